@@ -0,0 +1,405 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+A stand-in for the libvirt Python bindings that the benchmarks put first on
+the path of the commands they run.
+
+It implements the parts of the libvirt API that os-sandbox uses, and counts
+every call made on a connection, domain or network in CALLS, so each call
+stands for one RPC to libvirtd. Unlike libvirt's test:///default driver, the
+state of domains and networks is kept in the JSON file named by the
+OS_SANDBOX_FAKE_LIBVIRT_STATE environment variable, so that it carries over
+between the separate processes each command runs in.
+"""
+
+import atexit
+import collections
+import json
+import os
+import re
+import time
+
+STATE_PATH_ENV = 'OS_SANDBOX_FAKE_LIBVIRT_STATE'
+
+# libvirt.open() below shadows the builtin.
+_open_file = open
+
+VIR_ERR_ERROR = 2
+VIR_ERR_OPERATION_INVALID = 55
+VIR_ERR_NO_DOMAIN = 42
+VIR_ERR_NO_NETWORK = 43
+
+VIR_DOMAIN_NOSTATE = 0
+VIR_DOMAIN_RUNNING = 1
+VIR_DOMAIN_BLOCKED = 2
+VIR_DOMAIN_PAUSED = 3
+VIR_DOMAIN_SHUTDOWN = 4
+VIR_DOMAIN_SHUTOFF = 5
+VIR_DOMAIN_CRASHED = 6
+VIR_DOMAIN_PMSUSPENDED = 7
+
+VIR_DOMAIN_STATS_STATE = 1
+VIR_DOMAIN_STATS_CPU_TOTAL = 2
+VIR_DOMAIN_STATS_BALLOON = 4
+VIR_DOMAIN_STATS_VCPU = 8
+VIR_DOMAIN_STATS_INTERFACE = 16
+VIR_DOMAIN_STATS_BLOCK = 32
+VIR_CONNECT_LIST_NETWORKS_ACTIVE = 2
+VIR_DOMAIN_SAVE_BYPASS_CACHE = 1
+VIR_DOMAIN_SAVE_RUNNING = 2
+VIR_IP_ADDR_TYPE_IPV4 = 0
+
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_DEFINED = 0
+VIR_DOMAIN_EVENT_UNDEFINED = 1
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_SUSPENDED = 3
+VIR_DOMAIN_EVENT_RESUMED = 4
+VIR_DOMAIN_EVENT_STOPPED = 5
+VIR_DOMAIN_EVENT_SHUTDOWN = 6
+VIR_DOMAIN_EVENT_PMSUSPENDED = 7
+VIR_DOMAIN_EVENT_CRASHED = 8
+
+VIR_NETWORK_EVENT_ID_LIFECYCLE = 0
+VIR_NETWORK_EVENT_DEFINED = 0
+VIR_NETWORK_EVENT_UNDEFINED = 1
+VIR_NETWORK_EVENT_STARTED = 2
+VIR_NETWORK_EVENT_STOPPED = 3
+
+# Host the fake hypervisor pretends to run on.
+HOST_CPUS = 64
+HOST_MEMORY_MB = 1024 * 1024
+
+CAPABILITIES = """
+<capabilities>
+  <host>
+    <cpu>
+      <arch>x86_64</arch>
+      <model>Skylake-Server</model>
+      <vendor>Intel</vendor>
+      <pages unit='KiB' size='4'/>
+      <pages unit='KiB' size='2048'/>
+    </cpu>
+    <topology>
+      <cells num='1'>
+        <cell id='0'>
+          <memory unit='KiB'>{memory_kib}</memory>
+          <pages unit='KiB' size='4'>{small_pages}</pages>
+          <pages unit='KiB' size='2048'>0</pages>
+          <cpus num='{cpus}'>{cpu_xml}</cpus>
+        </cell>
+      </cells>
+    </topology>
+  </host>
+</capabilities>
+""".format(memory_kib=HOST_MEMORY_MB * 1024,
+           small_pages=HOST_MEMORY_MB * 256,
+           cpus=HOST_CPUS,
+           cpu_xml=''.join("<cpu id='{0}'/>".format(i)
+                           for i in range(HOST_CPUS)))
+
+# Number of calls made to each API method, keyed by method name.
+CALLS = collections.Counter()
+
+
+class libvirtError(Exception):
+
+    def __init__(self, msg, code=VIR_ERR_ERROR):
+        super(libvirtError, self).__init__(msg)
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+class _State(object):
+    """Domain and network state, loaded from and saved to the state file."""
+
+    def __init__(self):
+        self.path = os.environ.get(STATE_PATH_ENV)
+        self.domains = {}
+        self.networks = {}
+        self.dirty = False
+        if self.path and os.path.exists(self.path):
+            with _open_file(self.path) as state_file:
+                data = json.load(state_file)
+            self.domains = data.get('domains', {})
+            self.networks = data.get('networks', {})
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with _open_file(tmp_path, 'w') as state_file:
+            json.dump({'domains': self.domains, 'networks': self.networks},
+                      state_file)
+        os.rename(tmp_path, self.path)
+
+
+_STATE = _State()
+atexit.register(_STATE.save)
+
+
+def _counted(func):
+    def wrapper(*args, **kwargs):
+        CALLS[func.__name__] += 1
+        return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def _name_from_xml(xml):
+    return re.search(r'<name>\s*([^<\s]+)\s*</name>', xml).group(1)
+
+
+def _get_domain_stats(state, stats):
+    """Returns the stats of a domain in the format of getAllDomainStats(),
+    with the groups selected by the stats flags. 0 selects all groups.
+    """
+    result = {'state.state': state, 'state.reason': 0}
+    if not stats or stats & VIR_DOMAIN_STATS_CPU_TOTAL:
+        result.update({'cpu.time': 12 * 10 ** 9, 'cpu.user': 8 * 10 ** 9,
+                       'cpu.system': 3 * 10 ** 9})
+    if not stats or stats & VIR_DOMAIN_STATS_BALLOON:
+        result.update({'balloon.current': 524288,
+                       'balloon.maximum': 524288,
+                       'balloon.rss': 262144})
+    if not stats or stats & VIR_DOMAIN_STATS_VCPU:
+        result.update({'vcpu.current': 1, 'vcpu.maximum': 1})
+    if not stats or stats & VIR_DOMAIN_STATS_INTERFACE:
+        result.update({'net.count': 1, 'net.0.name': 'vnet0',
+                       'net.0.rx.bytes': 4096, 'net.0.rx.pkts': 32,
+                       'net.0.tx.bytes': 2048, 'net.0.tx.pkts': 16})
+    if not stats or stats & VIR_DOMAIN_STATS_BLOCK:
+        result.update({'block.count': 1, 'block.0.name': 'vda',
+                       'block.0.rd.bytes': 1048576, 'block.0.rd.reqs': 64,
+                       'block.0.wr.bytes': 524288, 'block.0.wr.reqs': 32,
+                       'block.0.capacity': 1073741824,
+                       'block.0.allocation': 196608})
+    return result
+
+
+class virDomain(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def _set_state(self, state):
+        if state is None:
+            _STATE.domains.pop(self._name, None)
+        else:
+            _STATE.domains[self._name] = state
+        _STATE.dirty = True
+
+    @_counted
+    def info(self):
+        return [_STATE.domains.get(self._name, VIR_DOMAIN_SHUTOFF),
+                0, 0, 1, 0]
+
+    @_counted
+    def destroy(self):
+        self._set_state(None)
+
+    @_counted
+    def suspend(self):
+        self._set_state(VIR_DOMAIN_PAUSED)
+
+    @_counted
+    def resume(self):
+        self._set_state(VIR_DOMAIN_RUNNING)
+
+    @_counted
+    def saveFlags(self, path, dxml=None, flags=0):
+        with _open_file(path, 'w') as save_file:
+            save_file.write('<domain><name>{0}</name></domain>'.format(
+                self._name))
+        self._set_state(None)
+
+
+class virNetwork(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    @_counted
+    def isActive(self):
+        return 1 if _STATE.networks.get(self._name) else 0
+
+    @_counted
+    def create(self):
+        _STATE.networks[self._name] = True
+        _STATE.dirty = True
+
+    @_counted
+    def destroy(self):
+        _STATE.networks.pop(self._name, None)
+        _STATE.dirty = True
+
+    @_counted
+    def DHCPLeases(self, mac=None, flags=0):
+        return []
+
+
+class virConnect(object):
+
+    def __init__(self, uri, readonly):
+        self.uri = uri
+        self.readonly = readonly
+        self._alive = True
+        self._callback_id = 0
+
+    def _check_writable(self):
+        if self.readonly:
+            raise libvirtError("read-only connection",
+                               VIR_ERR_OPERATION_INVALID)
+
+    # Answered by the client library without an RPC, so it is not counted.
+    def isAlive(self):
+        return 1 if self._alive else 0
+
+    @_counted
+    def close(self):
+        self._alive = False
+        return 0
+
+    @_counted
+    def getInfo(self):
+        return ['x86_64', HOST_MEMORY_MB, HOST_CPUS, 2400, 1, 1,
+                HOST_CPUS // 2, 2]
+
+    @_counted
+    def getFreeMemory(self):
+        used_mb = 512 * len(_STATE.domains)
+        return (HOST_MEMORY_MB - used_mb) * 1024 * 1024
+
+    @_counted
+    def getCapabilities(self):
+        return CAPABILITIES
+
+    @_counted
+    def getCPUModelNames(self, arch, flags=0):
+        return ['Skylake-Server', 'Haswell', 'qemu64']
+
+    @_counted
+    def lookupByName(self, name):
+        if name not in _STATE.domains:
+            raise libvirtError("Domain not found: " + name,
+                               VIR_ERR_NO_DOMAIN)
+        return virDomain(name)
+
+    @_counted
+    def createXML(self, xml, flags=0):
+        self._check_writable()
+        name = _name_from_xml(xml)
+        if name in _STATE.domains:
+            raise libvirtError("Domain {0} already exists".format(name))
+        _STATE.domains[name] = VIR_DOMAIN_RUNNING
+        _STATE.dirty = True
+        return virDomain(name)
+
+    @_counted
+    def restoreFlags(self, path, dxml=None, flags=0):
+        self._check_writable()
+        with _open_file(path) as save_file:
+            name = _name_from_xml(save_file.read())
+        _STATE.domains[name] = VIR_DOMAIN_RUNNING
+        _STATE.dirty = True
+
+    @_counted
+    def saveImageGetXMLDesc(self, path, flags=0):
+        with _open_file(path) as save_file:
+            return save_file.read()
+
+    @_counted
+    def getAllDomainStats(self, stats=0, flags=0):
+        return [(virDomain(name), _get_domain_stats(state, stats))
+                for name, state in _STATE.domains.items()]
+
+    @_counted
+    def listAllDomains(self, flags=0):
+        return [virDomain(name) for name in _STATE.domains]
+
+    @_counted
+    def networkLookupByName(self, name):
+        if name not in _STATE.networks:
+            raise libvirtError("Network not found: " + name,
+                               VIR_ERR_NO_NETWORK)
+        return virNetwork(name)
+
+    @_counted
+    def networkCreateXML(self, xml):
+        self._check_writable()
+        name = _name_from_xml(xml)
+        _STATE.networks[name] = True
+        _STATE.dirty = True
+        return virNetwork(name)
+
+    @_counted
+    def listAllNetworks(self, flags=0):
+        return [virNetwork(name) for name, active in _STATE.networks.items()
+                if active or not flags & VIR_CONNECT_LIST_NETWORKS_ACTIVE]
+
+    @_counted
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        self._callback_id += 1
+        return self._callback_id
+
+    @_counted
+    def domainEventDeregisterAny(self, callback_id):
+        return 0
+
+    @_counted
+    def networkEventRegisterAny(self, net, event_id, callback, opaque):
+        self._callback_id += 1
+        return self._callback_id
+
+    @_counted
+    def networkEventDeregisterAny(self, callback_id):
+        return 0
+
+    @_counted
+    def registerCloseCallback(self, callback, opaque):
+        return 0
+
+    @_counted
+    def unregisterCloseCallback(self):
+        return 0
+
+
+def registerErrorHandler(f, ctx):
+    pass
+
+
+def virEventRegisterDefaultImpl():
+    pass
+
+
+def virEventRunDefaultImpl():
+    # Nothing ever happens on the fake host.
+    time.sleep(3600)
+
+
+@_counted
+def open(uri=None):
+    return virConnect(uri, readonly=False)
+
+
+@_counted
+def openReadOnly(uri=None):
+    return virConnect(uri, readonly=True)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Measures the cold-start time of `os_sandbox.main:main` for each subcommand.
+
+Every run starts a fresh Python interpreter, so the timings include
+interpreter startup and every import the subcommand triggers. The heavy
+third-party modules each subcommand ended up importing are reported too, so
+that a command which starts importing something it doesn't need shows up.
+
+Usage:
+
+    python benchmarks/startup.py [--repeat N] [--state-dir DIR] [--json FILE]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Subcommands to measure. Commands that take the common --state-dir option
+# are run against the benchmark state dir.
+COMMANDS = (
+    (('--help',), False),
+    (('help',), False),
+    (('template', 'list'), True),
+    (('image', 'list'), True),
+    (('sandbox', 'list'), True),
+)
+
+# Third-party modules whose import cost shows up in the startup time. slugify
+# is cheap and imported eagerly, but is tracked so that it stays that way.
+HEAVY_MODULES = ('libvirt', 'netaddr', 'slugify', 'yaml')
+
+# Runs main() in the child interpreter and, on exit, writes the names of the
+# heavy modules it imported to the file named by the first argument.
+CHILD_SCRIPT = """
+import atexit, json, sys
+out_path = sys.argv.pop(1)
+heavy = %r
+
+def _report():
+    with open(out_path, 'w') as out:
+        json.dump([m for m in heavy if m in sys.modules], out)
+
+atexit.register(_report)
+from os_sandbox.main import main
+sys.exit(main(sys.argv[1:]))
+""" % (HEAVY_MODULES,)
+
+
+def make_state_dir():
+    """Creates an empty, group writeable state dir."""
+    state_dir = tempfile.mkdtemp(prefix='os-sandbox-bench-')
+    for d in ('sandboxes', 'templates', 'images'):
+        os.mkdir(os.path.join(state_dir, d))
+    os.chmod(state_dir, 0o775)
+    return state_dir
+
+
+def run_once(args):
+    """Runs the CLI once in a fresh interpreter.
+
+    :returns tuple of (elapsed seconds, exit code, list of heavy modules
+             imported)
+    """
+    fd, out_path = tempfile.mkstemp(prefix='os-sandbox-bench-')
+    os.close(fd)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (REPO_DIR, env.get('PYTHONPATH')) if p)
+    cmd = [sys.executable, '-c', CHILD_SCRIPT, out_path] + list(args)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            returncode = subprocess.call(cmd, stdout=devnull, stderr=devnull,
+                                         env=env)
+            elapsed = time.time() - start
+        with open(out_path) as out:
+            content = out.read()
+        return elapsed, returncode, json.loads(content) if content else []
+    finally:
+        os.unlink(out_path)
+
+
+def measure(state_dir, repeat):
+    results = []
+    for args, takes_state_dir in COMMANDS:
+        if takes_state_dir:
+            args = args + ('--state-dir', state_dir)
+        timings = []
+        imported = []
+        failed = False
+        for _ in range(repeat):
+            elapsed, returncode, imported = run_once(args)
+            timings.append(elapsed)
+            failed = failed or returncode != 0
+        timings.sort()
+        results.append({
+            'command': ' '.join(args[:2] if takes_state_dir else args),
+            'min_ms': round(timings[0] * 1000, 1),
+            'median_ms': round(timings[len(timings) // 2] * 1000, 1),
+            'heavy_imports': imported,
+            'failed': failed,
+        })
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of runs per command.")
+    parser.add_argument('--state-dir',
+                        help="State dir to run commands against. Defaults "
+                             "to a new, empty one.")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    state_dir = args.state_dir or make_state_dir()
+    try:
+        results = measure(state_dir, max(1, args.repeat))
+    finally:
+        if not args.state_dir:
+            shutil.rmtree(state_dir)
+
+    line = "{0:<16} {1:>10} {2:>12}  {3}"
+    print(line.format('Command', 'Min (ms)', 'Median (ms)', 'Heavy imports'))
+    for r in results:
+        command = r['command'] + (' (FAILED)' if r['failed'] else '')
+        print(line.format(command, r['min_ms'], r['median_ms'],
+                          ', '.join(r['heavy_imports']) or '-'))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'python': sys.version.split()[0], 'startup': results},
+                      out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Measures the latency, libvirt RPCs and peak memory of sandbox commands
+against generated state dirs holding 10, 100 and 1000 sandboxes.
+
+Every command runs in a fresh Python interpreter, as it would from the
+shell, with the fake libvirt module in benchmarks/fakes first on its path.
+The fake counts every libvirt call the command makes and keeps the state of
+domains and networks in a file in the state dir. A quarter of each state
+dir's sandboxes are running.
+
+Results can be written to a JSON file, and compared with those of another
+commit:
+
+    python benchmarks/suite.py --json after.json --compare before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKES_DIR = os.path.join(BENCH_DIR, 'fakes')
+
+sys.path.insert(0, REPO_DIR)
+
+DEFAULT_SIZES = (10, 100, 1000)
+TEMPLATE_NAME = 'bench'
+NODES = (
+    ('controller', ['controller'], []),
+    ('compute1', ['compute'], ['controller']),
+    ('compute2', ['compute'], ['controller']),
+)
+RUNNING_FRACTION = 0.25
+FAKE_STATE_FILENAME = 'fake-libvirt.json'
+
+# Every sandbox in a generated state dir fits on the fake host.
+HOST_CONFIG = {
+    'cpus': {'overcommit_ratio': 64.0},
+    'capacity': {'disk_overcommit_ratio': 10000.0},
+}
+
+# Changes of more than this fraction are flagged by --compare.
+REGRESSION_THRESHOLD = 0.10
+
+# Runs main() in the child interpreter and, on exit, writes the time main()
+# took, the libvirt calls it made and its peak RSS to the file named by the
+# first argument.
+CHILD_SCRIPT = """
+import atexit, json, resource, sys, time
+out_path = sys.argv.pop(1)
+result = {}
+
+def _report():
+    libvirt = sys.modules.get('libvirt')
+    result['rpcs'] = dict(getattr(libvirt, 'CALLS', {}))
+    result['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    with open(out_path, 'w') as out:
+        json.dump(result, out)
+
+atexit.register(_report)
+from os_sandbox.main import main
+start = time.time()
+try:
+    returncode = main(sys.argv[1:])
+finally:
+    result['main_ms'] = (time.time() - start) * 1000
+sys.exit(returncode)
+"""
+
+
+def have_qemu_img():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, 'qemu-img'), os.X_OK):
+            return True
+    return False
+
+
+def _write_yaml(path, data):
+    import yaml
+    with open(path, 'w') as out:
+        out.write(yaml.safe_dump(data, default_flow_style=False))
+
+
+def generate_state_dir(count):
+    """Creates a state dir with a template, a base image and `count`
+    sandboxes created from the template, and builds its state catalog.
+
+    :returns the path of the state dir.
+    """
+    from os_sandbox import catalog
+    from os_sandbox import conf
+    from os_sandbox import ipam
+
+    state_dir = tempfile.mkdtemp(prefix='os-sandbox-bench-%d-' % count)
+    for d in ('sandboxes', 'templates', 'images', 'pools'):
+        os.mkdir(os.path.join(state_dir, d))
+    os.chmod(state_dir, 0o775)
+    _write_yaml(os.path.join(state_dir, conf.HOST_CONFIG_FILENAME),
+                HOST_CONFIG)
+
+    image_path = os.path.join(state_dir, 'images', 'ubuntu.qcow2')
+    if have_qemu_img():
+        subprocess.check_call(('qemu-img', 'create', '-q', '-f', 'qcow2',
+                               image_path, '1G'))
+    else:
+        open(image_path, 'w').close()
+
+    tpl_nodes = [
+        {
+            'name': name,
+            'image': 'ubuntu',
+            'resources': {'vcpu': 1, 'ram_mb': 256, 'disk_gb': 1,
+                          'nested_virt': False},
+            'services': services,
+            'start_after': start_after,
+        }
+        for name, services, start_after in NODES
+    ]
+    tpl_dir = os.path.join(state_dir, 'templates', TEMPLATE_NAME)
+    os.mkdir(tpl_dir)
+    _write_yaml(os.path.join(tpl_dir, 'config.yaml'), {
+        'full_name': TEMPLATE_NAME,
+        'description': 'Benchmark template',
+        'nodes': tpl_nodes,
+        'device_profile': 'virtio',
+    })
+
+    pools = dict(
+        (name, ipam.SubnetPool(name, p['supernet'], p['prefixlen']))
+        for name, p in conf.HOST_CONFIG_DEFAULTS['networks'].items()
+    )
+    running = {}
+    for i in range(count):
+        slug = 'sb-%05d' % i
+        sb_dir = os.path.join(state_dir, 'sandboxes', slug)
+        os.makedirs(os.path.join(sb_dir, 'nodes'))
+        nodes = []
+        for tpl_node in tpl_nodes:
+            node_info = dict(tpl_node)
+            node_info.update({
+                'uuid': uuid.uuid4().hex,
+                'domain_name': '{0}-{1}'.format(slug, tpl_node['name']),
+                'image_path': image_path,
+                'device_profile': 'virtio',
+            })
+            node_dir = os.path.join(sb_dir, 'nodes', tpl_node['name'])
+            os.mkdir(node_dir)
+            # An empty overlay, so starting the node runs no qemu-img.
+            open(os.path.join(node_dir, 'disk.qcow2'), 'w').close()
+            _write_yaml(os.path.join(node_dir, 'config.yaml'), node_info)
+            nodes.append(node_info)
+            if i < count * RUNNING_FRACTION:
+                running[node_info['domain_name']] = 1
+        _write_yaml(os.path.join(sb_dir, 'config.yaml'), {
+            'full_name': slug,
+            'template': TEMPLATE_NAME,
+            'networks': dict((name, str(pool.cidr(i)))
+                             for name, pool in pools.items()),
+            'nodes': nodes,
+        })
+
+    with open(os.path.join(state_dir, FAKE_STATE_FILENAME), 'w') as out:
+        json.dump({'domains': running, 'networks': {'default': True}}, out)
+    catalog.get_catalog(state_dir).rebuild()
+    return state_dir
+
+
+def run_once(state_dir, args):
+    """Runs the CLI once in a fresh interpreter against the fake libvirt.
+
+    :returns dict with the 'elapsed_ms' of the whole run, the 'main_ms'
+             spent in main(), the 'rpcs' made, the 'peak_rss_kb' and the
+             'returncode'.
+    """
+    fd, out_path = tempfile.mkstemp(prefix='os-sandbox-bench-')
+    os.close(fd)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (FAKES_DIR, REPO_DIR, env.get('PYTHONPATH')) if p)
+    env['OS_SANDBOX_FAKE_LIBVIRT_STATE'] = os.path.join(state_dir,
+                                                        FAKE_STATE_FILENAME)
+    env.pop('OS_SANDBOX_LIBVIRT_URI', None)
+    cmd = [sys.executable, '-c', CHILD_SCRIPT, out_path] + list(args)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            returncode = subprocess.call(cmd, stdout=devnull, stderr=devnull,
+                                         env=env)
+            elapsed = time.time() - start
+        with open(out_path) as out:
+            content = out.read()
+        result = json.loads(content) if content else {}
+        result['elapsed_ms'] = elapsed * 1000
+        result['returncode'] = returncode
+        return result
+    finally:
+        os.unlink(out_path)
+
+
+def get_operations(count, can_create):
+    """Returns a list of (operation, list of argument tuples) to run for a
+    state dir of `count` sandboxes. The argument tuples of an operation are
+    run in order once per repeat.
+    """
+    first = 'sb-00000'
+    stopped = 'sb-%05d' % (count - 1)
+    ops = [
+        ('cold start', [('--help',)]),
+        ('sandbox list', [('sandbox', 'list', '-f', 'value')]),
+        ('sandbox show', [('sandbox', 'show', first)]),
+        ('sandbox start', [('sandbox', 'start', stopped)]),
+        ('sandbox stop', [('sandbox', 'stop', stopped)]),
+        ('host capacity', [('host', 'capacity', '-f', 'value')]),
+        ('metrics', [('metrics',)]),
+    ]
+    if can_create:
+        ops.extend([
+            ('sandbox create', [('sandbox', 'create', 'bench-new', '-t',
+                                 TEMPLATE_NAME)]),
+            ('sandbox delete', [('sandbox', 'delete', 'bench-new')]),
+        ])
+    return ops
+
+
+def measure(count, repeat, can_create):
+    state_dir = generate_state_dir(count)
+    try:
+        ops = get_operations(count, can_create)
+        runs = dict((name, []) for name, _args in ops)
+        # Operations are interleaved, so that each start is followed by its
+        # stop and each create by its delete.
+        for _ in range(repeat):
+            for name, arg_list in ops:
+                for args in arg_list:
+                    if args[0] != '--help':
+                        args = args + ('--state-dir', state_dir)
+                    runs[name].append(run_once(state_dir, args))
+
+        results = []
+        for name, _args in ops:
+            op_runs = runs[name]
+            elapsed = sorted(r['elapsed_ms'] for r in op_runs)
+            main_ms = sorted(r.get('main_ms', 0) for r in op_runs)
+            rpcs = op_runs[-1].get('rpcs', {})
+            results.append({
+                'sandboxes': count,
+                'operation': name,
+                'min_ms': round(elapsed[0], 1),
+                'median_ms': round(elapsed[len(elapsed) // 2], 1),
+                'main_median_ms': round(main_ms[len(main_ms) // 2], 1),
+                'rpc_calls': sum(rpcs.values()),
+                'rpcs': rpcs,
+                'peak_rss_kb': max(r.get('peak_rss_kb', 0) for r in op_runs),
+                'failed': any(r['returncode'] != 0 for r in op_runs),
+            })
+        return results
+    finally:
+        shutil.rmtree(state_dir)
+
+
+def get_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ('git', 'rev-parse', '--short', 'HEAD'), cwd=REPO_DIR,
+                stderr=devnull).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    line = "{0:>6} {1:<25} {2:>9} {3:>11} {4:>9} {5:>6} {6:>10}"
+    print(line.format('Sbs', 'Operation', 'Min (ms)', 'Median (ms)',
+                      'main (ms)', 'RPCs', 'Peak (KB)'))
+    for r in results:
+        operation = r['operation'] + (' (FAILED)' if r['failed'] else '')
+        print(line.format(r['sandboxes'], operation, r['min_ms'],
+                          r['median_ms'], r['main_median_ms'],
+                          r['rpc_calls'], r['peak_rss_kb']))
+
+
+def _change(old, new):
+    if not old:
+        return None
+    return float(new - old) / old
+
+
+def compare(old_results, new_results):
+    """Prints the change of each measurement from the old results to the
+    new ones, flagging those that grew by more than REGRESSION_THRESHOLD.
+
+    :returns the number of flagged regressions.
+    """
+    old = dict(((r['sandboxes'], r['operation']), r) for r in old_results)
+    metrics = (('median_ms', 'Median'), ('rpc_calls', 'RPCs'),
+               ('peak_rss_kb', 'Peak'))
+    line = "{0:>6} {1:<25} {2:>18} {3:>14} {4:>18}"
+    print(line.format('Sbs', 'Operation', 'Median (ms)', 'RPCs',
+                      'Peak (KB)'))
+    regressions = 0
+    for r in new_results:
+        before = old.get((r['sandboxes'], r['operation']))
+        if before is None:
+            continue
+        cells = []
+        for key, _title in metrics:
+            change = _change(before[key], r[key])
+            cell = '{0} -> {1}'.format(before[key], r[key])
+            if change is not None and change > REGRESSION_THRESHOLD:
+                cell += ' !'
+                regressions += 1
+            cells.append(cell)
+        print(line.format(r['sandboxes'], r['operation'], *cells))
+    if regressions:
+        print("\n{0} measurements grew by more than {1:.0%} (marked !)."
+              .format(regressions, REGRESSION_THRESHOLD))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES), metavar='N',
+                        help="Numbers of sandboxes to generate state dirs "
+                             "with.")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of runs per operation.")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Also write the results to this JSON file.")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Compare the results with those in this JSON "
+                             "file, written by an earlier --json run.")
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="With --compare, exit with status 1 if any "
+                             "measurement regressed.")
+    args = parser.parse_args(argv)
+
+    can_create = have_qemu_img()
+    if not can_create:
+        print("qemu-img not found, not measuring sandbox create and "
+              "delete.\n")
+
+    results = []
+    for count in args.sizes:
+        results.extend(measure(count, max(1, args.repeat), can_create))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({
+                'python': sys.version.split()[0],
+                'commit': get_commit(),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                            time.gmtime()),
+                'results': results,
+            }, out, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as old_file:
+            old = json.load(old_file)
+        print("\nCompared with {0}:\n".format(old.get('commit') or
+                                             args.compare))
+        regressions = compare(old['results'], results)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,199 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import errno
+import logging
+import logging.handlers
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+from six.moves import queue
+
+LOG = logging.getLogger(__name__)
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# Number of trailing output lines kept in memory for error reports.
+TAIL_LINES = 40
+
+# Seconds to wait for the build to exit after SIGTERM before sending SIGKILL.
+KILL_GRACE_SECONDS = 10
+
+# disk-image-create runs each element's hook scripts with dib-run-parts,
+# which logs a line like the following before running every script, e.g.:
+#   dib-run-parts Running /tmp/in_target.d/install.d/50-cloud-init-nocloud
+RUNNING_RE = re.compile(r'dib-run-parts .*Running \S*/([\w-]+)\.d/(\S+)')
+
+EVENT_PHASE = 'phase'
+EVENT_SCRIPT = 'script'
+
+
+class BuildResult(object):
+    """The outcome of a disk-image-create run."""
+
+    def __init__(self, returncode, elapsed, log_path, phases, scripts, tail):
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.log_path = log_path
+        # Lists of (name, seconds) tuples, in the order they ran.
+        self.phases = phases
+        self.scripts = scripts
+        self.tail = tail
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+    def slowest_scripts(self, count=5):
+        return sorted(self.scripts, key=lambda s: s[1], reverse=True)[:count]
+
+
+def _get_build_logger(log_path):
+    logger = logging.getLogger('os_sandbox.build.' + log_path)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
+def _pump(stream, name, lines):
+    """Reads lines from one of the build's pipes until it is closed."""
+    try:
+        for line in iter(stream.readline, b''):
+            lines.put((name, line))
+    finally:
+        stream.close()
+        lines.put((name, None))
+
+
+def _kill(proc):
+    """Terminates the build and everything it started, which all run in the
+    build's own process group.
+    """
+    for sig, wait in ((signal.SIGTERM, KILL_GRACE_SECONDS),
+                      (signal.SIGKILL, None)):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError as err:
+            if err.errno == errno.ESRCH:
+                return
+            raise
+        deadline = time.time() + (wait or 0)
+        while time.time() < deadline:
+            if proc.poll() is not None:
+                return
+            time.sleep(0.2)
+    proc.wait()
+
+
+def run(args, log_path, progress=None, timeout=None, env=None):
+    """Runs a disk-image-create command, streaming its stdout and stderr to
+    a rotating build log as they are produced instead of buffering them.
+
+    :param args: The command line to run.
+    :param log_path: Pathname of the build log. It is rotated when it grows
+                     beyond LOG_MAX_BYTES.
+    :param progress: Optional callable, passed (event, name), that is called
+                     when the build enters a new hook phase (EVENT_PHASE,
+                     e.g. 'root') or starts a hook script (EVENT_SCRIPT, e.g.
+                     '50-cloud-init-nocloud').
+    :param timeout: Optional number of seconds after which the build is
+                    killed.
+    :param env: Optional environment for the build.
+    :raises RuntimeError if the build timed out. If the build is interrupted
+            with Ctrl-C, the build is killed before KeyboardInterrupt is
+            re-raised.
+    :returns BuildResult
+    """
+    build_log = _get_build_logger(log_path)
+    build_log.info("Running: %s", " ".join(args))
+
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env,
+                            preexec_fn=os.setsid)
+    lines = queue.Queue()
+    pumps = [
+        threading.Thread(target=_pump, args=(proc.stdout, 'out', lines)),
+        threading.Thread(target=_pump, args=(proc.stderr, 'err', lines)),
+    ]
+    for pump in pumps:
+        pump.daemon = True
+        pump.start()
+
+    start = time.time()
+    deadline = start + timeout if timeout else None
+    tail = collections.deque(maxlen=TAIL_LINES)
+    phases = []
+    scripts = []
+    phase = script = None
+    phase_start = script_start = start
+    open_pipes = len(pumps)
+
+    try:
+        while open_pipes:
+            if deadline is not None and time.time() > deadline:
+                _kill(proc)
+                msg = ("Image build timed out after {0} seconds. See {1} "
+                       "for the build output.").format(timeout, log_path)
+                raise RuntimeError(msg)
+            try:
+                name, line = lines.get(timeout=1)
+            except queue.Empty:
+                continue
+            if line is None:
+                open_pipes -= 1
+                continue
+
+            line = line.decode('utf-8', 'replace').rstrip()
+            build_log.info("[%s] %s", name, line)
+            tail.append(line)
+
+            match = RUNNING_RE.search(line)
+            if not match:
+                continue
+            now = time.time()
+            if script is not None:
+                scripts.append((script, now - script_start))
+            script, script_start = match.group(2), now
+            if match.group(1) != phase:
+                if phase is not None:
+                    phases.append((phase, now - phase_start))
+                phase, phase_start = match.group(1), now
+                if progress is not None:
+                    progress(EVENT_PHASE, phase)
+            if progress is not None:
+                progress(EVENT_SCRIPT, script)
+    except KeyboardInterrupt:
+        build_log.info("Build cancelled.")
+        _kill(proc)
+        raise
+
+    returncode = proc.wait()
+    now = time.time()
+    if script is not None:
+        scripts.append((script, now - script_start))
+    if phase is not None:
+        phases.append((phase, now - phase_start))
+    build_log.info("Build exited with %d after %.1f seconds.",
+                   returncode, now - start)
+    return BuildResult(returncode, now - start, log_path, phases, scripts,
+                       list(tail))
@@ -0,0 +1,181 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import time
+
+from os_sandbox import catalog
+from os_sandbox import conf
+from os_sandbox import connection
+from os_sandbox import cpupin
+from os_sandbox import states
+
+LOG = logging.getLogger(__name__)
+
+RESOURCES = ('vcpu', 'ram_mb', 'disk_gb')
+
+# Seconds between admission checks while waiting for capacity.
+WAIT_INTERVAL = 5
+
+
+def get_disk_sizes_gb(resources):
+    """Returns the sizes in GB of the disks in a node's resources, the boot
+    disk's first. Their disk_gb is either the size of the boot disk or a
+    list of the sizes of the boot disk and of the node's data disks.
+    """
+    disk_gb = resources.get('disk_gb', 0)
+    if isinstance(disk_gb, list):
+        return list(disk_gb)
+    return [disk_gb]
+
+
+def get_request(node_confs, running=False):
+    """Returns the total resources of the supplied node configs as a dict
+    keyed by resource name.
+
+    :param running: Whether the nodes are already defined, in which case
+                    their disk is already accounted for and only their vCPUs
+                    and memory are requested.
+    """
+    request = dict((r, 0) for r in RESOURCES)
+    for node_conf in node_confs:
+        resources = node_conf['resources']
+        request['vcpu'] += resources.get('vcpu', 0)
+        request['ram_mb'] += resources.get('ram_mb', 0)
+        if not running:
+            request['disk_gb'] += sum(get_disk_sizes_gb(resources))
+    return request
+
+
+def get_define_request(node_confs):
+    """Returns the resources committed by defining the supplied node configs
+    without starting them, which is only their disk. Their vCPUs and memory
+    are requested when they are started.
+    """
+    request = dict((r, 0) for r in RESOURCES)
+    request['disk_gb'] = get_request(node_confs)['disk_gb']
+    return request
+
+
+class Capacity(object):
+    """How much of the host's vCPUs, memory and disk the sandboxes have
+    committed, and how much more they may commit.
+
+    vCPUs and memory are committed by running nodes, disk by every node,
+    since a node's overlay may grow to its full disk size whether it is
+    running or not. Each resource may be committed up to its total times its
+    overcommit ratio. Memory is also limited by what is actually free, less
+    the memory reserved for the host itself.
+    """
+
+    def __init__(self, state_dir, uri=None):
+        conn = connection.get_connection(uri)
+        # [model, memory MiB, cpus, MHz, NUMA nodes, sockets, cores, threads]
+        info = conn.getInfo()
+        st = os.statvfs(state_dir)
+        gib = 1024 * 1024 * 1024
+        self.total = {
+            'vcpu': info[2],
+            'ram_mb': info[1],
+            'disk_gb': st.f_blocks * st.f_frsize // gib,
+        }
+        self.free = {
+            'vcpu': None,
+            'ram_mb': conn.getFreeMemory() // (1024 * 1024),
+            'disk_gb': st.f_bavail * st.f_frsize // gib,
+        }
+
+        host_conf = conf.get_host_config(state_dir)
+        cap_conf = host_conf['capacity']
+        self.reserved_ram_mb = cap_conf['reserved_ram_mb']
+        self.limit = {
+            'vcpu': self._get_vcpu_limit(host_conf['cpus']),
+            'ram_mb': int(self.total['ram_mb'] *
+                          cap_conf['ram_overcommit_ratio']) -
+                      self.reserved_ram_mb,
+            'disk_gb': int(self.total['disk_gb'] *
+                           cap_conf['disk_overcommit_ratio']),
+        }
+        self.committed = self._get_committed(state_dir, uri)
+
+    def _get_vcpu_limit(self, cpu_conf):
+        """Dedicated host CPUs each take one vCPU, and shared ones are
+        overcommitted as set in the `cpus` host config.
+        """
+        total = self.total['vcpu']
+        dedicated = len([c for c in cpupin.parse_cpuset(
+                         cpu_conf.get('dedicated') or '') if c < total])
+        if cpu_conf.get('shared'):
+            shared = len([c for c in cpupin.parse_cpuset(cpu_conf['shared'])
+                          if c < total])
+        else:
+            shared = total - dedicated
+        return dedicated + int(shared * float(cpu_conf['overcommit_ratio']))
+
+    def _get_committed(self, state_dir, uri):
+        host_states = states.get_states(uri)
+        all_confs = []
+        running_confs = []
+        for node_confs in catalog.get_catalog(state_dir).get_nodes().values():
+            for name, node_conf in node_confs.items():
+                all_confs.append(node_conf)
+                domain_name = node_conf.get('domain_name', name)
+                if host_states.domain_active(domain_name):
+                    running_confs.append(node_conf)
+        committed = get_request(running_confs, running=True)
+        committed['disk_gb'] = get_request(all_confs)['disk_gb']
+        return committed
+
+    def headroom(self, resource):
+        """Returns how much more of the resource may be committed."""
+        headroom = self.limit[resource] - self.committed[resource]
+        if resource == 'ram_mb':
+            headroom = min(headroom,
+                           self.free['ram_mb'] - self.reserved_ram_mb)
+        return max(headroom, 0)
+
+    def shortfalls(self, request):
+        """Returns a list of messages describing each resource the request
+        does not fit in. An empty list means the request is admitted.
+        """
+        messages = []
+        for resource in RESOURCES:
+            wanted = request.get(resource, 0)
+            headroom = self.headroom(resource)
+            if wanted > headroom:
+                messages.append("{0}: {1} requested, {2} available".format(
+                    resource, wanted, headroom))
+        return messages
+
+
+def admit(state_dir, uri, request, wait=None):
+    """Checks that the host has the capacity for the requested resources.
+
+    :param request: Dict of requested resources. See get_request().
+    :param wait: Optional number of seconds to wait for capacity to become
+                 available, rechecking every WAIT_INTERVAL seconds.
+    :raises RuntimeError if the request does not fit on the host within the
+            wait.
+    """
+    deadline = time.time() + (wait or 0)
+    while True:
+        shortfalls = Capacity(state_dir, uri).shortfalls(request)
+        if not shortfalls:
+            return
+        if time.time() >= deadline:
+            msg = "Not enough capacity on the host: {0}."
+            raise RuntimeError(msg.format('; '.join(shortfalls)))
+        LOG.info("Waiting for capacity on the host: %s.",
+                 '; '.join(shortfalls))
+        time.sleep(WAIT_INTERVAL)
+        states.invalidate(uri)
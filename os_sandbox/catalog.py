@@ -0,0 +1,426 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from os_sandbox import helpers
+from os_sandbox import cpupin
+from os_sandbox import ipam
+
+yaml = helpers.lazy_import('yaml')
+
+LOG = logging.getLogger(__name__)
+
+CATALOG_FILENAME = 'catalog.db'
+
+# Bump this whenever the layout of the tables that are derived from the YAML
+# files changes, so that existing catalogs are rebuilt.
+SCHEMA_VERSION = 1
+
+# The catalog is considered stale, and is rebuilt from the YAML files, if
+# the mtime of any of these state dir subdirectories differs from the one
+# recorded when the catalog was last written, which catches entries being
+# added or removed, or if the config.yaml of any template, sandbox or node in
+# the catalog was changed in place since.
+WATCHED_DIRS = ('sandboxes', 'templates', 'images')
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS templates (
+        slug TEXT PRIMARY KEY,
+        config TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS sandboxes (
+        slug TEXT PRIMARY KEY,
+        template TEXT NOT NULL,
+        config TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS nodes (
+        sandbox TEXT NOT NULL,
+        name TEXT NOT NULL,
+        domain_name TEXT NOT NULL,
+        config TEXT NOT NULL,
+        PRIMARY KEY (sandbox, name)
+    )""",
+    """CREATE INDEX IF NOT EXISTS nodes_domain_name ON nodes (domain_name)""",
+    """CREATE TABLE IF NOT EXISTS networks (
+        sandbox TEXT NOT NULL,
+        name TEXT NOT NULL,
+        cidr TEXT NOT NULL,
+        PRIMARY KEY (sandbox, name)
+    )""",
+    """CREATE TABLE IF NOT EXISTS images (
+        name TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        file_format TEXT NOT NULL
+    )""",
+) + ipam.SCHEMA + cpupin.SCHEMA
+
+# Tables whose contents are derived entirely from the YAML files and images
+# in the state dir, and are cleared and refilled by Catalog.rebuild().
+DERIVED_TABLES = ('templates', 'sandboxes', 'nodes', 'networks', 'images')
+
+IMAGE_FORMATS = ('qcow2', 'raw')
+
+
+def _load_yaml(path):
+    with open(path, 'rb') as conf_file:
+        return yaml.load(conf_file.read())
+
+
+class Catalog(object):
+    """An SQLite index, stored in the state dir, of the sandboxes, nodes,
+    networks, templates and images described by the YAML files and image
+    files in the state dir.
+
+    The YAML files remain the source of truth. Every change to them made
+    through os-sandbox is mirrored into the catalog in a single transaction,
+    and the whole catalog is rebuilt from them when it is missing, was
+    written by an older version of os-sandbox, or the contents of the
+    sandboxes, templates or images directories, or the config files in them,
+    were changed behind its back.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.db_path = os.path.join(state_dir, CATALOG_FILENAME)
+        self._lock = threading.RLock()
+        self._conn = None
+        self._depth = 0
+        self._templates = None
+
+    def _open(self):
+        if self._conn is None:
+            # Transactions are managed explicitly. See transaction().
+            conn = sqlite3.connect(self.db_path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.text_factory = str
+            for stmt in SCHEMA:
+                conn.execute(stmt)
+            self._conn = conn
+        return self._conn
+
+    def _connect(self):
+        if self._conn is None:
+            self._open()
+            if not self._is_fresh():
+                self.rebuild()
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _dir_mtimes(self):
+        mtimes = {}
+        for d in WATCHED_DIRS:
+            try:
+                mtimes[d] = repr(os.stat(os.path.join(self.state_dir,
+                                                      d)).st_mtime)
+            except OSError:
+                mtimes[d] = ''
+        return mtimes
+
+    def _get_config_paths(self, conn):
+        """Returns the paths of the config files of every template, sandbox
+        and node in the catalog.
+        """
+        templates_dir = os.path.join(self.state_dir, 'templates') + os.sep
+        sandboxes_dir = os.path.join(self.state_dir, 'sandboxes') + os.sep
+        conf_name = os.sep + 'config.yaml'
+        nodes_dir = os.sep + 'nodes' + os.sep
+        paths = [templates_dir + slug + conf_name
+                 for (slug,) in conn.execute("SELECT slug FROM templates "
+                                             "ORDER BY slug")]
+        paths.extend(sandboxes_dir + slug + conf_name
+                     for (slug,) in conn.execute("SELECT slug FROM sandboxes "
+                                                 "ORDER BY slug"))
+        paths.extend(sandboxes_dir + sandbox + nodes_dir + name + conf_name
+                     for sandbox, name in conn.execute(
+                         "SELECT sandbox, name FROM nodes "
+                         "ORDER BY sandbox, name"))
+        return paths
+
+    def _configs_digest(self, conn):
+        """Returns a digest of the mtimes and sizes of the config files of
+        everything in the catalog. It costs a stat() per file, which is far
+        cheaper than parsing the files.
+        """
+        stamps = []
+        for path in self._get_config_paths(conn):
+            try:
+                st = os.stat(path)
+                stamps.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append((path, None, None))
+        return hashlib.sha1(repr(stamps).encode('utf-8')).hexdigest()
+
+    def _get_meta(self):
+        rows = self._conn.execute("SELECT key, value FROM meta")
+        return dict(rows.fetchall())
+
+    def _is_fresh(self):
+        meta = self._get_meta()
+        if meta.get('schema_version') != str(SCHEMA_VERSION):
+            return False
+        for d, mtime in self._dir_mtimes().items():
+            if meta.get('mtime:' + d) != mtime:
+                LOG.debug("State catalog is stale: %s dir changed.", d)
+                return False
+        if meta.get('configs') != self._configs_digest(self._conn):
+            LOG.debug("State catalog is stale: a config file changed.")
+            return False
+        return True
+
+    def _record_mtimes(self, conn):
+        """Records the current mtimes of the watched dirs and config files.
+        Must be called in the same transaction as any change made alongside
+        a change to them.
+        """
+        meta = [('mtime:' + d, mtime)
+                for d, mtime in self._dir_mtimes().items()]
+        meta.append(('configs', self._configs_digest(conn)))
+        meta.append(('schema_version', str(SCHEMA_VERSION)))
+        conn.executemany("INSERT OR REPLACE INTO meta (key, value) "
+                         "VALUES (?, ?)", meta)
+
+    @contextlib.contextmanager
+    def _transaction(self, conn):
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield conn
+                finally:
+                    self._depth -= 1
+                return
+
+            conn.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield conn
+                self._record_mtimes(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._depth = 0
+
+    def transaction(self):
+        """Returns a context manager that runs the enclosed catalog reads and
+        writes in a single transaction and yields the sqlite3 connection.
+
+        The transaction takes the database write lock up front, so it is
+        also serialized against other os-sandbox processes. Transactions may
+        be nested, in which case only the outermost one commits.
+        """
+        with self._lock:
+            conn = self._connect()
+        return self._transaction(conn)
+
+    def rebuild(self):
+        """Clears the catalog and refills it from the YAML files and image
+        files in the state dir.
+        """
+        with self._lock:
+            conn = self._open()
+            LOG.debug("Rebuilding state catalog %s.", self.db_path)
+            with self._transaction(conn):
+                for table in DERIVED_TABLES:
+                    conn.execute("DELETE FROM " + table)
+                self._rebuild_templates(conn)
+                self._rebuild_sandboxes(conn)
+                self._rebuild_images(conn)
+                ipam.rebuild_pools(conn)
+            self._templates = None
+
+    def _list_dir(self, name):
+        path = os.path.join(self.state_dir, name)
+        if not os.path.isdir(path):
+            return path, []
+        return path, sorted(os.listdir(path))
+
+    def _rebuild_templates(self, conn):
+        templates_dir, entries = self._list_dir('templates')
+        for entry in entries:
+            conf_path = os.path.join(templates_dir, entry, 'config.yaml')
+            if not os.path.exists(conf_path):
+                continue
+            try:
+                conf = _load_yaml(conf_path)
+            except Exception as err:
+                LOG.warning("Skipping template %s: %s", entry, err)
+                continue
+            self._insert_template(conn, entry, conf)
+
+    def _rebuild_sandboxes(self, conn):
+        sandboxes_dir, entries = self._list_dir('sandboxes')
+        for entry in entries:
+            sb_dir = os.path.join(sandboxes_dir, entry)
+            conf_path = os.path.join(sb_dir, 'config.yaml')
+            if not os.path.exists(conf_path):
+                continue
+            try:
+                conf = _load_yaml(conf_path)
+                node_confs = {}
+                for node_info in conf['nodes']:
+                    node_name = node_info['name']
+                    node_conf_path = os.path.join(sb_dir, 'nodes', node_name,
+                                                  'config.yaml')
+                    if os.path.exists(node_conf_path):
+                        node_confs[node_name] = _load_yaml(node_conf_path)
+            except Exception as err:
+                LOG.warning("Skipping sandbox %s: %s", entry, err)
+                continue
+            self._insert_sandbox(conn, entry, conf, node_confs)
+
+    def _rebuild_images(self, conn):
+        images_dir, entries = self._list_dir('images')
+        for entry in entries:
+            img_path = os.path.join(images_dir, entry)
+            name, _sep, file_format = entry.rpartition('.')
+            if file_format in IMAGE_FORMATS and os.path.isfile(img_path):
+                self._insert_image(conn, name, img_path, file_format)
+
+    def _insert_template(self, conn, slug, conf):
+        conn.execute("INSERT OR REPLACE INTO templates (slug, config) "
+                     "VALUES (?, ?)", (slug, json.dumps(conf)))
+
+    def _insert_sandbox(self, conn, slug, conf, node_confs):
+        conn.execute("INSERT OR REPLACE INTO sandboxes "
+                     "(slug, template, config) VALUES (?, ?, ?)",
+                     (slug, conf['template'], json.dumps(conf)))
+        conn.executemany(
+            "INSERT OR REPLACE INTO nodes "
+            "(sandbox, name, domain_name, config) VALUES (?, ?, ?, ?)",
+            [(slug, name, node_conf.get('domain_name', name),
+              json.dumps(node_conf))
+             for name, node_conf in node_confs.items()])
+        conn.executemany(
+            "INSERT OR REPLACE INTO networks (sandbox, name, cidr) "
+            "VALUES (?, ?, ?)",
+            [(slug, name, cidr)
+             for name, cidr in conf.get('networks', {}).items()])
+
+    def _insert_image(self, conn, name, path, file_format):
+        conn.execute("INSERT OR REPLACE INTO images "
+                     "(name, path, file_format) VALUES (?, ?, ?)",
+                     (name, path, file_format))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _write(self, func, *args):
+        with self.transaction() as conn:
+            func(conn, *args)
+
+    def add_template(self, slug, conf):
+        """Records a newly created template."""
+        self._write(self._insert_template, slug, conf)
+        self._templates = None
+
+    def get_templates(self):
+        """Returns a dict of template configs keyed by template slug."""
+        with self._lock:
+            if self._templates is None:
+                rows = self._query("SELECT slug, config FROM templates "
+                                   "ORDER BY slug")
+                self._templates = dict(
+                    (slug, json.loads(config)) for slug, config in rows
+                )
+            return self._templates
+
+    def get_template(self, slug):
+        """Returns the config of the template or None if it isn't known."""
+        return self.get_templates().get(slug)
+
+    def add_sandbox(self, slug, conf, node_confs):
+        """Records a newly created sandbox along with its nodes and
+        networks.
+
+        :param slug: The sandbox's directory name.
+        :param conf: The sandbox's config.
+        :param node_confs: Dict of node configs keyed by node name.
+        """
+        self._write(self._insert_sandbox, slug, conf, node_confs)
+
+    def delete_sandbox(self, slug):
+        """Removes a deleted sandbox along with its nodes and networks."""
+        def _delete(conn, slug):
+            for table, column in (('sandboxes', 'slug'),
+                                  ('nodes', 'sandbox'),
+                                  ('networks', 'sandbox')):
+                conn.execute("DELETE FROM {0} WHERE {1} = ?".format(
+                    table, column), (slug,))
+        self._write(_delete, slug)
+
+    def get_sandboxes(self):
+        """Returns a list of (slug, config) tuples for every sandbox."""
+        rows = self._query("SELECT slug, config FROM sandboxes ORDER BY slug")
+        return [(slug, json.loads(config)) for slug, config in rows]
+
+    def get_sandbox(self, slug):
+        """Returns the config of the sandbox or None if it isn't known."""
+        rows = self._query("SELECT config FROM sandboxes WHERE slug = ?",
+                           (slug,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_nodes(self, sandbox=None):
+        """Returns a dict, keyed by sandbox slug, of dicts of node configs
+        keyed by node name.
+
+        :param sandbox: Only return the nodes of the sandbox with this slug.
+        """
+        if sandbox is None:
+            rows = self._query("SELECT sandbox, name, config FROM nodes")
+        else:
+            rows = self._query("SELECT sandbox, name, config FROM nodes "
+                               "WHERE sandbox = ?", (sandbox,))
+        nodes = {}
+        for sb_slug, name, config in rows:
+            nodes.setdefault(sb_slug, {})[name] = json.loads(config)
+        return nodes
+
+    def add_image(self, name, path, file_format):
+        """Records a newly built image."""
+        self._write(self._insert_image, name, path, file_format)
+
+    def get_images(self):
+        """Returns a list of (name, path, file_format) tuples."""
+        return self._query("SELECT name, path, file_format FROM images "
+                           "ORDER BY name")
+
+
+_CATALOGS = {}
+_CATALOGS_LOCK = threading.Lock()
+
+
+def get_catalog(state_dir):
+    """Returns the shared Catalog for the supplied state dir."""
+    with _CATALOGS_LOCK:
+        if state_dir not in _CATALOGS:
+            _CATALOGS[state_dir] = Catalog(state_dir)
+        return _CATALOGS[state_dir]
@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import time
+
+from cliff import command
+from cliff import lister
+
+from os_sandbox import capacity
+from os_sandbox import conf
+from os_sandbox import events
+from os_sandbox import helpers
+from os_sandbox import node
+
+
+class HostCapacity(lister.Lister):
+    """Show how much of the sandbox host's capacity is committed."""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(HostCapacity, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+        cap = capacity.Capacity(state_dir, parsed_args.libvirt_uri)
+        return (
+            ('Resource', 'Total', 'Free', 'Limit', 'Committed', 'Headroom'),
+            ((
+                resource,
+                cap.total[resource],
+                '-' if cap.free[resource] is None else cap.free[resource],
+                cap.limit[resource],
+                cap.committed[resource],
+                cap.headroom(resource),
+              )
+             for resource in capacity.RESOURCES)
+        )
+
+
+class HostWatch(command.Command):
+    """Print domain and network state changes on the sandbox host as they
+    happen.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(HostWatch, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        return parser
+
+    def _print_change(self, kind, name, state):
+        if kind == 'domain':
+            status = node.Node.get_state_code_map().get(
+                state, node.Node.STATUS_UNDEFINED)
+        else:
+            status = 'ACTIVE' if state else 'INACTIVE'
+        line = "{0} {1:<8} {2:<40} {3}\n".format(
+            time.strftime('%H:%M:%S'), kind, name, status)
+        self.app.stdout.write(line)
+        self.app.stdout.flush()
+
+    def take_action(self, parsed_args):
+        watcher = events.get_watcher(parsed_args.libvirt_uri)
+        watcher.add_listener(self._print_change)
+        try:
+            while watcher.error is None:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        if watcher.error is not None:
+            raise RuntimeError(watcher.error)
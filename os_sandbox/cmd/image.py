@@ -16,6 +16,7 @@ import os
 from cliff import command
 from cliff import lister
 
+from os_sandbox import catalog
 from os_sandbox import conf
 from os_sandbox import helpers
 from os_sandbox import image
@@ -32,13 +33,12 @@ class ImageList(lister.Lister):
         return parser
 
     def take_action(self, parsed_args):
-        images = []
         state_dir = helpers.ensure_state_dir(parsed_args)
-        images_dir = os.path.join(state_dir, 'images')
-        for entry in os.listdir(images_dir):
-            img_path = os.path.join(images_dir, entry)
-            if os.path.isfile(img_path):
-                images.append(image.Image(parsed_args, entry))
+        cat = catalog.get_catalog(state_dir)
+        images = [
+            image.Image(parsed_args, name, file_format=file_format)
+            for name, path, file_format in cat.get_images()
+        ]
         return (
             ('Image', 'Type', 'Virtual Size', 'Disk Size'),
             ((
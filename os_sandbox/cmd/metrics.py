@@ -0,0 +1,62 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from cliff import command
+
+from os_sandbox import conf
+from os_sandbox import helpers
+from os_sandbox import metrics
+
+
+class Metrics(command.Command):
+    """Print the resource usage of every sandbox node in the Prometheus text
+    format, or serve it over HTTP for Prometheus to scrape.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(Metrics, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        parser.add_argument('--serve', action='store_true',
+                            default=False,
+                            help="Serve the metrics over HTTP at /metrics "
+                                 "until interrupted, collecting them afresh "
+                                 "for every scrape.")
+        parser.add_argument('--listen',
+                            default=metrics.DEFAULT_LISTEN_ADDRESS,
+                            metavar='ADDRESS',
+                            help="Address to serve the metrics on. "
+                                 "Defaults to %(default)s.")
+        parser.add_argument('--port', type=int,
+                            default=metrics.DEFAULT_PORT,
+                            help="Port to serve the metrics on. Defaults "
+                                 "to %(default)s.")
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+        collector = metrics.MetricsCollector(state_dir,
+                                             parsed_args.libvirt_uri)
+        if not parsed_args.serve:
+            text = metrics.format_text(collector.collect())
+            self.app.stdout.write(text)
+            self.app.stdout.flush()
+            return
+
+        try:
+            metrics.serve(collector, address=parsed_args.listen,
+                          port=parsed_args.port)
+        except KeyboardInterrupt:
+            pass
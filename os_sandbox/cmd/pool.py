@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from cliff import command
+from cliff import lister
+
+from os_sandbox import conf
+from os_sandbox import helpers
+from os_sandbox import pool
+
+
+class PoolList(lister.Lister):
+    """Show the warm pool of each template that has one."""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(PoolList, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+        rows = []
+        for tpl_name in sorted(pool.get_sizes(state_dir)):
+            wp = pool.WarmPool(parsed_args, tpl_name)
+            rows.append((
+                tpl_name,
+                wp.size,
+                len(wp.members(pool.STATE_READY)),
+                len(wp.members(pool.STATE_FILLING)),
+            ))
+        return (('Template', 'Size', 'Ready', 'Filling'), rows)
+
+
+class PoolFill(command.Command):
+    """Fills warm pools up to their size, deleting any surplus sandboxes."""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(PoolFill, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        parser.add_argument('templates', nargs='*', metavar='template',
+                            help='Name of a template whose pool to fill. '
+                                 'Defaults to every template with a warm '
+                                 'pool.')
+        conf.add_parallel_arg(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+
+        tpl_names = (parsed_args.templates or
+                     sorted(pool.get_sizes(state_dir)))
+        for tpl_name in tpl_names:
+            wp = pool.WarmPool(parsed_args, tpl_name)
+            filled = wp.fill(parallel=parsed_args.parallel)
+
+            if self.app.options.verbose_level > 0:
+                if filled:
+                    self.app.console_ok(newline=False)
+                    msg = " Filled warm pool of template {0}\n"
+                else:
+                    msg = ("Warm pool of template {0} is already being "
+                           "filled\n")
+                self.app.stdout.write(msg.format(tpl_name))
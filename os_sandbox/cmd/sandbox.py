@@ -19,9 +19,14 @@ from cliff import show
 
 from os_sandbox import conf
 from os_sandbox import helpers
+from os_sandbox import pool
+from os_sandbox import readiness
 from os_sandbox import sandbox
 from os_sandbox import template
 
+# Seconds `sandbox start --wait` waits for the nodes to boot.
+DEFAULT_WAIT_TIMEOUT = 600
+
 
 class SandboxList(lister.Lister):
     """Show a list of sandboxes created on the sandbox host."""
@@ -76,7 +81,7 @@ class SandboxShow(command.Command):
         self.app.stdout.write('Networks:\n')
         line = "  {:<18} {:<14} {:<10}\n"
         for net in sb.networks:
-            net_line = line.format(net.name, net.status, net.cidr)
+            net_line = line.format(net.libvirt_name, net.status, net.cidr)
             self.app.stdout.write(net_line)
         self.app.stdout.write('Nodes:\n')
         for node in sb.nodes:
@@ -97,6 +102,7 @@ class SandboxCreate(command.Command):
         parser.add_argument('-t', '--template',
                             required=True,
                             help='Name of the template to use for the sandbox')
+        conf.add_wait_for_capacity_arg(parser)
         return parser
 
     def take_action(self, parsed_args):
@@ -105,7 +111,7 @@ class SandboxCreate(command.Command):
         sb_name = parsed_args.name
         tpl_name = parsed_args.template
         sb = sandbox.Sandbox(parsed_args, sb_name)
-        sb.create()
+        sb.create(wait_for_capacity=parsed_args.wait_for_capacity)
         
         if self.app.options.verbose_level > 0:
             self.app.console_ok(newline=False)
@@ -114,6 +120,37 @@ class SandboxCreate(command.Command):
             self.app.stdout.write(msg)
 
 
+class SandboxCheckout(command.Command):
+    """Hands out a sandbox from a template's warm pool under a given name."""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(SandboxCheckout, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        parser.add_argument('name', help='Name of the sandbox')
+        parser.add_argument('-t', '--template',
+                            required=True,
+                            help='Name of the template whose warm pool to '
+                                 'take the sandbox from')
+        conf.add_parallel_arg(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+
+        sb_name = parsed_args.name
+        tpl_name = parsed_args.template
+        wp = pool.WarmPool(parsed_args, tpl_name)
+        wp.checkout(sb_name, parallel=parsed_args.parallel)
+
+        if self.app.options.verbose_level > 0:
+            self.app.console_ok(newline=False)
+            msg = " Checked out sandbox {0} from warm pool of template {1}\n"
+            msg = msg.format(sb_name, tpl_name)
+            self.app.stdout.write(msg)
+
+
 class SandboxDelete(command.Command):
     """Deletes a sandbox with a given name."""
 
@@ -123,6 +160,7 @@ class SandboxDelete(command.Command):
         parser = super(SandboxDelete, self).get_parser(prog_name)
         conf.add_common_args(parser)
         parser.add_argument('name', help='Name of the sandbox to delete')
+        conf.add_parallel_arg(parser)
         parser.add_argument('-f', '--force', action="store_true",
                             default=False,
                             help="Force the deletion of the sandbox, ignoring "
@@ -146,7 +184,7 @@ class SandboxDelete(command.Command):
             msg = "A sandbox with name {0} does not exist.".format(sb_name)
             raise RuntimeError(msg)
 
-        sb.delete()
+        sb.delete(parallel=parsed_args.parallel)
 
         if self.app.options.verbose_level > 0:
             self.app.console_ok(newline=False)
@@ -164,8 +202,40 @@ class SandboxStart(command.Command):
         parser = super(SandboxStart, self).get_parser(prog_name)
         conf.add_common_args(parser)
         parser.add_argument('name', help='Name of the sandbox to start')
+        conf.add_parallel_arg(parser)
+        conf.add_wait_for_capacity_arg(parser)
+        parser.add_argument('--wait', action='store_true', default=False,
+                            help="Wait for every node to get an address and "
+                                 "open its SSH port, and show how long each "
+                                 "node took.")
+        parser.add_argument('--wait-timeout', type=int,
+                            default=DEFAULT_WAIT_TIMEOUT,
+                            metavar='SECONDS',
+                            help="How long to wait for the nodes with "
+                                 "--wait. Defaults to {0}.".format(
+                                     DEFAULT_WAIT_TIMEOUT))
+        parser.add_argument('--wait-for-cloud-init', action='store_true',
+                            default=False,
+                            help="With --wait, also wait for cloud-init to "
+                                 "finish in every node.")
         return parser
 
+    def _print_readiness(self, results):
+        line = "  {:<18} {:<16} {:>8} {:>8} {:>11} {:>8}\n"
+        self.app.stdout.write(line.format('Node', 'Address', 'Lease',
+                                          'SSH', 'Cloud-init', 'Ready'))
+
+        def _secs(value):
+            return '-' if value is None else '{0:.1f}s'.format(value)
+
+        for r in results:
+            self.app.stdout.write(line.format(
+                r.node.name, r.address or '-',
+                _secs(r.elapsed(readiness.CHECK_LEASE)),
+                _secs(r.elapsed(readiness.CHECK_SSH)),
+                _secs(r.elapsed(readiness.CHECK_CLOUD_INIT)),
+                _secs(r.elapsed())))
+
     def take_action(self, parsed_args):
         state_dir = helpers.ensure_state_dir(parsed_args)
 
@@ -175,13 +245,21 @@ class SandboxStart(command.Command):
             msg = "A sandbox with name {0} does not exist.".format(sb_name)
             raise RuntimeError(msg)
 
-        sb.start()
+        sb.start(parallel=parsed_args.parallel,
+                 wait_for_capacity=parsed_args.wait_for_capacity)
+        results = None
+        if parsed_args.wait:
+            results = sb.wait_ready(
+                timeout=parsed_args.wait_timeout,
+                cloud_init=parsed_args.wait_for_cloud_init)
 
         if self.app.options.verbose_level > 0:
             self.app.console_ok(newline=False)
             msg = " Started sandbox {0}\n"
             msg = msg.format(sb_name)
             self.app.stdout.write(msg)
+            if results:
+                self._print_readiness(results)
 
 
 class SandboxStop(command.Command):
@@ -193,6 +271,7 @@ class SandboxStop(command.Command):
         parser = super(SandboxStop, self).get_parser(prog_name)
         conf.add_common_args(parser)
         parser.add_argument('name', help='Name of the sandbox to stop')
+        conf.add_parallel_arg(parser)
         return parser
 
     def take_action(self, parsed_args):
@@ -204,10 +283,72 @@ class SandboxStop(command.Command):
             msg = "A sandbox with name {0} does not exist.".format(sb_name)
             raise RuntimeError(msg)
 
-        sb.stop()
+        sb.stop(parallel=parsed_args.parallel)
 
         if self.app.options.verbose_level > 0:
             self.app.console_ok(newline=False)
             msg = " Stopped sandbox {0}\n"
             msg = msg.format(sb_name)
             self.app.stdout.write(msg)
+
+
+class SandboxSuspend(command.Command):
+    """Suspends a sandbox, saving the state of its nodes to disk."""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(SandboxSuspend, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        parser.add_argument('name', help='Name of the sandbox to suspend')
+        conf.add_parallel_arg(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+
+        sb_name = parsed_args.name
+        sb = sandbox.Sandbox(parsed_args, sb_name)
+        if not sb.exists():
+            msg = "A sandbox with name {0} does not exist.".format(sb_name)
+            raise RuntimeError(msg)
+
+        sb.suspend(parallel=parsed_args.parallel)
+
+        if self.app.options.verbose_level > 0:
+            self.app.console_ok(newline=False)
+            msg = " Suspended sandbox {0}\n"
+            msg = msg.format(sb_name)
+            self.app.stdout.write(msg)
+
+
+class SandboxResume(command.Command):
+    """Resumes a suspended sandbox."""
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(SandboxResume, self).get_parser(prog_name)
+        conf.add_common_args(parser)
+        parser.add_argument('name', help='Name of the sandbox to resume')
+        conf.add_parallel_arg(parser)
+        conf.add_wait_for_capacity_arg(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        state_dir = helpers.ensure_state_dir(parsed_args)
+
+        sb_name = parsed_args.name
+        sb = sandbox.Sandbox(parsed_args, sb_name)
+        if not sb.exists():
+            msg = "A sandbox with name {0} does not exist.".format(sb_name)
+            raise RuntimeError(msg)
+
+        sb.resume(parallel=parsed_args.parallel,
+                  wait_for_capacity=parsed_args.wait_for_capacity)
+
+        if self.app.options.verbose_level > 0:
+            self.app.console_ok(newline=False)
+            msg = " Resumed sandbox {0}\n"
+            msg = msg.format(sb_name)
+            self.app.stdout.write(msg)
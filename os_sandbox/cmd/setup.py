@@ -17,11 +17,16 @@ import textwrap
 
 from cliff import command
 
+from os_sandbox import build
+from os_sandbox import catalog
 from os_sandbox import conf
 from os_sandbox import image
+from os_sandbox import imagecache
 from os_sandbox import helpers
 from os_sandbox import template
 
+DEFAULT_BUILD_TIMEOUT = 3600
+
 
 class Setup(command.Command):
     """
@@ -34,12 +39,20 @@ class Setup(command.Command):
     def get_parser(self, prog_name):
         parser = super(Setup, self).get_parser(prog_name)
         conf.add_common_args(parser)
+        parser.add_argument('--build-timeout', type=int,
+                            default=DEFAULT_BUILD_TIMEOUT,
+                            metavar='SECONDS',
+                            help="Kill a base image build that runs for "
+                                 "longer than this. 0 disables the "
+                                 "timeout.")
         return parser
 
     def take_action(self, parsed_args):
         self._ensure_paths(parsed_args)
         self._ensure_base_images(parsed_args)
         self._ensure_starter_templates(parsed_args)
+        self._rebuild_catalog(parsed_args)
+        self._evict_image_cache(parsed_args)
 
     def _ensure_paths(self, parsed_args):
         state_dir = parsed_args.state_dir
@@ -88,7 +101,7 @@ class Setup(command.Command):
             helpers.create_writeable_dir(state_dir)
             self.app.console_ok()
 
-        for d in ('sandboxes', 'templates', 'images'):
+        for d in ('sandboxes', 'templates', 'images', 'pools'):
             dir_path = os.path.join(state_dir, d)
             msg = "Checking {0} dir {1} exists ... "
             msg = msg.format(d, dir_path)
@@ -107,25 +120,78 @@ class Setup(command.Command):
     def _ensure_base_images(self, parsed_args):
         state_dir = parsed_args.state_dir
 
-        msg = "Checking base images exist ... "
-        self.app.console_wrapped(msg)
-
         for img_name in ('ubuntu',):
             img = image.Image(parsed_args, img_name)
-            if img.exists():
+            key = img.get_build_key()
+
+            msg = "Checking base {0} image is up to date ... "
+            msg = msg.format(img_name)
+            self.app.console_wrapped(msg)
+            if img.build_key == key:
+                self.app.console_yes()
+                continue
+            self.app.console_no()
+
+            if img.exists() and img.build_key is None:
+                # Built before builds were cached. Replacing it would change
+                # what the overlays of nodes created from it are backed by.
+                in_use = imagecache.get_images_in_use(state_dir)
+                if os.path.abspath(img.image_path) in in_use:
+                    msg = ("Base {0} image is out of date but is used by "
+                           "existing nodes. Delete their sandboxes and run "
+                           "`os-sandbox setup` again to rebuild it.")
+                    msg = msg.format(img_name)
+                    self.log.warning(msg)
+                    continue
+
+            msg = "Checking image cache for base {0} image build {1} ... "
+            msg = msg.format(img_name, key[:12])
+            self.app.console_wrapped(msg)
+            if img.use_build(key):
                 self.app.console_yes()
+                cat = catalog.get_catalog(state_dir)
+                cat.add_image(img.name, img.image_path, img.file_format)
+                continue
+            self.app.console_no()
+
+            msg = "Creating base {0} image (this can take some time) ... "
+            msg = msg.format(img_name)
+            self.app.console_wrapped(msg, newline=True)
+            result = img.create(progress=self._build_progress,
+                                timeout=parsed_args.build_timeout or None)
+
+            msg = "Finished building base {0} image in {1:.0f}s ... "
+            msg = msg.format(img_name, result.elapsed)
+            self.app.console_wrapped(msg)
+            if result.succeeded:
+                cat = catalog.get_catalog(state_dir)
+                cat.add_image(img.name, img.image_path, img.file_format)
+                self.app.console_ok()
+                self._print_build_timings(result)
             else:
-                self.app.console_no()
+                self.app.console_fail()
+                msg = ("disk-image-create exited with {0}. Last lines of "
+                       "the build log {1}:\n{2}")
+                msg = msg.format(result.returncode, result.log_path,
+                                 '\n'.join(result.tail))
+                raise RuntimeError(msg)
 
-                msg = "Creating base {0} image (this can take some time) ... "
-                msg = msg.format(img_name)
-                self.app.console_wrapped(msg)
-                retcode, out, err = img.create()
-                if retcode == 0:
-                    self.app.console_ok()
-                else:
-                    self.app.console_fail(self.app)
-                    raise RuntimeError(err)
+    def _build_progress(self, event, name):
+        if event == build.EVENT_PHASE:
+            msg = "  Running {0} phase ... ".format(name)
+            self.app.console_wrapped(msg, newline=True)
+        else:
+            self.log.debug("Running %s", name)
+
+    def _print_build_timings(self, result):
+        for phase, seconds in result.phases:
+            msg = "  {0:<20} {1:>8.1f}s".format(phase, seconds)
+            self.app.console_wrapped(msg, newline=True)
+        msg = "  Slowest hook scripts:"
+        self.app.console_wrapped(msg, newline=True)
+        for script, seconds in result.slowest_scripts():
+            msg = "    {0:<40} {1:>8.1f}s".format(script, seconds)
+            self.app.console_wrapped(msg, newline=True)
 
     def _ensure_starter_templates(self, parsed_args):
         state_dir = parsed_args.state_dir
@@ -181,6 +247,9 @@ class Setup(command.Command):
                         'services': [
                             'compute',
                         ],
+                        'start_after': [
+                            'controller',
+                        ],
 
                     },
                     {
@@ -194,6 +263,9 @@ class Setup(command.Command):
                         'services': [
                             'compute',
                         ],
+                        'start_after': [
+                            'controller',
+                        ],
 
                     },
                 ],
@@ -218,3 +290,28 @@ class Setup(command.Command):
                 tpl.create(**tpl_conf)
 
                 self.app.console_ok()
+
+    def _rebuild_catalog(self, parsed_args):
+        state_dir = parsed_args.state_dir
+
+        msg = "Rebuilding state catalog from state dir {0} ... "
+        msg = msg.format(state_dir)
+        self.app.console_wrapped(msg)
+
+        catalog.get_catalog(state_dir).rebuild()
+        self.app.console_ok()
+
+    def _evict_image_cache(self, parsed_args):
+        state_dir = parsed_args.state_dir
+        budget_gb = conf.get_host_config(state_dir)['image_cache']['budget_gb']
+
+        msg = "Evicting unused image builds beyond {0} GB budget ... "
+        msg = msg.format(budget_gb)
+        self.app.console_wrapped(msg)
+
+        cache = imagecache.ImageCache(state_dir)
+        in_use = imagecache.get_images_in_use(state_dir)
+        evicted = cache.evict(budget_gb * 1024 * 1024 * 1024, in_use)
+        for key in evicted:
+            self.log.info("Evicted image build %s", key)
+        self.app.console_ok()
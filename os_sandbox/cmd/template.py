@@ -12,14 +12,15 @@
 
 import logging
 import os
-import yaml
 
 from cliff import command
 from cliff import lister
-import slugify
 
+from os_sandbox import catalog
 from os_sandbox import conf
+from os_sandbox import devices
 from os_sandbox import helpers
+from os_sandbox import network
 from os_sandbox import template
 
 
@@ -34,13 +35,12 @@ class TemplateList(lister.Lister):
         return parser
 
     def take_action(self, parsed_args):
-        templates = []
         state_dir = helpers.ensure_state_dir(parsed_args)
-        template_dir = os.path.join(state_dir, 'templates')
-        for entry in os.listdir(template_dir):
-            tpl_entry = os.path.join(template_dir, entry)
-            if os.path.isdir(tpl_entry):
-                templates.append(template.Template(parsed_args, entry))
+        cat = catalog.get_catalog(state_dir)
+        templates = [
+            template.Template(parsed_args, slug)
+            for slug in sorted(cat.get_templates())
+        ]
         return (
             ('Name', 'Description', '# Nodes'),
             ((tpl.name, tpl.description, len(tpl.nodes))
@@ -70,9 +70,25 @@ class TemplateShow(command.Command):
             
         self.app.stdout.write('Name: ' + tpl.name + '\n')
         self.app.stdout.write('Description: ' + tpl.description + '\n')
+        self.app.stdout.write('Device profile: ' + tpl.device_profile + '\n')
+        if tpl.disk_settings:
+            self.app.stdout.write('Disk: ' + devices.describe_disk_settings(
+                tpl.disk_settings) + '\n')
         self.app.stdout.write('Networks:\n')
-        for net_name, net_info in tpl.networks.items():
-            self.app.stdout.write('  ' + net_name + ' (' + net_info['cidr'] + ')\n')
+        pools = conf.get_network_pools(state_dir)
+        for net_name in sorted(pools):
+            line = '  ' + net_name + ' (/' + str(pools[net_name]['prefixlen'])
+            settings = network.describe_settings(
+                tpl.networks.get(net_name) or {})
+            if settings:
+                line += ', ' + settings
+            self.app.stdout.write(line + ')\n')
         self.app.stdout.write('Nodes:\n')
         for node in tpl.nodes:
             self.app.stdout.write('  ' + node['name'] + ' (' + ','.join(node['services']) + ')\n')
+            if 'device_profile' in node:
+                self.app.stdout.write('    Device profile: ' + node['device_profile'] + '\n')
+            if node.get('disk'):
+                self.app.stdout.write('    Disk: ' +
+                                      devices.describe_disk_settings(
+                                          node['disk']) + '\n')
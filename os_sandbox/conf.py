@@ -10,11 +10,68 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import copy
 import os
 
+from os_sandbox import helpers
+
+yaml = helpers.lazy_import('yaml')
+
 DEFAULT_LOG_FORMAT = "[%(levelname)7s] %(message)s"
 DEFAULT_ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_STATE_DIR = '/opt/os-sandbox'
+DEFAULT_PARALLEL = 4
+
+# Optional host-wide settings, read from this file in the state dir. Any
+# setting missing from it takes its value from HOST_CONFIG_DEFAULTS.
+HOST_CONFIG_FILENAME = 'os-sandbox.yaml'
+HOST_CONFIG_DEFAULTS = {
+    # Each sandbox gets one subnet of `prefixlen` from the `supernet` of
+    # each of these networks.
+    'networks': {
+        'mgmt': {'supernet': '10.10.0.0/16', 'prefixlen': 28},
+        'private': {'supernet': '10.20.0.0/16', 'prefixlen': 28},
+        'public': {'supernet': '10.30.0.0/16', 'prefixlen': 28},
+    },
+    # Least recently used image builds are evicted from the image cache
+    # when it grows beyond this many GB.
+    'image_cache': {
+        'budget_gb': 20,
+    },
+    # Host CPUs given exclusively to the vCPUs of nodes with the dedicated
+    # cpu_policy, and host CPUs the vCPUs of all other nodes float over. The
+    # shared pool defaults to every CPU not in the dedicated pool, and may be
+    # overcommitted up to overcommit_ratio vCPUs per host CPU.
+    'cpus': {
+        'dedicated': '',
+        'shared': '',
+        'overcommit_ratio': 4.0,
+    },
+    # Sandboxes are only created or started if their nodes fit within the
+    # host's memory and disk times these ratios. reserved_ram_mb is kept
+    # free for the host itself. vCPUs are limited by the `cpus` pools.
+    'capacity': {
+        'ram_overcommit_ratio': 1.0,
+        'disk_overcommit_ratio': 1.0,
+        'reserved_ram_mb': 2048,
+    },
+    # Compression of the guest memory saved by `sandbox suspend`, used when
+    # libvirt supports choosing it per save. Otherwise the save_image_format
+    # setting in libvirt's qemu.conf applies.
+    'suspend': {
+        'image_format': 'zstd',
+    },
+    # Number of sandboxes of each template, keyed by template name, that are
+    # kept created, booted and paused, ready for `sandbox checkout`. A pooled
+    # sandbox is paused once its nodes have booted, and deleted if they have
+    # not within boot_seconds.
+    'warm_pool': {
+        'sizes': {},
+        'boot_seconds': 300,
+    },
+}
+
+_HOST_CONFIGS = {}
 
 
 def add_common_args(parser):
@@ -22,3 +79,59 @@ def add_common_args(parser):
                         default=os.environ.get('OS_SANDBOX_STATE_DIR',
                                                DEFAULT_STATE_DIR),
                         help="The location where sandbox state is stored.")
+    parser.add_argument('--libvirt-uri',
+                        default=os.environ.get('OS_SANDBOX_LIBVIRT_URI'),
+                        help="The libvirt connection URI to use. Defaults "
+                             "to libvirt's default URI.")
+
+
+def add_parallel_arg(parser):
+    parser.add_argument('--parallel', type=int,
+                        default=DEFAULT_PARALLEL,
+                        metavar='N',
+                        help="Maximum number of nodes to act on "
+                             "concurrently.")
+
+
+def add_wait_for_capacity_arg(parser):
+    parser.add_argument('--wait-for-capacity', type=int,
+                        default=None,
+                        metavar='SECONDS',
+                        help="If the host lacks the capacity for the "
+                             "sandbox, wait up to this long for it to "
+                             "become available instead of failing.")
+
+
+def get_host_config(state_dir):
+    """Returns the host-wide settings for the supplied state dir, merged over
+    HOST_CONFIG_DEFAULTS.
+
+    :raises RuntimeError if the host config file cannot be parsed.
+    """
+    if state_dir in _HOST_CONFIGS:
+        return _HOST_CONFIGS[state_dir]
+
+    host_conf = copy.deepcopy(HOST_CONFIG_DEFAULTS)
+    conf_path = os.path.join(state_dir, HOST_CONFIG_FILENAME)
+    if os.path.exists(conf_path):
+        try:
+            overrides = yaml.safe_load(open(conf_path, 'rb').read()) or {}
+        except yaml.YAMLError as err:
+            msg = "Failed to parse host config {0}: {1}"
+            raise RuntimeError(msg.format(conf_path, err))
+        for key, value in overrides.items():
+            if isinstance(value, dict) and isinstance(host_conf.get(key),
+                                                      dict):
+                host_conf[key].update(value)
+            else:
+                host_conf[key] = value
+
+    _HOST_CONFIGS[state_dir] = host_conf
+    return host_conf
+
+
+def get_network_pools(state_dir):
+    """Returns a dict, keyed by network name, of the supernet and subnet
+    prefix length each sandbox network is allocated from.
+    """
+    return get_host_config(state_dir)['networks']
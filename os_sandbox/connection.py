@@ -0,0 +1,154 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+
+from os_sandbox import helpers
+
+libvirt = helpers.lazy_import('libvirt')
+
+LOG = logging.getLogger(__name__)
+
+
+def libvirt_callback(ignore, err):
+    if err[3] != libvirt.VIR_ERR_ERROR:
+          # Don't log libvirt errors: global error handler will do that
+          logging.warn("Non-error from libvirt: '%s'" % err[2])
+
+
+_EVENT_LOOP_LOCK = threading.Lock()
+_event_loop_thread = None
+
+
+def _run_event_loop():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except Exception as err:
+            LOG.error("Error in libvirt event loop: %s", err)
+
+
+def register_event_loop():
+    """Registers libvirt's default event loop implementation and runs it in
+    a daemon thread. Connections only deliver events, see os_sandbox.events,
+    if the event loop was registered before they were opened, so use
+    open_event_connection() for them.
+    """
+    global _event_loop_thread
+    with _EVENT_LOOP_LOCK:
+        if _event_loop_thread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_thread = threading.Thread(target=_run_event_loop,
+                                              name='libvirt-events')
+        _event_loop_thread.daemon = True
+        _event_loop_thread.start()
+
+
+class ConnectionPool(object):
+    """Caches libvirt connections, keyed by URI and access mode, so that a
+    single CLI invocation performs at most one libvirtd handshake per URI and
+    mode.
+    """
+
+    def __init__(self):
+        self._conns = {}
+        self._lock = threading.Lock()
+        self._handler_registered = False
+
+    def get(self, uri=None, readonly=True):
+        """Returns a live libvirt connection for the supplied URI.
+
+        A read-write connection to the URI is handed out for read-only
+        requests if one is already open, since it can do everything a
+        read-only connection can.
+
+        :param uri: libvirt connection URI. None means the default URI.
+        :param readonly: Whether a read-only connection is sufficient.
+        :raises RuntimeError if a connection could not be established.
+        """
+        with self._lock:
+            modes = (True, False) if readonly else (False,)
+            for mode in reversed(modes):
+                conn = self._conns.get((uri, mode))
+                if conn is None:
+                    continue
+                if self._is_alive(conn):
+                    return conn
+                LOG.debug("Dropping stale libvirt connection to %s.", uri)
+                self._close(uri, mode)
+
+            conn = self._open(uri, readonly)
+            self._conns[(uri, readonly)] = conn
+            return conn
+
+    def _open(self, uri, readonly):
+        if not self._handler_registered:
+            libvirt.registerErrorHandler(f=libvirt_callback, ctx=None)
+            self._handler_registered = True
+        if readonly:
+            conn = libvirt.openReadOnly(uri)
+        else:
+            conn = libvirt.open(uri)
+        if conn == None:
+            msg = "Failed to connect to QEMU."
+            raise RuntimeError(msg)
+        return conn
+
+    def _is_alive(self, conn):
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def _close(self, uri, readonly):
+        conn = self._conns.pop((uri, readonly), None)
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except libvirt.libvirtError as err:
+            LOG.debug("Error closing libvirt connection to %s: %s", uri, err)
+
+    def close_all(self):
+        """Closes every connection in the pool."""
+        with self._lock:
+            for uri, readonly in list(self._conns.keys()):
+                self._close(uri, readonly)
+
+
+_POOL = ConnectionPool()
+
+
+def get_connection(uri=None, readonly=True):
+    """Returns a pooled libvirt connection. See ConnectionPool.get()."""
+    return _POOL.get(uri, readonly)
+
+
+def open_event_connection(uri=None):
+    """Opens a read-only libvirt connection that delivers events, starting
+    the event loop first if need be. Pooled connections do not, so that
+    commands which never wait for events do not run the event loop. The
+    connection is not pooled and is closed by the caller.
+
+    :param uri: libvirt connection URI. None means the default URI.
+    :raises RuntimeError if a connection could not be established.
+    """
+    register_event_loop()
+    with _POOL._lock:
+        return _POOL._open(uri, True)
+
+
+def close_all():
+    """Closes all pooled libvirt connections."""
+    _POOL.close_all()
@@ -0,0 +1,257 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import logging
+import time
+
+LOG = logging.getLogger(__name__)
+
+POLICY_SHARED = 'shared'
+POLICY_DEDICATED = 'dedicated'
+POLICIES = (POLICY_SHARED, POLICY_DEDICATED)
+DEFAULT_POLICY = POLICY_SHARED
+
+# Allocations are made before their domains are started, so an allocation
+# is only reclaimed when its domain no longer exists, or is shut off, and it
+# is older than this, which leaves time for another process to start the
+# domain. Paused domains keep their CPUs.
+STALE_AFTER_SECONDS = 300
+
+# Table in the state catalog (see os_sandbox.catalog) holding the host CPUs
+# assigned to each running node's domain. Unlike the tables derived from the
+# YAML files, it survives catalog rebuilds.
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS cpu_pins (
+        domain_name TEXT PRIMARY KEY,
+        sandbox TEXT NOT NULL,
+        policy TEXT NOT NULL,
+        vcpus INTEGER NOT NULL,
+        cpus TEXT NOT NULL,
+        allocated_at REAL NOT NULL
+    )""",
+)
+
+
+def parse_cpuset(text):
+    """Returns the sorted list of CPU IDs in a cpuset string like '0-3,8'.
+
+    :raises RuntimeError if the string cannot be parsed.
+    """
+    cpus = set()
+    for part in str(text).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                first, last = part.split('-', 1)
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(part))
+        except ValueError:
+            msg = "Invalid cpuset {0}. Use e.g. 0-3,8.".format(text)
+            raise RuntimeError(msg)
+    return sorted(cpus)
+
+
+class CpuPins(object):
+    """The host CPUs a node's domain runs on.
+
+    For the dedicated policy, `cpus` holds one host CPU per vCPU, which no
+    other node uses. For the shared policy, every vCPU floats over all of
+    `cpus`. The QEMU emulator threads always run on `emulator_cpus`.
+    """
+
+    def __init__(self, policy, vcpus, cpus, emulator_cpus):
+        self.policy = policy
+        self.vcpus = vcpus
+        self.cpus = cpus
+        self.emulator_cpus = emulator_cpus
+
+    def vcpu_cpus(self, vcpu):
+        """Returns the host CPUs the supplied vCPU may run on."""
+        if self.policy == POLICY_DEDICATED:
+            return [self.cpus[vcpu]]
+        return self.cpus
+
+
+class CpuAllocator(object):
+    """Assigns host CPUs to nodes from two pools set in the host config: a
+    dedicated pool, whose CPUs are each given to a single vCPU of a single
+    node, and a shared pool, over which the vCPUs of all other nodes float.
+
+    The shared pool is overcommitted up to a configurable ratio of vCPUs to
+    host CPUs. Allocations are kept in the state catalog until released, and
+    allocations of domains that are no longer running are reclaimed.
+    """
+
+    def __init__(self, cat, host_cpus, cpu_conf, numa_cells=None):
+        """
+        :param cat: The state catalog.
+        :param host_cpus: IDs of all of the host's CPUs.
+        :param cpu_conf: The `cpus` section of the host config, with the
+                         'dedicated' and 'shared' cpusets and the shared
+                         pool's 'overcommit_ratio'. The shared pool defaults
+                         to every host CPU not in the dedicated pool.
+        :param numa_cells: Optional dict of host CPU IDs keyed by host NUMA
+                           cell ID, used to keep a node's CPUs on its
+                           numa_node and to avoid spreading dedicated CPUs
+                           across cells.
+        """
+        self.catalog = cat
+        host_cpus = set(host_cpus)
+        self.dedicated = [c for c in parse_cpuset(cpu_conf.get('dedicated')
+                                                  or '')
+                          if c in host_cpus]
+        if cpu_conf.get('shared'):
+            self.shared = [c for c in parse_cpuset(cpu_conf['shared'])
+                           if c in host_cpus]
+        else:
+            self.shared = sorted(host_cpus - set(self.dedicated))
+        overlap = set(self.dedicated) & set(self.shared)
+        if overlap:
+            msg = "Host CPUs {0} are in both the dedicated and shared pools."
+            msg = msg.format(','.join(str(c) for c in sorted(overlap)))
+            raise RuntimeError(msg)
+        self.overcommit_ratio = float(cpu_conf.get('overcommit_ratio', 1.0))
+        self.numa_cells = numa_cells or {}
+
+    def _reclaim(self, conn, is_active):
+        rows = conn.execute("SELECT domain_name FROM cpu_pins "
+                            "WHERE allocated_at < ?",
+                            (time.time() - STALE_AFTER_SECONDS,)).fetchall()
+        for (domain_name,) in rows:
+            if not is_active(domain_name):
+                LOG.debug("Reclaiming CPUs of domain %s, which no longer "
+                          "exists.", domain_name)
+                conn.execute("DELETE FROM cpu_pins WHERE domain_name = ?",
+                             (domain_name,))
+
+    def _cell_cpus(self, numa_node):
+        if numa_node is None:
+            return None
+        return set(self.numa_cells.get(numa_node, ()))
+
+    def _pick_dedicated(self, free, vcpus, numa_node):
+        """Returns vcpus free dedicated CPUs, all from the node's NUMA cell
+        if it has one, and otherwise from a single cell if any has enough.
+        """
+        cell_cpus = self._cell_cpus(numa_node)
+        if cell_cpus is not None:
+            candidates = [c for c in free if c in cell_cpus]
+            return candidates[:vcpus] if len(candidates) >= vcpus else None
+        for cell_id in sorted(self.numa_cells):
+            candidates = [c for c in free if c in self.numa_cells[cell_id]]
+            if len(candidates) >= vcpus:
+                return candidates[:vcpus]
+        return free[:vcpus] if len(free) >= vcpus else None
+
+    def _shared_cpus(self, numa_node):
+        cell_cpus = self._cell_cpus(numa_node)
+        if cell_cpus is None:
+            return list(self.shared)
+        return [c for c in self.shared if c in cell_cpus] or list(self.shared)
+
+    def allocate(self, sandbox, nodes, is_active):
+        """Assigns host CPUs to each of the supplied nodes that has none yet.
+
+        :param sandbox: Slug of the sandbox the nodes belong to.
+        :param nodes: List of (domain_name, policy, vcpus, numa_node)
+                      tuples.
+        :param is_active: Callable returning whether the named domain
+                          exists and is not shut off, used to reclaim stale
+                          allocations.
+        :raises RuntimeError if the pools cannot fit the nodes, in which
+                case nothing is allocated.
+        :returns dict of CpuPins keyed by domain name.
+        """
+        emulator_cpus = list(self.shared) or list(self.dedicated)
+        with self.catalog.transaction() as conn:
+            self._reclaim(conn, is_active)
+            rows = conn.execute("SELECT domain_name, policy, vcpus, cpus "
+                                "FROM cpu_pins").fetchall()
+            existing = dict((r[0], r[1:]) for r in rows)
+            used = set()
+            shared_vcpus = 0
+            for policy, vcpus, cpus in existing.values():
+                if policy == POLICY_DEDICATED:
+                    used.update(json.loads(cpus))
+                else:
+                    shared_vcpus += vcpus
+
+            pins = {}
+            for domain_name, policy, vcpus, numa_node in nodes:
+                if domain_name in existing:
+                    policy, vcpus, cpus = existing[domain_name]
+                    pins[domain_name] = CpuPins(policy, vcpus,
+                                                json.loads(cpus),
+                                                emulator_cpus)
+                    continue
+
+                if policy == POLICY_DEDICATED:
+                    free = [c for c in self.dedicated if c not in used]
+                    cpus = self._pick_dedicated(free, vcpus, numa_node)
+                    if cpus is None:
+                        msg = ("Cannot give domain {0} {1} dedicated host "
+                               "CPUs: only {2} of the {3} dedicated CPUs "
+                               "are free{4}.")
+                        where = ''
+                        if numa_node is not None:
+                            where = ' on NUMA node {0}'.format(numa_node)
+                        msg = msg.format(domain_name, vcpus, len(free),
+                                         len(self.dedicated), where)
+                        raise RuntimeError(msg)
+                    used.update(cpus)
+                else:
+                    limit = len(self.shared) * self.overcommit_ratio
+                    if shared_vcpus + vcpus > limit:
+                        msg = ("Cannot fit the {0} vCPUs of domain {1} in "
+                               "the shared CPU pool: {2} of {3:g} vCPUs "
+                               "({4} host CPUs at an overcommit ratio of "
+                               "{5:g}) are in use.")
+                        msg = msg.format(vcpus, domain_name, shared_vcpus,
+                                         limit, len(self.shared),
+                                         self.overcommit_ratio)
+                        raise RuntimeError(msg)
+                    shared_vcpus += vcpus
+                    cpus = self._shared_cpus(numa_node)
+
+                conn.execute("INSERT INTO cpu_pins "
+                             "(domain_name, sandbox, policy, vcpus, cpus, "
+                             "allocated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                             (domain_name, sandbox, policy, vcpus,
+                              json.dumps(cpus), time.time()))
+                pins[domain_name] = CpuPins(policy, vcpus, cpus,
+                                            emulator_cpus)
+            return pins
+
+
+def release(cat, domain_names):
+    """Returns the host CPUs of the named domains to the pools.
+
+    :param cat: The state catalog.
+    """
+    with cat.transaction() as conn:
+        conn.executemany("DELETE FROM cpu_pins WHERE domain_name = ?",
+                         [(name,) for name in domain_names])
+
+
+def rename_sandbox(cat, old_slug, new_slug):
+    """Records that the domains allocated CPUs for a sandbox now belong to
+    the sandbox under its new slug.
+
+    :param cat: The state catalog.
+    """
+    with cat.transaction() as conn:
+        conn.execute("UPDATE cpu_pins SET sandbox = ? WHERE sandbox = ?",
+                     (new_slug, old_slug))
@@ -0,0 +1,285 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import six
+
+# Device profiles select the virtual hardware a node's domain is given. The
+# virtio profiles use paravirtualized disks and NICs, which perform far better
+# than emulated hardware. The legacy profile emulates an IDE disk and an e1000
+# NIC, for guests without virtio drivers.
+PROFILE_VIRTIO = 'virtio'
+PROFILE_VIRTIO_SCSI = 'virtio-scsi'
+PROFILE_LEGACY = 'legacy'
+
+DEFAULT_PROFILE = PROFILE_VIRTIO
+
+PROFILES = {
+    # virtio-blk disks and vhost-net accelerated virtio NICs.
+    PROFILE_VIRTIO: {
+        'disk_bus': 'virtio',
+        'disk_dev': 'vda',
+        # Disks are named vda to vdz.
+        'max_disks': 26,
+        'disk_driver': {'cache': 'none', 'io': 'native'},
+        'iothreads': True,
+        'nic_model': 'virtio',
+        'vhost': True,
+        'paravirt': True,
+    },
+    # As above, but disks are attached to a virtio-scsi controller, which
+    # supports more disks per guest and passes discard requests through.
+    PROFILE_VIRTIO_SCSI: {
+        'disk_bus': 'scsi',
+        'disk_dev': 'sda',
+        'max_disks': 26,
+        'disk_driver': {'cache': 'none', 'io': 'native'},
+        'iothreads': True,
+        'nic_model': 'virtio',
+        'vhost': True,
+        'paravirt': True,
+    },
+    # Emulated devices, as nodes had before device profiles existed.
+    PROFILE_LEGACY: {
+        'disk_bus': 'ide',
+        'disk_dev': 'hda',
+        # The IDE bus takes two devices on each of its two channels.
+        'max_disks': 4,
+        'disk_driver': {},
+        'iothreads': False,
+        'nic_model': 'e1000',
+        'vhost': False,
+        'paravirt': False,
+    },
+}
+
+ARCH = 'x86_64'
+
+# Limits of a direction of a network's or NIC's traffic: average and peak
+# rates in KiB/s, and the KiB that may be sent at peak rate.
+BANDWIDTH_KEYS = ('average', 'peak', 'burst')
+
+# Settings a template, or a node in it, may give its nodes' disks, with the
+# values each may take. They override the device profile's disk_driver.
+# iothreads is the number of I/O threads of the node's domain, which serve
+# its disks instead of QEMU's main loop, for profiles that support them.
+DISK_SETTINGS = {
+    'cache': ('none', 'writethrough', 'writeback', 'directsync', 'unsafe'),
+    'io': ('native', 'threads', 'io_uring'),
+    'discard': ('unmap', 'ignore'),
+    'detect_zeroes': ('off', 'on', 'unmap'),
+    'iothreads': None,
+}
+# io='native' opens the disk with O_DIRECT, so it needs one of these caches.
+DIRECT_CACHE_MODES = ('none', 'directsync')
+
+
+def check_profile(name):
+    """
+    :raises RuntimeError if there is no device profile with the supplied
+            name.
+    """
+    if name not in PROFILES:
+        msg = "Unknown device profile {0}. Valid profiles are: {1}."
+        msg = msg.format(name, ', '.join(sorted(PROFILES)))
+        raise RuntimeError(msg)
+
+
+def check_disk_settings(owner, settings):
+    """
+    :param owner: Description of what has the settings, for error messages,
+                  e.g. "node controller".
+    :raises RuntimeError if the disk settings are not valid. See
+            DISK_SETTINGS.
+    """
+    if not isinstance(settings, dict):
+        msg = "Disk settings for {0} must be a mapping.".format(owner)
+        raise RuntimeError(msg)
+    for key, value in settings.items():
+        if key not in DISK_SETTINGS:
+            msg = "Unknown disk setting {0} for {1}. Valid settings are: {2}."
+            raise RuntimeError(msg.format(key, owner,
+                                          ', '.join(sorted(DISK_SETTINGS))))
+        if key == 'iothreads':
+            if (not isinstance(value, six.integer_types) or
+                    isinstance(value, bool) or value < 0):
+                msg = "Disk setting iothreads for {0} must be an integer of "
+                msg += "0 or more."
+                raise RuntimeError(msg.format(owner))
+        elif value not in DISK_SETTINGS[key]:
+            msg = "Invalid disk {0} {1} for {2}. Valid values are: {3}."
+            raise RuntimeError(msg.format(key, value, owner,
+                                          ', '.join(DISK_SETTINGS[key])))
+    if (settings.get('io') == 'native' and 'cache' in settings and
+            settings['cache'] not in DIRECT_CACHE_MODES):
+        msg = "Disk io native for {0} needs a cache of {1}, not {2}."
+        raise RuntimeError(msg.format(owner, ' or '.join(DIRECT_CACHE_MODES),
+                                      settings['cache']))
+    if (settings.get('detect_zeroes') == 'unmap' and
+            settings.get('discard') != 'unmap'):
+        msg = "Disk detect_zeroes unmap for {0} needs discard unmap."
+        raise RuntimeError(msg.format(owner))
+
+
+def describe_disk_settings(settings):
+    """Returns a short description of disk settings, such as
+    "cache writeback, io threads, iothreads 2".
+    """
+    return ', '.join("{0} {1}".format(key, settings[key])
+                     for key in ('cache', 'io', 'iothreads', 'discard',
+                                 'detect_zeroes')
+                     if key in settings)
+
+
+def get_disk_driver(profile, settings=None):
+    """Returns the attributes of a disk's driver: the device profile's
+    disk_driver overridden by the supplied disk settings.
+
+    A profile's io='native' falls back to io='threads' when the settings
+    select a cache it cannot be used with and do not set io themselves.
+    """
+    settings = settings or {}
+    driver = dict(PROFILES[profile]['disk_driver'])
+    driver.update((k, v) for k, v in settings.items() if k != 'iothreads')
+    if ('io' not in settings and driver.get('io') == 'native' and
+            driver.get('cache') not in DIRECT_CACHE_MODES):
+        driver['io'] = 'threads'
+    return driver
+
+
+def get_iothreads(profile, settings=None):
+    """Returns the number of I/O threads a node with the supplied disk
+    settings is given, which is 0 for profiles that do not support them.
+    """
+    if not PROFILES[profile]['iothreads']:
+        return 0
+    return (settings or {}).get('iothreads', 0)
+
+
+def get_controller_xml(profile, iothread=None):
+    """Returns the XML for the controller the node's disks are attached to,
+    or an empty string if the bus does not need one.
+
+    :param iothread: Optional number of the I/O thread serving the
+                     controller's disks.
+    """
+    if PROFILES[profile]['disk_bus'] != 'scsi':
+        return ''
+    driver = ''
+    if iothread:
+        driver = "<driver iothread='{0}'/>".format(iothread)
+    return """
+<controller type='scsi' index='0' model='virtio-scsi'>
+    {driver}
+</controller>
+""".format(driver=driver)
+
+
+def get_disk_xml(profile, disk_path, index=0, settings=None, iothread=None):
+    """Returns the XML for one of the node's disks.
+
+    :param index: Position of the disk among the node's disks. The first
+                  one is the boot disk.
+    :param settings: Optional disk settings. See get_disk_driver().
+    :param iothread: Optional number of the I/O thread serving the disk, for
+                     disks not attached to a controller.
+    """
+    p = PROFILES[profile]
+    driver = get_disk_driver(profile, settings)
+    driver_attrs = ''.join(" {0}='{1}'".format(k, driver[k])
+                           for k in ('cache', 'io', 'discard',
+                                     'detect_zeroes')
+                           if k in driver)
+    if iothread and p['disk_bus'] == 'virtio':
+        driver_attrs += " iothread='{0}'".format(iothread)
+    # Disks are named in order after the profile's first disk, e.g. vda,
+    # vdb, vdc.
+    dev = p['disk_dev'][:-1] + chr(ord(p['disk_dev'][-1]) + index)
+    return """
+<disk type='file' device='disk'>
+    <driver name='qemu' type='qcow2'{driver_attrs}/>
+    <source file='{disk_path}'/>
+    <target dev='{dev}' bus='{bus}'/>
+</disk>
+""".format(driver_attrs=driver_attrs, disk_path=disk_path, dev=dev,
+           bus=p['disk_bus'])
+
+
+def get_bandwidth_xml(bandwidth):
+    """Returns the XML limiting the traffic of a network or NIC, or an empty
+    string if bandwidth is empty.
+
+    :param bandwidth: Dict with optional 'inbound' and 'outbound' dicts of
+                      'average' and 'peak' rates in KiB/s and 'burst' sizes
+                      in KiB.
+    """
+    if not bandwidth:
+        return ''
+    directions = []
+    for direction in ('inbound', 'outbound'):
+        limits = bandwidth.get(direction)
+        if not limits:
+            continue
+        attrs = ''.join(" {0}='{1}'".format(k, limits[k])
+                        for k in BANDWIDTH_KEYS if k in limits)
+        directions.append("<{0}{1}/>".format(direction, attrs))
+    return "<bandwidth>{0}</bandwidth>".format(''.join(directions))
+
+
+def get_interface_xml(profile, network, mac_address=None, mtu=None,
+                      queues=None, bandwidth=None):
+    """Returns the XML for a NIC attached to the named libvirt network.
+
+    :param mac_address: Optional MAC address for the NIC. libvirt generates
+                        a random one if it is not set.
+    :param mtu: Optional MTU of the NIC.
+    :param queues: Optional number of queue pairs of the NIC, for profiles
+                   with vhost-net accelerated NICs.
+    :param bandwidth: Optional limits of the NIC's traffic. See
+                      get_bandwidth_xml().
+    """
+    p = PROFILES[profile]
+    driver = ''
+    if p['vhost']:
+        queues_attr = ''
+        if queues and queues > 1:
+            queues_attr = " queues='{0}'".format(queues)
+        driver = "<driver name='vhost'{0}/>".format(queues_attr)
+    mac = "<mac address='{0}'/>".format(mac_address) if mac_address else ''
+    mtu = "<mtu size='{0}'/>".format(mtu) if mtu else ''
+    return """
+<interface type='network'>
+    {mac}
+    <source network='{network}'/>
+    <model type='{model}'/>
+    {driver}
+    {mtu}
+    {bandwidth}
+</interface>
+""".format(network=network, mac=mac, model=p['nic_model'], driver=driver,
+           mtu=mtu, bandwidth=get_bandwidth_xml(bandwidth))
+
+
+def get_misc_xml(profile):
+    """Returns the XML for the profile's other devices: a virtio RNG, so
+    guests do not stall at boot waiting for entropy, and a memory balloon
+    reporting guest memory statistics.
+    """
+    if not PROFILES[profile]['paravirt']:
+        return ''
+    return """
+<rng model='virtio'>
+    <backend model='random'>/dev/urandom</backend>
+</rng>
+<memballoon model='virtio'>
+    <stats period='10'/>
+</memballoon>
+"""
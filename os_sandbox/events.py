@@ -0,0 +1,243 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+import time
+
+from os_sandbox import connection
+from os_sandbox import helpers
+from os_sandbox import states
+
+libvirt = helpers.lazy_import('libvirt')
+
+LOG = logging.getLogger(__name__)
+
+# Built on first use, so that libvirt is only imported when needed.
+_lifecycle_state_map = None
+
+
+def get_lifecycle_state_map():
+    """Returns a dict mapping libvirt domain lifecycle event types to the
+    domain state code the domain is in after the event. Domains are removed
+    from the cache when they are undefined, so that event is not mapped.
+    """
+    global _lifecycle_state_map
+    if _lifecycle_state_map is None:
+        _lifecycle_state_map = {
+            libvirt.VIR_DOMAIN_EVENT_DEFINED: libvirt.VIR_DOMAIN_SHUTOFF,
+            libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+            libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+            libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+            libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+            libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED:
+                libvirt.VIR_DOMAIN_PMSUSPENDED,
+            libvirt.VIR_DOMAIN_EVENT_CRASHED: libvirt.VIR_DOMAIN_CRASHED,
+        }
+    return _lifecycle_state_map
+
+
+class Watcher(object):
+    """Tracks the state of every domain and network on a libvirt host from
+    the domain lifecycle and network events libvirt sends, so that callers
+    can wait for state changes without polling libvirtd.
+
+    The state of domains and networks is fetched once when the watcher is
+    created. After that it is only updated by events. Domains that stop are
+    reported as SHUTOFF, even transient ones libvirt no longer knows about.
+    """
+
+    def __init__(self, uri=None):
+        """
+        :param uri: libvirt connection URI. None means the default URI.
+        """
+        self.uri = uri
+        self._cond = threading.Condition()
+        self._domains = {}
+        self._networks = set()
+        # Names whose state came from an event, and so is newer than the
+        # initial state fetched after the callbacks were registered.
+        self._evented = set()
+        self._listeners = []
+        self.error = None
+
+        # Events are only delivered on connections opened after the event
+        # loop was started, so the watcher has a connection of its own.
+        self._conn = connection.open_event_connection(uri)
+        self._callback_ids = [
+            ('domain', self._conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._on_domain_event, None)),
+            ('network', self._conn.networkEventRegisterAny(
+                None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE,
+                self._on_network_event, None)),
+        ]
+        self._conn.registerCloseCallback(self._on_close, None)
+        self._load()
+
+    def _load(self):
+        # Fetched without holding the lock, since the event loop thread
+        # may need to run for the calls to complete.
+        records = self._conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        domains = dict((dom.name(), stats['state.state'])
+                       for dom, stats in records)
+        flags = libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE
+        networks = set(net.name() for net in self._conn.listAllNetworks(flags))
+        with self._cond:
+            for name, state in domains.items():
+                if ('domain', name) not in self._evented:
+                    self._domains[name] = state
+            for name in networks:
+                if ('network', name) not in self._evented:
+                    self._networks.add(name)
+            self._cond.notify_all()
+
+    def add_listener(self, callback):
+        """Calls the supplied callable with the kind ('domain' or
+        'network'), name and new state of every domain and network that
+        changes state. Domain states are libvirt state codes, or None once
+        the domain is undefined. Network states are True if the network is
+        active.
+        """
+        self._listeners.append(callback)
+
+    def _update(self, kind, name, state):
+        with self._cond:
+            self._evented.add((kind, name))
+            if kind == 'domain':
+                if state is None:
+                    self._domains.pop(name, None)
+                else:
+                    self._domains[name] = state
+            elif state:
+                self._networks.add(name)
+            else:
+                self._networks.discard(name)
+            self._cond.notify_all()
+        # Snapshots taken by this process before the event are stale.
+        states.invalidate(self.uri)
+        for listener in self._listeners:
+            try:
+                listener(kind, name, state)
+            except Exception as err:
+                LOG.error("Error in state listener: %s", err)
+
+    def _on_domain_event(self, conn, dom, event, detail, opaque):
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            state = None
+        else:
+            state = get_lifecycle_state_map().get(event)
+            if state is None:
+                # e.g. VIR_DOMAIN_EVENT_SHUTDOWN, which is followed by
+                # VIR_DOMAIN_EVENT_STOPPED once the guest is off.
+                return
+        LOG.debug("Domain %s event %d, detail %d.", dom.name(), event, detail)
+        self._update('domain', dom.name(), state)
+
+    def _on_network_event(self, conn, net, event, detail, opaque):
+        if event == libvirt.VIR_NETWORK_EVENT_STARTED:
+            active = True
+        elif event in (libvirt.VIR_NETWORK_EVENT_STOPPED,
+                       libvirt.VIR_NETWORK_EVENT_UNDEFINED):
+            active = False
+        else:
+            return
+        LOG.debug("Network %s event %d.", net.name(), event)
+        self._update('network', net.name(), active)
+
+    def _on_close(self, conn, reason, opaque):
+        with self._cond:
+            self.error = "The connection to libvirt closed (reason {0})."
+            self.error = self.error.format(reason)
+            self._cond.notify_all()
+
+    def domain_state(self, name):
+        """Returns the libvirt state code of the named domain or None if no
+        domain with that name exists.
+        """
+        with self._cond:
+            return self._domains.get(name)
+
+    def network_active(self, name):
+        """Returns True if the named network exists and is active."""
+        with self._cond:
+            return name in self._networks
+
+    def _reached(self, domain_name, state):
+        current = self._domains.get(domain_name)
+        if state == libvirt.VIR_DOMAIN_SHUTOFF:
+            return current in (None, libvirt.VIR_DOMAIN_SHUTOFF)
+        return current == state
+
+    def wait_for(self, domain_name, state, timeout=None):
+        """Blocks until the named domain is in the supplied state.
+
+        :param state: libvirt domain state code. A domain that does not
+                      exist is considered to be in VIR_DOMAIN_SHUTOFF.
+        :param timeout: Optional number of seconds to wait.
+        :raises RuntimeError if the domain is not in the state within the
+                timeout, or the connection to libvirt closes.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._reached(domain_name, state):
+                if self.error is not None:
+                    raise RuntimeError(self.error)
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        msg = ("Timed out after {0} seconds waiting for "
+                               "domain {1} to reach state {2}. It is in "
+                               "state {3}.")
+                        msg = msg.format(timeout, domain_name, state,
+                                         self._domains.get(domain_name))
+                        raise RuntimeError(msg)
+                self._cond.wait(remaining)
+
+    def close(self):
+        """Stops receiving events and closes the watcher's connection."""
+        with _WATCHERS_LOCK:
+            if _WATCHERS.get(self.uri) is self:
+                del _WATCHERS[self.uri]
+        for kind, callback_id in self._callback_ids:
+            try:
+                if kind == 'domain':
+                    self._conn.domainEventDeregisterAny(callback_id)
+                else:
+                    self._conn.networkEventDeregisterAny(callback_id)
+            except libvirt.libvirtError as err:
+                LOG.debug("Failed to deregister %s events: %s", kind, err)
+        self._callback_ids = []
+        try:
+            self._conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+        try:
+            self._conn.close()
+        except libvirt.libvirtError as err:
+            LOG.debug("Error closing libvirt connection to %s: %s",
+                      self.uri, err)
+
+
+_WATCHERS = {}
+_WATCHERS_LOCK = threading.Lock()
+
+
+def get_watcher(uri=None):
+    """Returns the shared Watcher for the supplied URI, creating it on first
+    use.
+    """
+    with _WATCHERS_LOCK:
+        if uri not in _WATCHERS:
+            _WATCHERS[uri] = Watcher(uri)
+        return _WATCHERS[uri]
@@ -0,0 +1,119 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import functools
+import logging
+from multiprocessing import pool
+
+from os_sandbox import conf
+from os_sandbox import timing
+
+LOG = logging.getLogger(__name__)
+
+
+def get_waves(tasks, reverse=False):
+    """Groups tasks into waves so that every task runs in a later wave than
+    all of the tasks it must run after.
+
+    :param tasks: Sequence of (name, callable, after) tuples, where after is a
+                  sequence of names of tasks that must complete first.
+    :param reverse: Reverse the ordering, e.g. to stop things in the
+                    opposite order they were started in.
+    :raises RuntimeError if a task runs after an unknown task or the
+            ordering constraints contain a cycle.
+    :returns list of lists of tasks.
+    """
+    names = set(t[0] for t in tasks)
+    for name, func, after in tasks:
+        unknown = set(after or ()) - names
+        if unknown:
+            msg = "{0} is ordered after unknown {1}."
+            msg = msg.format(name, ", ".join(sorted(unknown)))
+            raise RuntimeError(msg)
+
+    waves = []
+    done = set()
+    remaining = list(tasks)
+    while remaining:
+        wave = [t for t in remaining if set(t[2] or ()) <= done]
+        if not wave:
+            msg = "Ordering constraints between {0} contain a cycle."
+            msg = msg.format(", ".join(t[0] for t in remaining))
+            raise RuntimeError(msg)
+        waves.append(wave)
+        done.update(t[0] for t in wave)
+        remaining = [t for t in remaining if t[0] not in done]
+
+    if reverse:
+        waves.reverse()
+    return waves
+
+
+def _call(action, parent, task):
+    name, func, after = task
+    try:
+        # Tasks run in worker threads, so their spans are nested under the
+        # span that was open where run() was called.
+        with timing.span('{0} {1}'.format(action, name), parent=parent):
+            func()
+        return name, None
+    except Exception as err:
+        LOG.debug("%s failed: %s", name, err, exc_info=True)
+        return name, err
+
+
+def run(tasks, parallel=conf.DEFAULT_PARALLEL, reverse=False, action='run',
+        skip_after_failure=True):
+    """Runs tasks concurrently on a bounded pool of worker threads, honouring
+    the ordering constraints between them.
+
+    All tasks in a wave are run even if some of them fail, but later waves
+    are not started once a wave has failed, unless skip_after_failure is
+    False.
+
+    :param tasks: Sequence of (name, callable, after) tuples. See get_waves().
+    :param parallel: Maximum number of tasks to run at the same time.
+    :param reverse: Run the waves in reverse order.
+    :param action: Verb used to describe the tasks in error messages.
+    :param skip_after_failure: Whether to skip the later waves once a wave
+                               has failed. Teardown, such as stopping
+                               nodes, runs every wave instead, so that one
+                               failure does not leave the rest running.
+    :raises RuntimeError listing every task that failed or was skipped.
+    """
+    waves = get_waves(tasks, reverse=reverse)
+    parallel = max(1, parallel)
+    call = functools.partial(_call, action, timing.current())
+    errors = []
+    skipped = []
+    for wave in waves:
+        if errors and skip_after_failure:
+            skipped.extend(t[0] for t in wave)
+            continue
+        if parallel == 1 or len(wave) == 1:
+            results = [call(t) for t in wave]
+        else:
+            workers = pool.ThreadPool(min(parallel, len(wave)))
+            try:
+                results = workers.map(call, wave)
+            finally:
+                workers.close()
+                workers.join()
+        errors.extend((name, err) for name, err in results if err is not None)
+
+    if errors:
+        lines = ["Failed to {0} {1}:".format(action,
+                                           ", ".join(e[0] for e in errors))]
+        lines.extend("  {0}: {1}".format(name, err) for name, err in errors)
+        if skipped:
+            lines.append("Skipped: {0}".format(", ".join(skipped)))
+        raise RuntimeError("\n".join(lines))
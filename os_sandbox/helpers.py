@@ -12,6 +12,7 @@
 
 import errno
 import grp
+import importlib
 import os
 import pwd
 import stat
@@ -20,6 +21,32 @@ import subprocess
 import six
 
 
+class LazyModule(object):
+    """Stands in for a module that is only imported the first time one of
+    its attributes is used, so that commands that never touch it don't pay
+    for importing it.
+
+    :param name: Name of the module to import.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def lazy_import(name):
+    """Returns a LazyModule for the named module."""
+    return LazyModule(name)
+
+
 def get_current_groupname():
     """Returns the group name of the user currently executing the program."""
     return grp.getgrgid(os.getgid())[0]
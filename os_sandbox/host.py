@@ -0,0 +1,179 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+from xml.etree import ElementTree
+
+from six.moves.urllib import parse
+
+from os_sandbox import connection
+
+LOG = logging.getLogger(__name__)
+
+VENDOR_INTEL = 'Intel'
+VENDOR_AMD = 'AMD'
+
+# The CPU feature flag a guest needs to run KVM itself, by host CPU vendor.
+VIRT_FEATURES = {
+    VENDOR_INTEL: 'vmx',
+    VENDOR_AMD: 'svm',
+}
+
+# Whether the kvm module passes hardware virtualization through to guests.
+NESTED_PARAM_PATHS = {
+    VENDOR_INTEL: '/sys/module/kvm_intel/parameters/nested',
+    VENDOR_AMD: '/sys/module/kvm_amd/parameters/nested',
+}
+
+
+_UNIT_KIB = {
+    'b': 1.0 / 1024, 'bytes': 1.0 / 1024,
+    'KiB': 1, 'k': 1,
+    'MiB': 1024, 'M': 1024,
+    'GiB': 1024 ** 2, 'G': 1024 ** 2,
+    'TiB': 1024 ** 3, 'T': 1024 ** 3,
+}
+
+
+def _to_kib(value, unit):
+    return int(value * _UNIT_KIB[unit])
+
+
+class HostCapabilities(object):
+    """The parts of a libvirt host's capabilities XML that node domains are
+    configured from.
+    """
+
+    def __init__(self, caps_xml):
+        root = ElementTree.fromstring(caps_xml)
+        cpu = root.find('host/cpu')
+        self.arch = cpu.findtext('arch')
+        self.cpu_vendor = cpu.findtext('vendor')
+        self.cpu_model = cpu.findtext('model')
+        # Memory page sizes the host supports, in KiB. The smallest one is
+        # the normal page size, the others are hugepage sizes.
+        self.page_sizes_kib = sorted(
+            int(pages.get('size')) for pages in cpu.findall('pages'))
+
+        # Host NUMA cells, keyed by cell ID, as dicts with the cell's
+        # 'memory_kib', the number of 'pages' of each page size in it and
+        # the IDs of its 'cpus'.
+        self.numa_cells = {}
+        for cell in root.findall('host/topology/cells/cell'):
+            memory = cell.find('memory')
+            self.numa_cells[int(cell.get('id'))] = {
+                'memory_kib': _to_kib(int(memory.text),
+                                      memory.get('unit', 'KiB')),
+                'pages': dict(
+                    (int(pages.get('size')), int(pages.text))
+                    for pages in cell.findall('pages')
+                ),
+                'cpus': sorted(int(c.get('id'))
+                               for c in cell.findall('cpus/cpu')),
+            }
+
+    @property
+    def hugepage_sizes_kib(self):
+        return self.page_sizes_kib[1:]
+
+    def configured_pages(self, size_kib, cells=None):
+        """Returns the number of pages of the supplied size that are
+        configured on the host, in all NUMA cells or in the supplied ones.
+        """
+        cells = self.numa_cells.keys() if cells is None else cells
+        return sum(self.numa_cells[c]['pages'].get(size_kib, 0)
+                   for c in cells if c in self.numa_cells)
+
+    @property
+    def virt_feature(self):
+        """The CPU feature flag for hardware virtualization on this host, or
+        None if the host CPU vendor is not known.
+        """
+        return VIRT_FEATURES.get(self.cpu_vendor)
+
+
+def format_cpuset(cpus):
+    """Returns a libvirt cpuset string, like '0-3,8', for the CPU IDs."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{0}-{1}'.format(a, b)
+                    for a, b in ranges)
+
+
+_CAPS = {}
+_CAPS_LOCK = threading.Lock()
+
+
+def get_capabilities(uri=None):
+    """Returns the HostCapabilities of the host at the supplied URI. They
+    are only fetched once per URI.
+    """
+    with _CAPS_LOCK:
+        if uri not in _CAPS:
+            conn = connection.get_connection(uri)
+            _CAPS[uri] = HostCapabilities(conn.getCapabilities())
+        return _CAPS[uri]
+
+
+def is_local(uri):
+    """Returns True if the libvirt URI refers to this machine."""
+    return uri is None or not parse.urlparse(uri).netloc
+
+
+def nested_virt_enabled(uri=None):
+    """Returns whether the kvm module on the host passes hardware
+    virtualization through to guests, without which KVM inside the nodes
+    falls back to emulation.
+
+    The kvm module parameters can only be read on this machine, so None is
+    returned for remote hosts, as it is for hosts whose CPU vendor is not
+    known.
+    """
+    if not is_local(uri):
+        return None
+    param_path = NESTED_PARAM_PATHS.get(get_capabilities(uri).cpu_vendor)
+    if param_path is None:
+        return None
+    try:
+        with open(param_path, 'rb') as param:
+            return param.read().strip().upper() in (b'Y', b'1')
+    except (IOError, OSError):
+        return False
+
+
+def check_nested_virt(uri=None):
+    """Checks that the kvm module on the host passes hardware
+    virtualization through to guests. See nested_virt_enabled().
+
+    :raises RuntimeError, saying how to enable it, if nested virtualization
+            is not enabled.
+    """
+    enabled = nested_virt_enabled(uri)
+    if enabled is None:
+        if is_local(uri):
+            LOG.warning("Cannot check nested virtualization on host with "
+                        "CPU vendor %s.", get_capabilities(uri).cpu_vendor)
+        else:
+            LOG.debug("Not checking nested virtualization on remote host "
+                      "%s.", uri)
+    elif not enabled:
+        vendor = get_capabilities(uri).cpu_vendor
+        module = 'kvm_intel' if vendor == VENDOR_INTEL else 'kvm_amd'
+        msg = ("Nested virtualization is not enabled on this host, so "
+               "compute nodes would run their instances without KVM. Enable "
+               "it with `modprobe -r {0} && modprobe {0} nested=1`.")
+        raise RuntimeError(msg.format(module))
@@ -13,8 +13,99 @@
 import json
 import os
 import subprocess
+import threading
 
+from os_sandbox import build
 from os_sandbox import helpers
+from os_sandbox import imagecache
+from os_sandbox import timing
+
+INFO_CACHE_FILENAME = 'image-info.json'
+BUILD_LOG_DIRNAME = 'build-logs'
+
+# Elements, besides the distro, that base images are built with.
+ELEMENTS = (
+    'vm',
+    'cloud-init-nocloud',  # Avoid delay polling for EC2 metadata
+    'pip-and-virtualenv',
+    'local-config',  # Inject the local user's SSH keys
+)
+
+
+class ImageInfoCache(object):
+    """Persistent cache of `qemu-img info` output, stored as JSON in the
+    state directory.
+
+    Entries are keyed by image path and are only valid while the file's size,
+    mtime and inode are unchanged, so a rebuilt or modified image is always
+    re-inspected.
+    """
+
+    def __init__(self, state_dir):
+        self.cache_path = os.path.join(state_dir, INFO_CACHE_FILENAME)
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                return json.loads(cache_file.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp_path = '{0}.{1}.tmp'.format(self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(json.dumps(self._entries).encode('utf-8'))
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            # The cache is only an optimization. Failing to write it, for
+            # instance on a read-only state dir, is not an error.
+            pass
+
+    @staticmethod
+    def _stat_key(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime, st.st_ino]
+
+    def get_info(self, path):
+        """Returns the decoded `qemu-img info` output for the image at the
+        supplied path, running qemu-img only on a cache miss.
+
+        :raises RuntimeError if qemu-img fails.
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            stat_key = self._stat_key(path)
+            entry = self._entries.get(path)
+            if entry is not None and entry['stat'] == stat_key:
+                return entry['info']
+
+            cmd = ('qemu-img', 'info', '--output=json', path)
+            try:
+                with timing.span('qemu-img info', path=path):
+                    output = helpers.execute(*cmd)
+            except subprocess.CalledProcessError as err:
+                raise RuntimeError(err)
+
+            info = json.loads(output)
+            self._entries[path] = {'stat': stat_key, 'info': info}
+            self._save()
+            return info
+
+
+_INFO_CACHES = {}
+_INFO_CACHES_LOCK = threading.Lock()
+
+
+def get_info_cache(state_dir):
+    """Returns the shared ImageInfoCache for the supplied state dir."""
+    with _INFO_CACHES_LOCK:
+        if state_dir not in _INFO_CACHES:
+            _INFO_CACHES[state_dir] = ImageInfoCache(state_dir)
+        return _INFO_CACHES[state_dir]
 
 
 class Image(object):
@@ -23,50 +114,150 @@ class Image(object):
         if name.endswith(file_format):
             name = name.rstrip('.' + file_format)
         self.name = name
+        self.file_format = file_format
+        self.state_dir = parsed_args.state_dir
         self.images_base_dir = os.path.join(parsed_args.state_dir, 'images')
         self.image_path = os.path.join(self.images_base_dir,
                                      name + '.' + file_format)
-        if os.path.exists(self.image_path):
-            self._fill()
 
-    def _fill(self):
-        cmd = ('qemu-img', 'info', '--output=json', self.image_path)
+    def _get_info(self):
+        """Returns `qemu-img info` details about the image. qemu-img is only
+        run when the image is new or has changed since it was last inspected.
+        """
+        return get_info_cache(self.state_dir).get_info(self.image_path)
+
+    @property
+    def virtual_size_bytes(self):
+        return self._get_info()['virtual-size']
+
+    @property
+    def disk_size_bytes(self):
+        return self._get_info()['actual-size']
+
+    def exists(self):
+        return os.path.exists(self.image_path)
+
+    def get_build_key(self, distro='ubuntu', image_size_gb=10):
+        """Returns the key the image would be cached under if it were built
+        from the supplied inputs. See os_sandbox.imagecache.get_build_key().
+        """
+        return imagecache.get_build_key(distro, ELEMENTS, image_size_gb,
+                                        self.file_format)
+
+    @property
+    def build_key(self):
+        """The key of the cached build the image currently points to, or None
+        if the image does not exist or was built before builds were cached.
+        """
+        if not os.path.islink(self.image_path) or not self.exists():
+            return None
+        return imagecache.ImageCache(self.state_dir).key_of(self.image_path)
+
+    def use_build(self, key):
+        """Points the image at the cached build with the supplied key.
+
+        :returns True if there is such a build, False otherwise.
+        """
+        cache = imagecache.ImageCache(self.state_dir)
+        path = cache.lookup(key, os.path.basename(self.image_path))
+        if path is None:
+            return False
+        # Replace the image atomically, so nothing ever sees it missing.
+        tmp_path = '{0}.{1}.tmp'.format(self.image_path, os.getpid())
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        os.symlink(path, tmp_path)
+        os.rename(tmp_path, self.image_path)
+        cache.touch(path)
+        return True
+
+    def create_overlay(self, overlay_path):
+        """Creates a thin qcow2 copy-on-write overlay at the supplied path that
+        is backed by this image. Writes to the overlay never touch this image,
+        so one base image can back any number of nodes.
+
+        The overlay is backed by the cached build the image currently points
+        to rather than by the image itself, so rebuilding the image later
+        does not change what existing overlays are backed by.
+
+        :param overlay_path: Pathname of the overlay file to create.
+        :raises RuntimeError if the image does not exist or qemu-img fails.
+        :returns the path of the image file backing the overlay.
+        """
+        if not self.exists():
+            msg = ("Image {0} does not exist at {1}. Please run "
+                   "`os-sandbox setup`.").format(self.name, self.image_path)
+            raise RuntimeError(msg)
+
+        backing_path = os.path.realpath(self.image_path)
+        cmd = (
+            'qemu-img', 'create', '-q',
+            '-f', 'qcow2',
+            '-b', backing_path,
+            '-F', self.file_format,
+            overlay_path,
+        )
         try:
-            output = helpers.execute(*cmd)
+            with timing.span('qemu-img create', path=overlay_path):
+                helpers.execute(*cmd)
         except subprocess.CalledProcessError as err:
             raise RuntimeError(err)
+        imagecache.ImageCache(self.state_dir).touch(backing_path)
+        return backing_path
 
-        img_info = json.loads(output)
-        self.file_format = img_info['format']
-        self.virtual_size_bytes = img_info['virtual-size']
-        self.disk_size_bytes = img_info['actual-size']
+    def create(self, distro='ubuntu', image_size_gb=10, progress=None,
+               timeout=None):
+        """Uses disk-image-create to build the image into the image cache and
+        points the image at the new build.
 
-    def exists(self):
-        return os.path.exists(self.image_path)
+        The build's output is streamed to a rotating log in the build-logs
+        dir under the images dir rather than being held in memory.
 
-    def create(self, distro='ubuntu', image_size_gb=10, file_format='qcow2'):
-        """Uses disk-image-create to create a new disk image.
-        
-        :returns a tuple containing (returncode, out, err)
+        :param progress: Optional callable, passed (event, name), that is
+                         called as the build moves through its hook phases
+                         and scripts. See os_sandbox.build.run().
+        :param timeout: Optional number of seconds after which the build is
+                        killed.
+        :raises RuntimeError if the build timed out.
+        :returns os_sandbox.build.BuildResult
         """
+        cache = imagecache.ImageCache(self.state_dir)
+        key = self.get_build_key(distro, image_size_gb)
+        build_dir = cache.new_build_dir(key)
         # NOTE(jaypipes): Unfortunately, disk-image-create always tacks on
         # the file format to the output image filename, so we need to only
         # pass the path up to the name of the image and not the file format
         # extension.
-        out_path = os.path.join(self.images_base_dir, self.name)
+        out_path = os.path.join(build_dir, self.name)
         args = [
             'disk-image-create',
-            '-o ' + out_path,
-            '-t ' + file_format,
+            '-o', out_path,
+            '-t', self.file_format,
             '--image-size=%d' % image_size_gb,
             distro,
-            'vm',
-            'cloud-init-nocloud',  # Avoid delay polling for EC2 metadata
-            'pip-and-virtualenv',
-            'local-config',  # Inject the local user's SSH keys
-        ]
-        p = subprocess.Popen(args,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        dib_out, dib_err = p.communicate()
-        return p.returncode, dib_out, dib_err
+        ] + list(ELEMENTS)
+        env = dict(os.environ, DIB_IMAGE_CACHE=cache.dib_cache_dir)
+
+        log_dir = os.path.join(self.images_base_dir, BUILD_LOG_DIRNAME)
+        if not os.path.exists(log_dir):
+            os.mkdir(log_dir, 0o755)
+        log_path = os.path.join(log_dir, self.name + '.log')
+        try:
+            result = build.run(args, log_path, progress=progress,
+                               timeout=timeout, env=env)
+        except BaseException:
+            cache.discard(build_dir)
+            raise
+
+        if not result.succeeded:
+            cache.discard(build_dir)
+            return result
+        inputs = {
+            'distro': distro,
+            'elements': list(ELEMENTS),
+            'image_size_gb': image_size_gb,
+            'file_format': self.file_format,
+        }
+        cache.add(key, build_dir, inputs)
+        self.use_build(key)
+        return result
@@ -0,0 +1,276 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from os_sandbox import catalog
+
+LOG = logging.getLogger(__name__)
+
+CACHE_DIRNAME = 'image-cache'
+# Shared download and package cache for disk-image-create, so rebuilds do
+# not fetch the same cloud images and packages again.
+DIB_CACHE_DIRNAME = 'dib-cache'
+METADATA_FILENAME = 'build.json'
+# Touched whenever a build is used, so its mtime is the build's last use.
+LAST_USED_FILENAME = 'last-used'
+
+
+def _get_elements_dirs():
+    """Returns the directories disk-image-create looks up elements in: those
+    on $ELEMENTS_PATH followed by the ones shipped with diskimage-builder.
+    """
+    dirs = [d for d in os.environ.get('ELEMENTS_PATH', '').split(':') if d]
+    try:
+        import diskimage_builder
+    except ImportError:
+        pass
+    else:
+        pkg_dir = os.path.dirname(os.path.abspath(diskimage_builder.__file__))
+        dirs.append(os.path.join(pkg_dir, 'elements'))
+    return dirs
+
+
+def _find_element(element, elements_dirs):
+    for elements_dir in elements_dirs:
+        element_dir = os.path.join(elements_dir, element)
+        if os.path.isdir(element_dir):
+            return element_dir
+    return None
+
+
+def _hash_element(digest, element, elements_dirs, seen):
+    """Adds the source of the element, and of every element it depends on
+    through its element-deps file, to the digest.
+    """
+    if element in seen:
+        return
+    seen.add(element)
+
+    element_dir = _find_element(element, elements_dirs)
+    digest.update(('element:' + element + '\0').encode('utf-8'))
+    if element_dir is None:
+        LOG.warning("Could not find the source of element %s. Changes to it "
+                    "will not cause images to be rebuilt.", element)
+        return
+
+    deps = []
+    for root, dirs, files in os.walk(element_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            rel_path = os.path.relpath(path, element_dir)
+            digest.update((rel_path + '\0').encode('utf-8'))
+            with open(path, 'rb') as src:
+                content = src.read()
+            digest.update(content)
+            if rel_path == 'element-deps':
+                deps = content.decode('utf-8').split()
+
+    for dep in deps:
+        _hash_element(digest, dep, elements_dirs, seen)
+
+
+def get_build_key(distro, elements, image_size_gb, file_format):
+    """Returns a hash of everything that goes into building an image: the
+    distro, the elements, the image size and format, and the source of each
+    element and of the elements they depend on.
+    """
+    digest = hashlib.sha256()
+    inputs = {
+        'distro': distro,
+        'elements': list(elements),
+        'image_size_gb': image_size_gb,
+        'file_format': file_format,
+    }
+    digest.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+    elements_dirs = _get_elements_dirs()
+    seen = set()
+    for element in [distro] + list(elements):
+        _hash_element(digest, element, elements_dirs, seen)
+    return digest.hexdigest()
+
+
+def _dir_size(path):
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for fname in files:
+            st = os.lstat(os.path.join(root, fname))
+            size += st.st_blocks * 512
+    return size
+
+
+def get_images_in_use(state_dir):
+    """Returns the set of image files that must not be evicted: those the
+    images in the images dir currently point to, and those backing the
+    overlays of existing nodes.
+
+    Nodes created before image builds were cached did not record the image
+    file their overlay is backed by. Their overlays are backed by the path of
+    the image in the images dir.
+    """
+    images_dir = os.path.join(state_dir, 'images')
+    in_use = set()
+    for entry in os.listdir(images_dir):
+        in_use.add(os.path.realpath(os.path.join(images_dir, entry)))
+    for node_confs in catalog.get_catalog(state_dir).get_nodes().values():
+        for node_conf in node_confs.values():
+            path = node_conf.get('image_path')
+            if path is None:
+                path = os.path.join(images_dir, node_conf['image'] + '.qcow2')
+            in_use.add(os.path.realpath(path))
+    return in_use
+
+
+class ImageCache(object):
+    """Content-addressed store of built images in the state dir.
+
+    Each build lives in a directory named after its build key (see
+    get_build_key()), together with a build.json file describing the inputs
+    it was built from. The images in the images dir are symlinks to the
+    build currently in use.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.cache_dir = os.path.join(state_dir, CACHE_DIRNAME)
+        self.dib_cache_dir = os.path.join(state_dir, DIB_CACHE_DIRNAME)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def key_of(self, path):
+        """Returns the build key of the cached image file at the supplied
+        path, or None if it is not a cached build.
+        """
+        entry_dir = os.path.dirname(os.path.realpath(path))
+        if os.path.dirname(entry_dir) != os.path.realpath(self.cache_dir):
+            return None
+        return os.path.basename(entry_dir)
+
+    def lookup(self, key, filename):
+        """Returns the path of the named image file in the build with the
+        supplied key, or None if there is no such build.
+        """
+        path = os.path.join(self.entry_dir(key), filename)
+        if os.path.exists(os.path.join(self.entry_dir(key),
+                                       METADATA_FILENAME)) and \
+                os.path.isfile(path):
+            return path
+        return None
+
+    def ensure_dirs(self):
+        for path in (self.cache_dir, self.dib_cache_dir):
+            if not os.path.exists(path):
+                os.mkdir(path, 0o755)
+
+    def new_build_dir(self, key):
+        """Returns a new, empty directory to build an image for the supplied
+        key in. Pass it to add() once the build succeeds.
+        """
+        self.ensure_dirs()
+        build_dir = '{0}.{1}.tmp'.format(self.entry_dir(key), os.getpid())
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+        os.mkdir(build_dir, 0o755)
+        return build_dir
+
+    def add(self, key, build_dir, inputs):
+        """Records the image built in build_dir as the build with the
+        supplied key.
+
+        :param inputs: Dict describing what the image was built from.
+        """
+        metadata = dict(inputs, key=key, created=time.time())
+        with open(os.path.join(build_dir, METADATA_FILENAME), 'wb') as md:
+            md.write(json.dumps(metadata, indent=2,
+                                sort_keys=True).encode('utf-8'))
+        entry_dir = self.entry_dir(key)
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(build_dir, entry_dir)
+        self.touch(entry_dir)
+
+    def discard(self, build_dir):
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    def touch(self, path):
+        """Marks the build containing the supplied image file, or the build
+        directory itself, as just used. Does nothing for other paths.
+        """
+        path = os.path.realpath(path)
+        entry_dir = path if os.path.isdir(path) else os.path.dirname(path)
+        if os.path.dirname(entry_dir) != os.path.realpath(self.cache_dir):
+            return
+        stamp = os.path.join(entry_dir, LAST_USED_FILENAME)
+        try:
+            with open(stamp, 'a'):
+                os.utime(stamp, None)
+        except (IOError, OSError):
+            # Only affects eviction order, so not an error.
+            pass
+
+    def get_entries(self):
+        """Returns a list of dicts describing each cached build, least
+        recently used first.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self.entry_dir(key)
+            if key.endswith('.tmp') or not os.path.exists(
+                    os.path.join(entry_dir, METADATA_FILENAME)):
+                continue
+            stamp = os.path.join(entry_dir, LAST_USED_FILENAME)
+            try:
+                last_used = os.stat(stamp).st_mtime
+            except OSError:
+                last_used = 0
+            entries.append({
+                'key': key,
+                'dir': entry_dir,
+                'size': _dir_size(entry_dir),
+                'last_used': last_used,
+            })
+        return sorted(entries, key=lambda e: e['last_used'])
+
+    def evict(self, budget_bytes, in_use):
+        """Deletes least recently used builds until the cache fits within
+        the budget. Builds containing any of the in-use image files are never
+        deleted, even if that leaves the cache over budget.
+
+        :param budget_bytes: Disk budget for the whole cache.
+        :param in_use: Set of image file paths that must be kept.
+        :returns list of the build keys that were evicted.
+        """
+        in_use_dirs = set(os.path.dirname(os.path.realpath(p))
+                          for p in in_use)
+        entries = self.get_entries()
+        total = sum(e['size'] for e in entries)
+        evicted = []
+        for entry in entries:
+            if total <= budget_bytes:
+                break
+            if os.path.realpath(entry['dir']) in in_use_dirs:
+                continue
+            LOG.info("Evicting image build %s (%d bytes).", entry['key'],
+                     entry['size'])
+            shutil.rmtree(entry['dir'])
+            total -= entry['size']
+            evicted.append(entry['key'])
+        return evicted
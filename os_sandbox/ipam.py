@@ -0,0 +1,213 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+
+from os_sandbox import helpers
+
+netaddr = helpers.lazy_import('netaddr')
+
+LOG = logging.getLogger(__name__)
+
+# Tables in the state catalog (see os_sandbox.catalog) holding the state of
+# each subnet pool. The subnets allocated from a pool are the rows of the
+# catalog's networks table with the pool's name, so the allocator state can
+# always be recomputed from them with rebuild_pools().
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS ipam_pools (
+        name TEXT PRIMARY KEY,
+        supernet TEXT NOT NULL,
+        prefixlen INTEGER NOT NULL,
+        next_index INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS ipam_free (
+        pool TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        PRIMARY KEY (pool, idx)
+    )""",
+)
+
+
+class SubnetPool(object):
+    """A supernet carved into equally sized subnets, addressed by index.
+
+    Subnets are computed arithmetically from their index, so none of them
+    are ever materialized.
+    """
+
+    def __init__(self, name, supernet, prefixlen):
+        self.name = name
+        self.supernet = netaddr.IPNetwork(supernet).cidr
+        self.prefixlen = int(prefixlen)
+        width = 32 if self.supernet.version == 4 else 128
+        if not self.supernet.prefixlen <= self.prefixlen <= width:
+            msg = ("Prefix length /{0} of network pool {1} must be between "
+                   "/{2} and /{3}.").format(self.prefixlen, name,
+                                            self.supernet.prefixlen, width)
+            raise RuntimeError(msg)
+        self._shift = width - self.prefixlen
+        self.size = 1 << (self.prefixlen - self.supernet.prefixlen)
+
+    def cidr(self, idx):
+        """Returns the CIDR of the subnet with the supplied index."""
+        first = self.supernet.first + (idx << self._shift)
+        addr = netaddr.IPAddress(first, self.supernet.version)
+        return '{0}/{1}'.format(addr, self.prefixlen)
+
+    def index(self, cidr):
+        """Returns the index of the subnet with the supplied CIDR, or None if
+        it is not one of the pool's subnets.
+        """
+        net = netaddr.IPNetwork(cidr)
+        if (net.prefixlen != self.prefixlen or
+                net.version != self.supernet.version or
+                net not in self.supernet):
+            return None
+        return (net.first - self.supernet.first) >> self._shift
+
+    def matches(self, supernet, prefixlen):
+        return (str(self.supernet) == str(netaddr.IPNetwork(supernet).cidr)
+                and self.prefixlen == int(prefixlen))
+
+
+def _sync_pool(conn, pool):
+    """Recomputes the next unused index and the free list of the pool from
+    the subnets recorded in the catalog's networks table.
+    """
+    used = set()
+    rows = conn.execute("SELECT sandbox, cidr FROM networks WHERE name = ?",
+                        (pool.name,))
+    for sandbox, cidr in rows.fetchall():
+        idx = pool.index(cidr)
+        if idx is None:
+            LOG.warning("Network %s of sandbox %s is outside of network pool "
+                        "%s/%d.", cidr, sandbox, pool.supernet,
+                        pool.prefixlen)
+            continue
+        used.add(idx)
+
+    next_index = max(used) + 1 if used else 0
+    conn.execute("DELETE FROM ipam_free WHERE pool = ?", (pool.name,))
+    conn.executemany("INSERT INTO ipam_free (pool, idx) VALUES (?, ?)",
+                     [(pool.name, idx) for idx in range(next_index)
+                      if idx not in used])
+    conn.execute("INSERT OR REPLACE INTO ipam_pools "
+                 "(name, supernet, prefixlen, next_index) "
+                 "VALUES (?, ?, ?, ?)",
+                 (pool.name, str(pool.supernet), pool.prefixlen, next_index))
+
+
+def rebuild_pools(conn):
+    """Recomputes the state of every known pool. Called by the catalog after
+    it has been rebuilt from the YAML files.
+    """
+    rows = conn.execute("SELECT name, supernet, prefixlen FROM ipam_pools")
+    for name, supernet, prefixlen in rows.fetchall():
+        _sync_pool(conn, SubnetPool(name, supernet, prefixlen))
+
+
+class SubnetAllocator(object):
+    """Allocates and releases sandbox network subnets from persistent pools.
+
+    Each pool keeps the index of the next never-allocated subnet and a free
+    list of released indexes in the state catalog, so allocation and release
+    take a constant number of indexed queries regardless of how many
+    sandboxes exist.
+    """
+
+    def __init__(self, cat, pools):
+        """
+        :param cat: The state catalog.
+        :param pools: Dict, keyed by network name, of dicts with the
+                      'supernet' CIDR and the subnet 'prefixlen' to allocate
+                      that network's subnets from. See
+                      os_sandbox.conf.get_network_pools().
+        """
+        self.catalog = cat
+        self.pools = dict(
+            (name, SubnetPool(name, p['supernet'], p['prefixlen']))
+            for name, p in pools.items()
+        )
+
+    def _get_next_index(self, conn, pool):
+        row = conn.execute("SELECT supernet, prefixlen, next_index "
+                           "FROM ipam_pools WHERE name = ?",
+                           (pool.name,)).fetchone()
+        if row is not None and pool.matches(row[0], row[1]):
+            return row[2]
+
+        if row is not None:
+            in_use = conn.execute("SELECT COUNT(*) FROM networks "
+                                  "WHERE name = ?", (pool.name,)).fetchone()
+            if in_use[0]:
+                msg = ("Network pool {0} is in use with {1} subnets of {2} "
+                       "and cannot be changed to /{3} subnets of {4} until "
+                       "the sandboxes using it are deleted.")
+                msg = msg.format(pool.name, '/%d' % row[1], row[0],
+                                 pool.prefixlen, pool.supernet)
+                raise RuntimeError(msg)
+
+        # A new or reconfigured pool. Adopt any subnets that sandboxes
+        # created before the pool existed are already using.
+        _sync_pool(conn, pool)
+        return conn.execute("SELECT next_index FROM ipam_pools "
+                            "WHERE name = ?", (pool.name,)).fetchone()[0]
+
+    def _allocate(self, conn, pool):
+        next_index = self._get_next_index(conn, pool)
+        row = conn.execute("SELECT idx FROM ipam_free WHERE pool = ? "
+                           "ORDER BY idx LIMIT 1", (pool.name,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM ipam_free WHERE pool = ? AND idx = ?",
+                         (pool.name, row[0]))
+            return pool.cidr(row[0])
+
+        if next_index >= pool.size:
+            msg = "No free /{0} subnets left in network pool {1} ({2})."
+            msg = msg.format(pool.prefixlen, pool.name, pool.supernet)
+            raise RuntimeError(msg)
+        conn.execute("UPDATE ipam_pools SET next_index = ? WHERE name = ?",
+                     (next_index + 1, pool.name))
+        return pool.cidr(next_index)
+
+    def allocate(self):
+        """Allocates one subnet from every pool.
+
+        Call this in the same catalog transaction that records the sandbox
+        the subnets are for, so no other process can be handed them first.
+
+        :raises RuntimeError if a pool is exhausted.
+        :returns dict of CIDRs keyed by network name.
+        """
+        with self.catalog.transaction() as conn:
+            return dict(
+                (name, self._allocate(conn, pool))
+                for name, pool in self.pools.items()
+            )
+
+    def release(self, cidrs):
+        """Returns the supplied subnets to their pools.
+
+        :param cidrs: Dict of CIDRs keyed by network name, as returned by
+                      allocate().
+        """
+        with self.catalog.transaction() as conn:
+            for name, cidr in cidrs.items():
+                row = conn.execute("SELECT supernet, prefixlen, next_index "
+                                   "FROM ipam_pools WHERE name = ?",
+                                   (name,)).fetchone()
+                if row is None:
+                    continue
+                idx = SubnetPool(name, row[0], row[1]).index(cidr)
+                if idx is not None and idx < row[2]:
+                    conn.execute("INSERT OR IGNORE INTO ipam_free "
+                                 "(pool, idx) VALUES (?, ?)", (name, idx))
@@ -18,7 +18,9 @@ from cliff import app
 from cliff import commandmanager
 
 from os_sandbox import conf
+from os_sandbox import connection
 from os_sandbox import helpers
+from os_sandbox import timing
 
 VERSION = '0.1'
 DESCRIPTION = 'Create an OpenStack sandbox'
@@ -45,18 +47,55 @@ class OsSandboxApp(app.App):
                 command_manager=commandmanager.CommandManager('os_sandbox'),
                 deferred_help=True,
         )
+        self._command_span = None
+
+    def build_option_parser(self, *args, **kwargs):
+        parser = super(OsSandboxApp, self).build_option_parser(*args,
+                                                               **kwargs)
+        parser.add_argument('--timings', action='store_true',
+                            default=False,
+                            help="Print how long each phase of the command "
+                                 "took to stderr.")
+        parser.add_argument('--timings-file', metavar='FILE',
+                            help="Write how long each phase of the command "
+                                 "took to FILE as a trace in the Trace Event "
+                                 "JSON format, for viewing in "
+                                 "chrome://tracing or Perfetto.")
+        return parser
 
     def initialize_app(self, argv):
         self.LOG.debug('Initializing app.')
+        if self.options.timings or self.options.timings_file:
+            timing.enable()
 
     def prepare_to_run_command(self, cmd):
         self.LOG.debug("Preparing to run command '%s", cmd.__class__.__name__)
+        cmd_name = getattr(cmd, 'cmd_name', None) or cmd.__class__.__name__
+        if timing.enabled():
+            self._command_span = timing.span(cmd_name)
+            self._command_span.__enter__()
 
     def clean_up(self, cmd, result, err):
         self.LOG.debug("Cleaning up after running command '%s'",
                        cmd.__class__.__name__)
         if err:
             self.LOG.debug('Got error: %s', err)
+        connection.close_all()
+        if self._command_span is not None:
+            self._command_span.__exit__(None, None, None)
+            self._command_span = None
+            self._report_timings()
+
+    def _report_timings(self):
+        if self.options.timings:
+            self.stderr.write(timing.format_summary() + "\n")
+            self.stderr.flush()
+        if self.options.timings_file:
+            try:
+                timing.write_trace(self.options.timings_file)
+            except (IOError, OSError) as err:
+                self.LOG.error("Failed to write timings to %s: %s",
+                               self.options.timings_file, err)
 
     def console_wrapped(self, msg, newline=False, wrap_length=70):
         s = "%%-%ds" % wrap_length
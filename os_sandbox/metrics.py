@@ -0,0 +1,304 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import time
+
+from six.moves import BaseHTTPServer
+
+from os_sandbox import catalog
+from os_sandbox import connection
+from os_sandbox import helpers
+from os_sandbox import timing
+
+libvirt = helpers.lazy_import('libvirt')
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_LISTEN_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 9717
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+NS_PER_SECOND = 1e9
+BYTES_PER_KIB = 1024
+
+# Every series is labelled with the node it describes. Block and interface
+# series are also labelled with their device.
+NODE_LABELS = ('sandbox', 'node', 'template', 'services')
+
+Metric = collections.namedtuple('Metric', 'name type help key scale')
+
+# Per-node metrics, each read from a key of the domain's bulk stats and
+# multiplied by scale.
+NODE_METRICS = (
+    Metric('os_sandbox_node_state', 'gauge',
+           "libvirt state code of the node's domain.", 'state.state', 1),
+    Metric('os_sandbox_node_cpu_seconds_total', 'counter',
+           "CPU time used by the node's domain.", 'cpu.time',
+           1 / NS_PER_SECOND),
+    Metric('os_sandbox_node_cpu_user_seconds_total', 'counter',
+           "User CPU time used by the node's domain.", 'cpu.user',
+           1 / NS_PER_SECOND),
+    Metric('os_sandbox_node_cpu_system_seconds_total', 'counter',
+           "System CPU time used by the node's domain.", 'cpu.system',
+           1 / NS_PER_SECOND),
+    Metric('os_sandbox_node_vcpus', 'gauge',
+           "Number of online vCPUs of the node.", 'vcpu.current', 1),
+    Metric('os_sandbox_node_memory_max_bytes', 'gauge',
+           "Memory the node's balloon can grow to.", 'balloon.maximum',
+           BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_balloon_bytes', 'gauge',
+           "Memory currently given to the node by its balloon.",
+           'balloon.current', BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_rss_bytes', 'gauge',
+           "Resident set size of the node's QEMU process.", 'balloon.rss',
+           BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_unused_bytes', 'gauge',
+           "Memory left unused by the guest, as reported by its balloon "
+           "driver.", 'balloon.unused', BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_available_bytes', 'gauge',
+           "Memory the guest sees as usable, as reported by its balloon "
+           "driver.", 'balloon.available', BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_swap_in_bytes_total', 'counter',
+           "Memory the guest swapped in.", 'balloon.swap_in',
+           BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_swap_out_bytes_total', 'counter',
+           "Memory the guest swapped out.", 'balloon.swap_out',
+           BYTES_PER_KIB),
+    Metric('os_sandbox_node_memory_major_faults_total', 'counter',
+           "Page faults in the guest that required disk IO.",
+           'balloon.major_fault', 1),
+)
+
+# Per-disk metrics, each read from the block.<n>.<key> stats.
+BLOCK_METRICS = (
+    Metric('os_sandbox_node_block_read_bytes_total', 'counter',
+           "Bytes read from the disk.", 'rd.bytes', 1),
+    Metric('os_sandbox_node_block_read_requests_total', 'counter',
+           "Read requests to the disk.", 'rd.reqs', 1),
+    Metric('os_sandbox_node_block_read_seconds_total', 'counter',
+           "Time spent reading from the disk.", 'rd.times',
+           1 / NS_PER_SECOND),
+    Metric('os_sandbox_node_block_write_bytes_total', 'counter',
+           "Bytes written to the disk.", 'wr.bytes', 1),
+    Metric('os_sandbox_node_block_write_requests_total', 'counter',
+           "Write requests to the disk.", 'wr.reqs', 1),
+    Metric('os_sandbox_node_block_write_seconds_total', 'counter',
+           "Time spent writing to the disk.", 'wr.times',
+           1 / NS_PER_SECOND),
+    Metric('os_sandbox_node_block_flush_requests_total', 'counter',
+           "Flush requests to the disk.", 'fl.reqs', 1),
+    Metric('os_sandbox_node_block_capacity_bytes', 'gauge',
+           "Virtual size of the disk.", 'capacity', 1),
+    Metric('os_sandbox_node_block_allocation_bytes', 'gauge',
+           "Highest offset written to the disk's image.", 'allocation', 1),
+)
+
+# Per-NIC metrics, each read from the net.<n>.<key> stats.
+INTERFACE_METRICS = (
+    Metric('os_sandbox_node_network_receive_bytes_total', 'counter',
+           "Bytes received by the NIC.", 'rx.bytes', 1),
+    Metric('os_sandbox_node_network_receive_packets_total', 'counter',
+           "Packets received by the NIC.", 'rx.pkts', 1),
+    Metric('os_sandbox_node_network_receive_errors_total', 'counter',
+           "Receive errors on the NIC.", 'rx.errs', 1),
+    Metric('os_sandbox_node_network_receive_drops_total', 'counter',
+           "Received packets dropped by the NIC.", 'rx.drop', 1),
+    Metric('os_sandbox_node_network_transmit_bytes_total', 'counter',
+           "Bytes transmitted by the NIC.", 'tx.bytes', 1),
+    Metric('os_sandbox_node_network_transmit_packets_total', 'counter',
+           "Packets transmitted by the NIC.", 'tx.pkts', 1),
+    Metric('os_sandbox_node_network_transmit_errors_total', 'counter',
+           "Transmit errors on the NIC.", 'tx.errs', 1),
+    Metric('os_sandbox_node_network_transmit_drops_total', 'counter',
+           "Transmitted packets dropped by the NIC.", 'tx.drop', 1),
+)
+
+SCRAPE_METRICS = (
+    Metric('os_sandbox_scrape_success', 'gauge',
+           "Whether the stats of the host's domains could be fetched.",
+           None, 1),
+    Metric('os_sandbox_scrape_duration_seconds', 'gauge',
+           "Time taken to collect the metrics.", None, 1),
+)
+
+
+def _get_stats_flags():
+    return (libvirt.VIR_DOMAIN_STATS_STATE |
+            libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+            libvirt.VIR_DOMAIN_STATS_BALLOON |
+            libvirt.VIR_DOMAIN_STATS_VCPU |
+            libvirt.VIR_DOMAIN_STATS_INTERFACE |
+            libvirt.VIR_DOMAIN_STATS_BLOCK)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_text(families):
+    """Returns metrics in the Prometheus text exposition format.
+
+    :param families: Sequence of (Metric, samples) tuples, where samples is
+                     a list of (labels, value) tuples and labels is a
+                     sequence of (name, value) tuples.
+    """
+    lines = []
+    for metric, samples in families:
+        if not samples:
+            continue
+        lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+        lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+        for labels, value in samples:
+            label_text = ','.join('{0}="{1}"'.format(k, _escape(v))
+                                  for k, v in labels)
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append("{0}{1} {2}".format(metric.name, label_text,
+                                             _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsCollector(object):
+    """Collects the resource usage of every sandbox node on the host.
+
+    Each collection makes a single bulk getAllDomainStats call for all
+    domains, and reads which sandbox, template and services each domain
+    belongs to from the state catalog. Domains that are not sandbox nodes
+    are left out.
+    """
+
+    def __init__(self, state_dir, uri=None):
+        self.catalog = catalog.get_catalog(state_dir)
+        self.uri = uri
+
+    def _get_node_labels(self):
+        """Returns a dict, keyed by domain name, of the label values of
+        every sandbox node.
+        """
+        templates = dict((slug, sb_conf['template'])
+                         for slug, sb_conf in self.catalog.get_sandboxes())
+        labels = {}
+        for sb_slug, node_confs in self.catalog.get_nodes().items():
+            for name, node_conf in node_confs.items():
+                labels[node_conf.get('domain_name', name)] = (
+                    ('sandbox', sb_slug),
+                    ('node', name),
+                    ('template', templates.get(sb_slug, '')),
+                    ('services', ','.join(node_conf.get('services') or ())),
+                )
+        return labels
+
+    def _get_stats(self):
+        conn = connection.get_connection(self.uri)
+        with timing.span('libvirt.getAllDomainStats'):
+            return conn.getAllDomainStats(_get_stats_flags())
+
+    @staticmethod
+    def _add_device_samples(families, metrics, prefix, label, labels,
+                            stats):
+        for i in range(stats.get(prefix + '.count', 0)):
+            dev_prefix = '{0}.{1}.'.format(prefix, i)
+            dev_labels = labels + ((label, stats.get(dev_prefix + 'name',
+                                                     str(i))),)
+            for metric in metrics:
+                value = stats.get(dev_prefix + metric.key)
+                if value is not None:
+                    families[metric].append((dev_labels,
+                                             value * metric.scale))
+
+    def collect(self):
+        """Returns the metrics of every sandbox node as (Metric, samples)
+        tuples. See format_text().
+
+        :raises libvirt.libvirtError if the host could not be queried.
+        """
+        families = collections.OrderedDict(
+            (m, []) for m in NODE_METRICS + BLOCK_METRICS + INTERFACE_METRICS
+        )
+        node_labels = self._get_node_labels()
+        for dom, stats in self._get_stats():
+            labels = node_labels.get(dom.name())
+            if labels is None:
+                continue
+            for metric in NODE_METRICS:
+                value = stats.get(metric.key)
+                if value is not None:
+                    families[metric].append((labels, value * metric.scale))
+            self._add_device_samples(families, BLOCK_METRICS, 'block',
+                                     'device', labels, stats)
+            self._add_device_samples(families, INTERFACE_METRICS, 'net',
+                                     'interface', labels, stats)
+        return list(families.items())
+
+    def scrape(self):
+        """Returns the metrics of every sandbox node, and of the scrape
+        itself, in the Prometheus text format. Failing to query the host is
+        reported by the os_sandbox_scrape_success metric rather than raised.
+        """
+        start = time.time()
+        try:
+            families = self.collect()
+            success = 1
+        except libvirt.libvirtError as err:
+            LOG.error("Failed to collect domain stats: %s", err)
+            families = []
+            success = 0
+        families.extend([
+            (SCRAPE_METRICS[0], [((), success)]),
+            (SCRAPE_METRICS[1], [((), time.time() - start)]),
+        ])
+        return format_text(families)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in (METRICS_PATH, '/'):
+            self.send_error(404)
+            return
+        body = self.server.collector.scrape().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOG.debug("%s - %s", self.address_string(), fmt % args)
+
+
+def serve(collector, address=DEFAULT_LISTEN_ADDRESS, port=DEFAULT_PORT):
+    """Serves the collector's metrics over HTTP until interrupted. Scrapes
+    are handled one at a time, each with one bulk stats call.
+
+    :param collector: The MetricsCollector to scrape.
+    :param address: Address to listen on.
+    :param port: Port to listen on.
+    """
+    server = BaseHTTPServer.HTTPServer((address, port), _MetricsHandler)
+    server.collector = collector
+    LOG.info("Serving metrics on http://%s:%d%s", address, port,
+             METRICS_PATH)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -13,11 +13,102 @@
 import logging
 import os
 
-import libvirt
-import netaddr
+import six
 import slugify
 
+from os_sandbox import connection
+from os_sandbox import devices
 from os_sandbox import helpers
+from os_sandbox import states
+from os_sandbox import timing
+
+libvirt = helpers.lazy_import('libvirt')
+netaddr = helpers.lazy_import('netaddr')
+
+# Settings a template may give each of the networks of its sandboxes. mtu is
+# the MTU of the network's bridge and of the nodes' NICs on it. queues is the
+# number of queue pairs of the nodes' NICs, or 'vcpu' for one per vCPU of the
+# node, and never more than the node has vCPUs. bandwidth limits the traffic
+# of the whole network and interface_bandwidth that of each NIC on it.
+NETWORK_SETTINGS = ('mtu', 'queues', 'bandwidth', 'interface_bandwidth')
+QUEUES_PER_VCPU = 'vcpu'
+MIN_MTU = 68
+MAX_MTU = 65535
+
+
+def _check_bandwidth(net_name, setting, bandwidth):
+    if not isinstance(bandwidth, dict):
+        msg = "{0} of network {1} must be a mapping.".format(setting,
+                                                             net_name)
+        raise RuntimeError(msg)
+    for direction, limits in bandwidth.items():
+        if direction not in ('inbound', 'outbound'):
+            msg = ("Unknown direction {0} in {1} of network {2}. Valid "
+                   "directions are: inbound, outbound.")
+            raise RuntimeError(msg.format(direction, setting, net_name))
+        if not isinstance(limits, dict) or 'average' not in limits:
+            msg = "{0} {1} of network {2} must set an average rate."
+            raise RuntimeError(msg.format(setting, direction, net_name))
+        for key, value in limits.items():
+            if key not in devices.BANDWIDTH_KEYS:
+                msg = ("Unknown limit {0} in {1} {2} of network {3}. Valid "
+                       "limits are: {4}.")
+                raise RuntimeError(msg.format(
+                    key, setting, direction, net_name,
+                    ', '.join(devices.BANDWIDTH_KEYS)))
+            if not isinstance(value, six.integer_types) or value < 1:
+                msg = "{0} in {1} {2} of network {3} must be a positive "
+                msg += "integer."
+                raise RuntimeError(msg.format(key, setting, direction,
+                                              net_name))
+
+
+def check_settings(net_name, settings):
+    """
+    :raises RuntimeError if the settings of the named network are not
+            valid. See NETWORK_SETTINGS.
+    """
+    # An empty entry in the template, e.g. `mgmt:`, has no settings.
+    settings = settings or {}
+    if not isinstance(settings, dict):
+        msg = "Settings of network {0} must be a mapping.".format(net_name)
+        raise RuntimeError(msg)
+    unknown = set(settings) - set(NETWORK_SETTINGS)
+    if unknown:
+        msg = "Unknown settings {0} for network {1}. Valid settings are: {2}."
+        raise RuntimeError(msg.format(', '.join(sorted(unknown)), net_name,
+                                      ', '.join(NETWORK_SETTINGS)))
+    mtu = settings.get('mtu')
+    if mtu is not None and (not isinstance(mtu, six.integer_types) or
+                            not MIN_MTU <= mtu <= MAX_MTU):
+        msg = "mtu of network {0} must be an integer from {1} to {2}."
+        raise RuntimeError(msg.format(net_name, MIN_MTU, MAX_MTU))
+    queues = settings.get('queues')
+    if queues is not None and queues != QUEUES_PER_VCPU and (
+            not isinstance(queues, six.integer_types) or queues < 1):
+        msg = "queues of network {0} must be a positive integer or {1}."
+        raise RuntimeError(msg.format(net_name, QUEUES_PER_VCPU))
+    for setting in ('bandwidth', 'interface_bandwidth'):
+        if settings.get(setting):
+            _check_bandwidth(net_name, setting, settings[setting])
+
+
+def describe_settings(settings):
+    """Returns a short description of a network's settings, such as
+    "mtu 9000, queues vcpu, inbound 125000 KiB/s".
+    """
+    parts = []
+    for setting in ('mtu', 'queues'):
+        if settings.get(setting) is not None:
+            parts.append("{0} {1}".format(setting, settings[setting]))
+    for setting, prefix in (('bandwidth', ''), ('interface_bandwidth',
+                                                'per NIC ')):
+        for direction in ('inbound', 'outbound'):
+            limits = (settings.get(setting) or {}).get(direction)
+            if limits:
+                parts.append("{0}{1} {2} KiB/s".format(prefix, direction,
+                                                      limits['average']))
+    return ', '.join(parts)
 
 
 class Network(object):
@@ -28,43 +119,85 @@ class Network(object):
     STATUS_DOWN = 'DOWN'
     STATUS_ERROR = 'ERROR'
 
-    def __init__(self, sandbox, name, cidr):
+    def __init__(self, sandbox, name, cidr, settings=None):
+        """
+        :param sandbox: The Sandbox the network belongs to.
+        :param name: Name of the network within the sandbox.
+        :param cidr: The subnet allocated to the network.
+        :param settings: Optional dict of the network's settings from the
+                         sandbox's template. See NETWORK_SETTINGS.
+        """
         self.sandbox = sandbox
         self.name = name
         self.slug = slugify.slugify(helpers.utf8_bytes(self.name))
+        # Network names are only unique within a sandbox, so the libvirt
+        # network is named after both. See Sandbox.network_prefix.
+        self.libvirt_name = '{0}-{1}'.format(sandbox.network_prefix,
+                                             self.slug)
         self.cidr = cidr
+        self.settings = settings or {}
+        self.mtu = self.settings.get('mtu')
+        self.interface_bandwidth = self.settings.get('interface_bandwidth')
         self.error = None
-        self.ip_net = netaddr.IPNetwork(cidr)
-        self.gateway_ip_address = str(self.ip_net.ip)
-        self.dhcp_ip_address_start = str(self.ip_net[1])
-        self.dhcp_ip_address_end = str(self.ip_net[-2])  # [-1] is broadcast
+        self._ip_net = None
 
-    def _get_conn(self, readonly=True):
-        if readonly:
-            conn = libvirt.openReadOnly(None)
-        else:
-            conn = libvirt.open(None)
-        if conn == None:
-            msg = "Failed to connect to QEMU."
-            raise RuntimeError(msg)
-        return conn
+    @property
+    def ip_net(self):
+        # Parsed on first use, since listing sandboxes never needs it.
+        if self._ip_net is None:
+            self._ip_net = netaddr.IPNetwork(self.cidr)
+        return self._ip_net
+
+    @property
+    def netmask(self):
+        return str(self.ip_net.netmask)
+
+    @property
+    def gateway_ip_address(self):
+        # [0] is the network address.
+        return str(self.ip_net[1])
+
+    @property
+    def dhcp_ip_address_start(self):
+        return str(self.ip_net[2])
 
-    def _get_libvirt_net(self, readonly=True):
-        conn = self._get_conn(readonly)
-        return conn.networkLookupByName(self.name)
+    @property
+    def dhcp_ip_address_end(self):
+        return str(self.ip_net[-2])  # [-1] is broadcast
+
+    def get_queues(self, vcpus):
+        """Returns the number of queue pairs of the NIC of a node with the
+        supplied number of vCPUs on the network.
+        """
+        queues = self.settings.get('queues')
+        if queues is None:
+            return None
+        if queues == QUEUES_PER_VCPU:
+            return vcpus
+        return min(queues, vcpus)
+
+    def _get_conn(self, readonly=True):
+        return connection.get_connection(self.sandbox.libvirt_uri, readonly)
 
     def _get_xml(self):
         conf = {
-            'name': self.name,
+            'name': self.libvirt_name,
             'gateway_ip_address': self.gateway_ip_address,
+            'netmask': self.netmask,
             'dhcp_ip_address_start': self.dhcp_ip_address_start,
             'dhcp_ip_address_end': self.dhcp_ip_address_end,
+            'mtu_xml': ("<mtu size='{0}'/>".format(self.mtu)
+                        if self.mtu else ''),
+            'bandwidth_xml': devices.get_bandwidth_xml(
+                self.settings.get('bandwidth')),
         }
         xml_text = """
 <network>
     <name>{name}</name>
     <forward mode='nat'/>
-    <ip address='{gateway_ip_address}' netmask='255.255.255.0'>
+    {mtu_xml}
+    {bandwidth_xml}
+    <ip address='{gateway_ip_address}' netmask='{netmask}'>
         <dhcp>
             <range start='{dhcp_ip_address_start}'
                    end='{dhcp_ip_address_end}'/>
@@ -78,45 +211,68 @@ class Network(object):
     def status(self):
         if self.error is not None:
             return Network.STATUS_ERROR
+        host_states = states.get_states(self.sandbox.libvirt_uri)
         try:
-            net = self._get_libvirt_net()
-            if net.isActive() :
+            if host_states.network_active(self.libvirt_name):
                 return Network.STATUS_UP
             else:
-                return Network.STATUS_DOWN
-        except libvirt.libvirtError as err:
-            err_code = err.get_error_code()
-            if err_code == libvirt.VIR_ERR_NO_NETWORK:
                 # The networks for sandboxes are temporal, so there's
                 # no real mapping of "no network found" other than the
                 # network should be considered not "up".
                 return Network.STATUS_DOWN
+        except libvirt.libvirtError as err:
             self.error = err
             return Network.STATUS_ERROR
 
-    def start(self):
-        if self.status == Network.STATUS_UP:
+    def start(self, check=True):
+        """Creates the network in libvirt if it is not active.
+
+        :param check: Whether to check if the network is already active.
+                      Callers that checked the status of several networks
+                      in one host state snapshot pass False.
+        :raises RuntimeError if the network failed to start.
+        """
+        if check and self.status == Network.STATUS_UP:
             return
 
         conn = self._get_conn(readonly=False)
-        net = conn.networkCreateXML(self._get_xml())
+        try:
+            with timing.span('libvirt.networkCreateXML',
+                             network=self.libvirt_name):
+                net = conn.networkCreateXML(self._get_xml())
+        except libvirt.libvirtError as err:
+            self.error = err
+            msg = "Failed to start network {0}: {1}"
+            raise RuntimeError(msg.format(self.libvirt_name, err))
+        finally:
+            states.invalidate(self.sandbox.libvirt_uri)
         if net == None:
             msg = "Failed to start network {0}"
-            msg = msg.format(self.name)
+            msg = msg.format(self.libvirt_name)
             self.error = msg
             raise RuntimeError(msg)
-        conn.close()
 
-    def stop(self):
-        conn = self._get_conn(False)
+    def stop(self, check=True):
+        """Tears the network down if it is active.
+
+        :param check: Whether to check if the network is active. See
+                      start().
+        :raises RuntimeError if the network failed to stop.
+        """
+        if check and self.status != Network.STATUS_UP:
+            return
+
+        conn = self._get_conn(readonly=False)
         try:
-            net = conn.networkLookupByName(self.name)
+            net = conn.networkLookupByName(self.libvirt_name)
+            with timing.span('libvirt.networkDestroy',
+                             network=self.libvirt_name):
+                net.destroy()
         except libvirt.libvirtError as err:
             if err.get_error_code() == libvirt.VIR_ERR_NO_NETWORK:
                 return
             self.error = err
-        if net == None:
-            msg = "Failed to stop network {0}"
-            msg = msg.format(self.name)
-            raise RuntimeError(msg)
-        net.destroy()
+            msg = "Failed to stop network {0}: {1}"
+            raise RuntimeError(msg.format(self.libvirt_name, err))
+        finally:
+            states.invalidate(self.sandbox.libvirt_uri)
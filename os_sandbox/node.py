@@ -10,24 +10,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import logging
 import os
-import shutil
+import subprocess
+import time
 import uuid
-import yaml
 
-import libvirt
-import slugify
+import six
 
+from os_sandbox import capacity
+from os_sandbox import conf
+from os_sandbox import connection
+from os_sandbox import cpupin
+from os_sandbox import devices
+from os_sandbox import events
 from os_sandbox import helpers
+from os_sandbox import host
 from os_sandbox import image
-from os_sandbox import template
+from os_sandbox import states
+from os_sandbox import timing
 
-def libvirt_callback(ignore, err):
-    if err[3] != libvirt.VIR_ERR_ERROR:
-          # Don't log libvirt errors: global error handler will do that
-          logging.warn("Non-error from libvirt: '%s'" % err[2])
-libvirt.registerErrorHandler(f=libvirt_callback, ctx=None)
+libvirt = helpers.lazy_import('libvirt')
+yaml = helpers.lazy_import('yaml')
 
 
 class Node(object):
@@ -38,118 +43,637 @@ class Node(object):
     STATUS_UP = 'UP'
     STATUS_ERROR = 'ERROR'
     STATUS_DOWN = 'DOWN'
+    STATUS_SUSPENDED = 'SUSPENDED'
+    STATUS_PAUSED = 'PAUSED'
 
-    def __init__(self, sandbox, name):
+    CPU_MODE_HOST_PASSTHROUGH = 'host-passthrough'
+    CPU_MODE_HOST_MODEL = 'host-model'
+    CPU_MODE_CUSTOM = 'custom'
+    CPU_MODES = (CPU_MODE_HOST_PASSTHROUGH, CPU_MODE_HOST_MODEL,
+                 CPU_MODE_CUSTOM)
+    DEFAULT_CPU_MODE = CPU_MODE_HOST_PASSTHROUGH
+
+    # Hugepage size used when the hugepages resource is just `true`.
+    DEFAULT_HUGEPAGE_SIZE_KIB = 2048
+    # Memory QEMU itself may lock on top of the guest's memory when the
+    # mem_lock resource is set.
+    MEM_LOCK_OVERHEAD_KIB = 512 * 1024
+
+    # Built on first use, so that libvirt is only imported when needed.
+    _state_code_map = None
+
+    @classmethod
+    def get_state_code_map(cls):
+        """Returns a dict mapping libvirt domain state codes to statuses."""
+        if cls._state_code_map is None:
+            cls._state_code_map = {
+                libvirt.VIR_DOMAIN_NOSTATE: Node.STATUS_UNDEFINED,
+                libvirt.VIR_DOMAIN_RUNNING: Node.STATUS_UP,
+                libvirt.VIR_DOMAIN_BLOCKED: Node.STATUS_UP,
+                libvirt.VIR_DOMAIN_PAUSED: Node.STATUS_PAUSED,
+                libvirt.VIR_DOMAIN_SHUTDOWN: Node.STATUS_DOWN,
+                libvirt.VIR_DOMAIN_SHUTOFF: Node.STATUS_DOWN,
+                libvirt.VIR_DOMAIN_CRASHED: Node.STATUS_ERROR,
+                libvirt.VIR_DOMAIN_PMSUSPENDED: Node.STATUS_DOWN,
+            }
+        return cls._state_code_map
+
+    def __init__(self, sandbox, name, conf=None):
+        """
+        :param sandbox: The Sandbox the node belongs to.
+        :param name: Name of the node within the sandbox.
+        :param conf: The node's config, if already loaded from the state
+                     catalog. If None, the node's config file is read.
+        """
         self.sandbox = sandbox
         self.parsed_args = sandbox.parsed_args
         self.name = name
+        # Node names are only unique within a sandbox, so the libvirt domain
+        # is named after both. Nodes created before domain names were
+        # recorded in their config used the bare node name.
+        self.domain_name = '{0}-{1}'.format(sandbox.slug, name)
         self.error = None
+        # Host CPUs assigned to the node by its sandbox when it is started.
+        # See os_sandbox.cpupin.
+        self.cpu_pins = None
+        # When this process last started the node, for measuring how long
+        # it takes to boot. See os_sandbox.readiness.
+        self.started_at = None
         self.node_dir = os.path.join(sandbox.nodes_dir,
                                      self.name)
         self.conf_path = os.path.join(self.node_dir,
                                       'config.yaml')
+        # Copy-on-write overlay, backed by the node's base image, that holds
+        # everything the guest writes to its disk.
+        self.disk_path = os.path.join(self.node_dir, 'disk.qcow2')
+        # Settings of the node's disks, overriding those of its device
+        # profile. See devices.DISK_SETTINGS.
+        self.disk_settings = {}
+        # Whether the node gets nested virtualization unless its resources
+        # set nested_virt. Nodes created before the setting existed do not.
+        self.nested_virt_default = False
+        # The guest's memory and device state while the node is suspended.
+        self.save_path = os.path.join(self.node_dir, 'memory.save')
 
-        if os.path.exists(self.conf_path):
+        if conf is not None or os.path.exists(self.conf_path):
             try:
-                self._fill()
+                self._fill(conf)
             except Exception as err:
                 self.error = err
 
-    def _fill(self):
-        conf = yaml.load(open(self.conf_path, 'rb'))
+    def _fill(self, conf=None):
+        if conf is None:
+            conf = yaml.load(open(self.conf_path, 'rb'))
         self.uuid = conf['uuid']
+        self.domain_name = conf.get('domain_name', self.name)
         self.resources = conf['resources']
         self.services = conf['services']
+        self.start_after = conf.get('start_after', [])
+        # Nodes created before device profiles existed had emulated devices.
+        self.device_profile = conf.get('device_profile',
+                                       devices.PROFILE_LEGACY)
+        self.disk_settings = conf.get('disk', {})
+        self.nested_virt_default = conf.get('nested_virt_default', False)
         self.image = image.Image(self.parsed_args, conf['image'])
+        # Nodes created before image builds were cached have overlays backed
+        # by the image in the images dir.
+        self.image_path = conf.get('image_path',
+                                   os.path.abspath(self.image.image_path))
 
     def _get_conn(self, readonly=True):
-        if readonly:
-            conn = libvirt.openReadOnly(None)
-        else:
-            conn = libvirt.open(None)
-        if conn == None:
-            msg = "Failed to connect to QEMU."
-            raise RuntimeError(msg)
-        return conn
+        return connection.get_connection(self.sandbox.libvirt_uri, readonly)
 
     def _get_domain(self, readonly=True):
         conn = self._get_conn(readonly)
-        return conn.lookupByName(self.name)
+        return conn.lookupByName(self.domain_name)
+
+    def _get_state(self):
+        """Returns the libvirt state code for the node's domain, or None if
+        the domain does not exist, from the bulk host state snapshot.
+        """
+        return states.get_states(self.sandbox.libvirt_uri).domain_state(
+            self.domain_name)
 
     def exists(self):
         return os.path.exists(self.conf_path)
 
     def started(self):
+        """Returns True if the node's domain exists, whether its guest is
+        running or paused.
+        """
         try:
-            dom = self._get_domain()
-            return dom.info()[0] == libvirt.VIR_DOMAIN_RUNNING
+            return self._get_state() in (libvirt.VIR_DOMAIN_RUNNING,
+                                         libvirt.VIR_DOMAIN_BLOCKED,
+                                         libvirt.VIR_DOMAIN_PAUSED)
         except:
             return False
 
+    def paused(self):
+        try:
+            return self._get_state() == libvirt.VIR_DOMAIN_PAUSED
+        except:
+            return False
+
+    def wait_for(self, state, timeout=None):
+        """Blocks until the node's domain is in the supplied state, as
+        reported by libvirt's domain events rather than by polling.
+
+        :param state: libvirt domain state code. A node without a domain is
+                      in VIR_DOMAIN_SHUTOFF.
+        :param timeout: Optional number of seconds to wait.
+        :raises RuntimeError if the domain does not reach the state within
+                the timeout.
+        """
+        watcher = events.get_watcher(self.sandbox.libvirt_uri)
+        watcher.wait_for(self.domain_name, state, timeout=timeout)
+
     def get_info(self):
         return {
             'uuid': self.uuid,
             'name': self.name,
+            'domain_name': self.domain_name,
             'image': self.image.name,
+            'image_path': self.image_path,
             'resources': self.resources,
             'services': self.services,
+            'start_after': self.start_after,
+            'device_profile': self.device_profile,
+            'disk': self.disk_settings,
+            'nested_virt_default': self.nested_virt_default,
         }
 
-    def create(self, node_conf):
-        """Define the virtual machine if it isn't already defined using
-        the node configuration block from a template definition."""
+    @property
+    def data_disk_paths(self):
+        """Paths of the node's blank data disks, one for each size after the
+        boot disk's in its disk_gb.
+        """
+        sizes = capacity.get_disk_sizes_gb(self.resources)
+        return [os.path.join(self.node_dir, 'data{0}.qcow2'.format(i))
+                for i in range(1, len(sizes))]
+
+    def check(self, node_conf, device_profile=devices.DEFAULT_PROFILE,
+              disk_settings=None):
+        """Validates the node configuration block from a template definition
+        without creating anything.
+
+        :param device_profile: The template's device profile, used unless
+                               the node configuration block names another.
+        :param disk_settings: The template's disk settings, which the node
+                              configuration block's disk settings override.
+        :raises RuntimeError if the node is already defined or a setting is
+                invalid or cannot be satisfied by the host.
+        :returns tuple of the node's device profile and disk settings.
+        """
         if self.exists():
             msg = "The node with name {0} is already defined."
             msg = msg.format(self.name)
             raise RuntimeError(msg)
 
+        device_profile = node_conf.get('device_profile', device_profile)
+        devices.check_profile(device_profile)
+        disk_settings = dict(disk_settings or {})
+        disk_settings.update(node_conf.get('disk') or {})
+        devices.check_disk_settings('node {0}'.format(self.name),
+                                    disk_settings)
+        self._check_disks(node_conf['resources'], device_profile)
+        self._check_cpu(node_conf['resources'])
+        self._check_memory(node_conf['resources'])
+        return device_profile, disk_settings
+
+    def create(self, node_conf, device_profile=devices.DEFAULT_PROFILE,
+               disk_settings=None):
+        """Define the virtual machine if it isn't already defined using
+        the node configuration block from a template definition.
+
+        :param device_profile: The template's device profile, used unless
+                               the node configuration block names another.
+        :param disk_settings: The template's disk settings, which the node
+                              configuration block's disk settings override.
+        :raises RuntimeError if the node configuration is invalid. See
+                check().
+        """
+        device_profile, disk_settings = self.check(
+            node_conf, device_profile=device_profile,
+            disk_settings=disk_settings)
+
         os.mkdir(self.node_dir, 0755)
 
-        self.resources = node_conf['resources']
+        self.resources = Node._get_resources(node_conf)
         self.services = node_conf['services']
+        # Recorded apart from the resources, so that a node only requires
+        # nested virtualization if its template asked for it.
+        self.nested_virt_default = 'compute' in self.services
+        # Names of other nodes in the sandbox that must be started before,
+        # and stopped after, this one.
+        self.start_after = node_conf.get('start_after', [])
+        self.device_profile = device_profile
+        self.disk_settings = disk_settings
         self.image = image.Image(self.parsed_args,
                                  node_conf['image'])
         self.uuid = uuid.uuid4().hex
+        # The image build backing the overlay, which must be kept in the
+        # image cache for as long as the node exists.
+        self.image_path = self.image.create_overlay(self.disk_path)
+        self._create_data_disks()
+
+        with timing.span('node.write_conf', node=self.name):
+            with open(self.conf_path, 'wb') as conf_file:
+                conf_file.write(yaml.safe_dump(self.get_info(),
+                                               default_flow_style=False))
+
+    def _check_disks(self, resources, device_profile):
+        """
+        :raises RuntimeError if the disk_gb in the node's resources is not a
+                size in GB or a list of sizes, or names more disks than the
+                bus of the node's device profile takes.
+        """
+        sizes = capacity.get_disk_sizes_gb(resources)
+        if not sizes or not all(isinstance(s, six.integer_types) and s > 0
+                                for s in sizes):
+            msg = ("Node {0} disk_gb must be a size in GB or a list of "
+                   "sizes, the boot disk's first.")
+            raise RuntimeError(msg.format(self.name))
+        max_disks = devices.PROFILES[device_profile]['max_disks']
+        if len(sizes) > max_disks:
+            msg = ("Node {0} has {1} disks, but the {2} device profile "
+                   "takes at most {3}.")
+            raise RuntimeError(msg.format(self.name, len(sizes),
+                                          device_profile, max_disks))
+
+    def _create_data_disks(self):
+        """Creates the node's blank data disks.
+
+        :raises RuntimeError if qemu-img fails.
+        """
+        sizes = capacity.get_disk_sizes_gb(self.resources)[1:]
+        for path, size_gb in zip(self.data_disk_paths, sizes):
+            cmd = (
+                'qemu-img', 'create', '-q',
+                '-f', 'qcow2',
+                path, '{0}G'.format(size_gb),
+            )
+            try:
+                with timing.span('qemu-img create', path=path):
+                    helpers.execute(*cmd)
+            except subprocess.CalledProcessError as err:
+                raise RuntimeError(err)
+
+    @staticmethod
+    def _get_cpu_mode(resources, default=DEFAULT_CPU_MODE):
+        """Returns the CPU mode from a node's resources. Naming a cpu_model
+        implies the custom mode.
+
+        :param default: The mode of nodes whose resources set neither.
+        """
+        if resources.get('cpu_model'):
+            return resources.get('cpu_mode', Node.CPU_MODE_CUSTOM)
+        return resources.get('cpu_mode', default)
+
+    @staticmethod
+    def _get_resources(node_conf):
+        """Returns the resources of a node configuration block from a
+        template definition with the CPU mode made explicit, so that
+        changing its default later does not change existing nodes.
+        """
+        resources = dict(node_conf['resources'])
+        resources['cpu_mode'] = Node._get_cpu_mode(resources)
+        return resources
+
+    def _check_cpu(self, resources):
+        """
+        :raises RuntimeError if the CPU settings in the node's resources are
+                invalid or name a CPU model the host does not know.
+        """
+        cpu_model = resources.get('cpu_model')
+        cpu_mode = Node._get_cpu_mode(resources)
+        if cpu_mode not in Node.CPU_MODES:
+            msg = "Invalid cpu_mode {0} for node {1}. Valid modes are: {2}."
+            msg = msg.format(cpu_mode, self.name, ', '.join(Node.CPU_MODES))
+            raise RuntimeError(msg)
+        cpu_policy = resources.get('cpu_policy', cpupin.DEFAULT_POLICY)
+        if cpu_policy not in cpupin.POLICIES:
+            msg = ("Invalid cpu_policy {0} for node {1}. Valid policies "
+                   "are: {2}.")
+            msg = msg.format(cpu_policy, self.name,
+                             ', '.join(cpupin.POLICIES))
+            raise RuntimeError(msg)
+        if cpu_mode != Node.CPU_MODE_CUSTOM:
+            return
+        if not cpu_model:
+            msg = "Node {0} has cpu_mode custom but no cpu_model."
+            raise RuntimeError(msg.format(self.name))
+        known_models = self._get_conn().getCPUModelNames(devices.ARCH)
+        if cpu_model not in known_models:
+            msg = "Unknown cpu_model {0} for node {1}."
+            raise RuntimeError(msg.format(cpu_model, self.name))
+
+    @staticmethod
+    def _get_hugepage_size_kib(resources):
+        """Returns the hugepage size, in KiB, from the hugepages setting in a
+        node's resources, or None if the node does not use hugepages. The
+        setting is either `true` or a size such as 2M or 1G.
+
+        :raises RuntimeError if the size cannot be parsed.
+        """
+        value = resources.get('hugepages')
+        if value is None or value is False:
+            return None
+        if value is True:
+            return Node.DEFAULT_HUGEPAGE_SIZE_KIB
+        text = str(value).strip().upper().rstrip('B').rstrip('I')
+        multipliers = {'K': 1, 'M': 1024, 'G': 1024 * 1024}
+        multiplier = multipliers.get(text[-1:], 1)
+        if text[-1:] in multipliers:
+            text = text[:-1]
+        try:
+            return int(text) * multiplier
+        except ValueError:
+            msg = "Invalid hugepages size {0}. Use e.g. 2M or 1G."
+            raise RuntimeError(msg.format(value))
+
+    def _check_memory(self, resources):
+        """Validates the node's memory placement settings against the host's
+        NUMA topology and hugepage configuration.
+
+        :raises RuntimeError if a setting is invalid or the host cannot
+                satisfy it.
+        """
+        memory_kib = resources['ram_mb'] * 1024
+        page_kib = Node._get_hugepage_size_kib(resources)
+        numa_node = resources.get('numa_node')
+        guest_numa_nodes = resources.get('guest_numa_nodes')
+
+        if guest_numa_nodes is not None:
+            if not 1 <= guest_numa_nodes <= resources['vcpu']:
+                msg = ("Node {0} has guest_numa_nodes {1}, which must be "
+                       "between 1 and its vcpu count {2}.")
+                msg = msg.format(self.name, guest_numa_nodes,
+                                 resources['vcpu'])
+                raise RuntimeError(msg)
+            if resources['ram_mb'] % guest_numa_nodes:
+                msg = ("Node {0} ram_mb {1} cannot be split evenly across "
+                       "{2} guest NUMA nodes.")
+                msg = msg.format(self.name, resources['ram_mb'],
+                                 guest_numa_nodes)
+                raise RuntimeError(msg)
+
+        if page_kib is None and numa_node is None:
+            return
+
+        caps = host.get_capabilities(self.sandbox.libvirt_uri)
+        cells = None
+        if numa_node is not None:
+            if numa_node not in caps.numa_cells:
+                msg = ("Node {0} has numa_node {1}, but the host's NUMA "
+                       "nodes are: {2}.")
+                msg = msg.format(self.name, numa_node,
+                                 ', '.join(str(c) for c in
+                                           sorted(caps.numa_cells)))
+                raise RuntimeError(msg)
+            cell_kib = caps.numa_cells[numa_node]['memory_kib']
+            if memory_kib > cell_kib:
+                msg = ("Node {0} needs {1} MB of memory but host NUMA node "
+                       "{2} only has {3} MB.")
+                msg = msg.format(self.name, resources['ram_mb'], numa_node,
+                                 cell_kib // 1024)
+                raise RuntimeError(msg)
+            cells = [numa_node]
+
+        if page_kib is not None:
+            if page_kib not in caps.hugepage_sizes_kib:
+                msg = ("Node {0} uses {1} KiB hugepages, which the host does "
+                       "not support. Supported sizes (KiB): {2}.")
+                msg = msg.format(self.name, page_kib,
+                                 ', '.join(str(p) for p in
+                                           caps.hugepage_sizes_kib) or
+                                 'none')
+                raise RuntimeError(msg)
+            cell_count = guest_numa_nodes or 1
+            if (memory_kib // cell_count) % page_kib:
+                msg = ("Node {0} memory per guest NUMA node must be a "
+                       "multiple of its {1} KiB hugepage size.")
+                raise RuntimeError(msg.format(self.name, page_kib))
+            needed = memory_kib // page_kib
+            configured = caps.configured_pages(page_kib, cells)
+            if configured < needed:
+                where = 'the host'
+                if cells:
+                    where = 'host NUMA node {0}'.format(numa_node)
+                msg = ("Node {0} needs {1} hugepages of {2} KiB but only {3} "
+                       "are configured on {4}.")
+                msg = msg.format(self.name, needed, page_kib, configured,
+                                 where)
+                raise RuntimeError(msg)
+
+    @property
+    def memory_kib(self):
+        return self.resources['ram_mb'] * 1024
+
+    def _get_memory_xml(self):
+        """Returns the XML for the node's memory backing, locking and host
+        NUMA placement.
+        """
+        xml_texts = []
+        backing = []
+        page_kib = Node._get_hugepage_size_kib(self.resources)
+        if page_kib is not None:
+            backing.append(
+                "<hugepages><page size='{0}' unit='KiB'/></hugepages>".format(
+                    page_kib))
+        if self.resources.get('mem_lock'):
+            backing.append("<locked/>")
+            # QEMU refuses to lock memory without a hard limit to cap it.
+            xml_texts.append(
+                "<memtune><hard_limit unit='KiB'>{0}</hard_limit></memtune>"
+                .format(self.memory_kib + Node.MEM_LOCK_OVERHEAD_KIB))
+        if backing:
+            xml_texts.append(
+                "<memoryBacking>{0}</memoryBacking>".format(''.join(backing)))
+
+        numa_node = self.resources.get('numa_node')
+        if numa_node is not None:
+            xml_texts.append(
+                "<numatune><memory mode='strict' nodeset='{0}'/></numatune>"
+                .format(numa_node))
+        return "\n".join(xml_texts)
+
+    @property
+    def cpu_policy(self):
+        return self.resources.get('cpu_policy', cpupin.DEFAULT_POLICY)
 
-        with open(self.conf_path, 'wb') as conf_file:
-            conf_file.write(yaml.dump(self.get_info(),
-                                      default_flow_style=False))
+    def _get_vcpu_xml(self):
+        """Returns the XML for the node's vCPUs, which float over the CPUs of
+        the node's host NUMA node if it has one.
+        """
+        vcpus = self.resources['vcpu']
+        numa_node = self.resources.get('numa_node')
+        if self.cpu_pins is not None:
+            # Placement is set per vCPU by <cputune>.
+            return "<vcpu placement='static'>{0}</vcpu>".format(vcpus)
+        if numa_node is None:
+            return "<vcpu>{0}</vcpu>".format(vcpus)
+        caps = host.get_capabilities(self.sandbox.libvirt_uri)
+        cpuset = host.format_cpuset(caps.numa_cells[numa_node]['cpus'])
+        return "<vcpu placement='static' cpuset='{0}'>{1}</vcpu>".format(
+            cpuset, vcpus)
+
+    def _get_cputune_xml(self):
+        """Returns the XML pinning each vCPU, and the emulator threads, to the
+        host CPUs assigned to the node.
+        """
+        if self.cpu_pins is None:
+            return ''
+        pins = [
+            "<vcpupin vcpu='{0}' cpuset='{1}'/>".format(
+                vcpu, host.format_cpuset(self.cpu_pins.vcpu_cpus(vcpu)))
+            for vcpu in range(self.resources['vcpu'])
+        ]
+        pins.append("<emulatorpin cpuset='{0}'/>".format(
+            host.format_cpuset(self.cpu_pins.emulator_cpus)))
+        return "<cputune>{0}</cputune>".format(''.join(pins))
+
+    def _get_guest_numa_xml(self):
+        """Returns the XML for the guest NUMA topology, with the node's vCPUs
+        and memory split evenly across the guest NUMA nodes.
+        """
+        cell_count = self.resources.get('guest_numa_nodes')
+        if not cell_count:
+            return ''
+        vcpus = self.resources['vcpu']
+        cells = []
+        first = 0
+        for idx in range(cell_count):
+            count = vcpus // cell_count + (1 if idx < vcpus % cell_count
+                                           else 0)
+            cells.append(
+                "<cell id='{0}' cpus='{1}' memory='{2}' unit='KiB'/>".format(
+                    idx, host.format_cpuset(range(first, first + count)),
+                    self.memory_kib // cell_count))
+            first += count
+        return "<numa>{0}</numa>".format(''.join(cells))
+
+    @property
+    def nested_virt(self):
+        """Whether the node's guest gets hardware virtualization, so it can
+        run KVM guests itself. New compute nodes have it unless their
+        template turns it off. Nodes created before the setting existed do
+        not.
+        """
+        return self.resources.get('nested_virt', self.nested_virt_default)
+
+    @property
+    def nested_virt_required(self):
+        """Whether the node's resources explicitly ask for nested
+        virtualization, in which case the node is not started on a host
+        without it.
+        """
+        return bool(self.resources.get('nested_virt'))
+
+    def _get_cpu_xml(self):
+        cpu_model = self.resources.get('cpu_model')
+        # Nodes created before CPU modes existed get the hypervisor's
+        # default CPU.
+        cpu_mode = Node._get_cpu_mode(self.resources, default=None)
+        if cpu_mode is None:
+            numa_xml = self._get_guest_numa_xml()
+            return "<cpu>{0}</cpu>".format(numa_xml) if numa_xml else ''
+
+        features = []
+        if (self.nested_virt and
+                cpu_mode != Node.CPU_MODE_HOST_PASSTHROUGH and
+                host.nested_virt_enabled(self.sandbox.libvirt_uri)
+                is not False):
+            # host-passthrough already exposes every feature of the host CPU.
+            # A host without nested KVM cannot give the guest the feature,
+            # so nodes that merely default to nested virtualization start
+            # without it there. See Sandbox.start().
+            caps = host.get_capabilities(self.sandbox.libvirt_uri)
+            if caps.virt_feature is not None:
+                features.append(
+                    "<feature policy='require' name='{0}'/>".format(
+                        caps.virt_feature))
+
+        features.append(self._get_guest_numa_xml())
+
+        if cpu_mode == Node.CPU_MODE_CUSTOM:
+            return """
+<cpu mode='custom' match='exact'>
+    <model fallback='forbid'>{0}</model>
+    {1}
+</cpu>
+""".format(cpu_model, "\n".join(features))
+        return """
+<cpu mode='{0}'>
+    {1}
+</cpu>
+""".format(cpu_mode, "\n".join(features))
+
+    @property
+    def network_names(self):
+        """Names of the libvirt networks the node has a NIC on, in the order
+        of its NICs, which is that of the sandbox's networks.
+        """
+        return [net.libvirt_name for net in self.sandbox.networks]
+
+    def get_mac_address(self, network_name):
+        """Returns the MAC address of the node's NIC on the named libvirt
+        network. It is derived from the node's UUID, so it is the same every
+        time the node is started and DHCP leases can be matched to the node.
+        """
+        seed = '{0}-{1}'.format(self.uuid, network_name).encode('utf-8')
+        digest = bytearray(hashlib.md5(seed).digest())
+        # 52:54:00 is the prefix QEMU and libvirt use for guest NICs.
+        return '52:54:00:{0:02x}:{1:02x}:{2:02x}'.format(*digest[:3])
 
     def _get_xml(self):
-        net_xml_texts = []
+        profile = self.device_profile
+        iothreads = devices.get_iothreads(profile, self.disk_settings)
+        dev_xml_texts = [devices.get_controller_xml(
+            profile, iothread=1 if iothreads else None)]
+        disk_paths = [self.disk_path] + self.data_disk_paths
+        for index, disk_path in enumerate(disk_paths):
+            # Disks are spread over the I/O threads, which are numbered
+            # from 1.
+            dev_xml_texts.append(devices.get_disk_xml(
+                profile, disk_path, index=index,
+                settings=self.disk_settings,
+                iothread=index % iothreads + 1 if iothreads else None))
         for net in self.sandbox.networks:
-            net_xml_texts.append("""
-<interface type='network'>
-    <source network='{0}'/>
-    <model type='e1000'/>
-</interface>
-""".format(net.slug))
-        net_xml_text = "\n".join(net_xml_texts)
+            dev_xml_texts.append(devices.get_interface_xml(
+                profile, net.libvirt_name,
+                mac_address=self.get_mac_address(net.libvirt_name),
+                mtu=net.mtu,
+                queues=net.get_queues(self.resources['vcpu']),
+                bandwidth=net.interface_bandwidth))
+        dev_xml_texts.append(devices.get_misc_xml(profile))
         conf = {
-            'name': self.name,
+            'name': self.domain_name,
             'uuid': self.uuid,
-            'image_path': self.image.image_path,
-            'vcpus': self.resources['vcpu'],
-            'memory_bytes': self.resources['ram_mb'] * 1024,
-            'net_xml': net_xml_text,
+            'arch': devices.ARCH,
+            'cpu_xml': self._get_cpu_xml(),
+            'vcpu_xml': self._get_vcpu_xml(),
+            'cputune_xml': self._get_cputune_xml(),
+            'iothreads_xml': ("<iothreads>{0}</iothreads>".format(iothreads)
+                              if iothreads else ''),
+            'memory_kib': self.memory_kib,
+            'memory_xml': self._get_memory_xml(),
+            'dev_xml': "\n".join(dev_xml_texts),
         }
         xml_text = """
 <domain type='kvm'>
     <uuid>{uuid}</uuid>
     <name>{name}</name>
-    <vcpu>{vcpus}</vcpu>
-    <memory>{memory_bytes}</memory>
+    {vcpu_xml}
+    {iothreads_xml}
+    {cputune_xml}
+    {cpu_xml}
+    <memory unit='KiB'>{memory_kib}</memory>
+    {memory_xml}
     <os>
-        <type arch="i686">hvm</type>
+        <type arch='{arch}'>hvm</type>
     </os>
     <devices>
-        <disk type='file' device='disk'>
-            <source file='{image_path}'/>
-            <target dev='hda'/>
-        </disk>
-        <interface type='network'>
-            <source network='default'/>
-        </interface>
+        {dev_xml}
         <serial type='pty'>
             <target port='0'/>
         </serial>
@@ -168,55 +692,164 @@ class Node(object):
             return Node.STATUS_ERROR
         if not self.exists():
             return Node.STATUS_UNDEFINED
-        state_code_map = {
-            libvirt.VIR_DOMAIN_NOSTATE: Node.STATUS_UNDEFINED,
-            libvirt.VIR_DOMAIN_RUNNING: Node.STATUS_UP,
-            libvirt.VIR_DOMAIN_BLOCKED: Node.STATUS_UP,
-            libvirt.VIR_DOMAIN_PAUSED: Node.STATUS_UP,
-            libvirt.VIR_DOMAIN_SHUTDOWN: Node.STATUS_DOWN,
-            libvirt.VIR_DOMAIN_SHUTOFF: Node.STATUS_DOWN,
-            libvirt.VIR_DOMAIN_CRASHED: Node.STATUS_ERROR,
-            libvirt.VIR_DOMAIN_PMSUSPENDED: Node.STATUS_DOWN,
-        }
         try:
-            dom = self._get_domain()
-            return state_code_map[dom.info()[0]]
-        except libvirt.libvirtError as err:
-            err_code = err.get_error_code()
-            if err_code == libvirt.VIR_ERR_NO_DOMAIN:
-                # The domains for sandbox nodes are temporal, so there's
-                # no real mapping of "no domain found" other than the
-                # node should be considered not started.
-                return Node.STATUS_DOWN
-            else:
-                return Node.STATUS_ERROR
+            state = self._get_state()
         except Exception as err:
             self.LOG.error(err)
+            self.error = err
             return Node.STATUS_ERROR
+        if state is None:
+            if self.suspended():
+                return Node.STATUS_SUSPENDED
+            # The domains for sandbox nodes are temporal, so there's
+            # no real mapping of "no domain found" other than the
+            # node should be considered not started.
+            return Node.STATUS_DOWN
+        return Node.get_state_code_map().get(state, Node.STATUS_ERROR)
+
+    def suspended(self):
+        """Returns True if the node's guest state is saved to disk."""
+        return os.path.exists(self.save_path)
 
     def start(self):
+        """Starts the node, restoring its saved guest state if the node is
+        suspended and unpausing its guest if the node is paused.
+        """
         if not self.exists():
             msg = "A node with name {0} does not exist."
             msg = msg.format(self.name)
             raise RuntimeError(msg)
 
+        if self.paused():
+            self.started_at = time.time()
+            dom = self._get_domain(readonly=False)
+            with timing.span('libvirt.resume', node=self.name):
+                dom.resume()
+            states.invalidate(self.sandbox.libvirt_uri)
+            return
+
         if self.started():
             return
 
+        if self.suspended():
+            self._restore()
+            return
+
+        if not os.path.exists(self.disk_path):
+            # Nodes created before per-node overlays existed booted the base
+            # image directly.
+            self.image_path = self.image.create_overlay(self.disk_path)
+
         conn = self._get_conn(readonly=False)
-        dom = conn.createXML(self._get_xml(), 0)
+        with timing.span('node.get_xml', node=self.name):
+            xml = self._get_xml()
+        self.started_at = time.time()
+        with timing.span('libvirt.createXML', node=self.name):
+            dom = conn.createXML(xml, 0)
+        states.invalidate(self.sandbox.libvirt_uri)
         if dom == None:
             msg = "Failed to start guest {0}"
             msg = msg.format(self.name)
             raise RuntimeError(msg)
-        conn.close()
+
+    def pause(self):
+        """Stops scheduling the guest's vCPUs, keeping its memory resident
+        on the host, so it continues at once when the node is started.
+        """
+        if not self.exists():
+            msg = "A node with name {0} does not exist."
+            msg = msg.format(self.name)
+            raise RuntimeError(msg)
+
+        if not self.started() or self.paused():
+            return
+
+        dom = self._get_domain(readonly=False)
+        with timing.span('libvirt.suspend', node=self.name):
+            dom.suspend()
+        states.invalidate(self.sandbox.libvirt_uri)
+
+    def suspend(self):
+        """Saves the guest's memory and device state to the node dir and
+        removes the domain. The next start() restores the guest exactly as
+        it was.
+        """
+        if not self.exists():
+            msg = "A node with name {0} does not exist."
+            msg = msg.format(self.name)
+            raise RuntimeError(msg)
+
+        if not self.started():
+            return
+
+        dom = self._get_domain(readonly=False)
+        flags = libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE
+        tmp_path = self.save_path + '.tmp'
+        image_format = conf.get_host_config(
+            self.parsed_args.state_dir)['suspend']['image_format']
+        format_param = getattr(libvirt,
+                               'VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT', None)
+        try:
+            with timing.span('libvirt.save', node=self.name):
+                if format_param is not None and hasattr(dom, 'saveParams'):
+                    dom.saveParams({
+                        libvirt.VIR_DOMAIN_SAVE_PARAM_FILE: tmp_path,
+                        format_param: image_format,
+                    }, flags)
+                else:
+                    # Older libvirt compresses saves as set by
+                    # save_image_format in qemu.conf.
+                    dom.saveFlags(tmp_path, None, flags)
+        except Exception:
+            # A save that failed part way, e.g. on a full disk, leaves an
+            # image as large as the guest's memory behind.
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        os.rename(tmp_path, self.save_path)
+        states.invalidate(self.sandbox.libvirt_uri)
+
+    def _restore(self):
+        conn = self._get_conn(readonly=False)
+        # The domain XML is regenerated so the restored guest gets the host
+        # CPUs assigned to it now rather than those it had when suspended.
+        with timing.span('node.get_xml', node=self.name):
+            xml = self._get_xml()
+        saved_xml = conn.saveImageGetXMLDesc(self.save_path, 0)
+        network_names = self.network_names
+        if (network_names and
+                self.get_mac_address(network_names[0]) not in saved_xml):
+            # Saved before NICs had fixed MAC addresses and were attached to
+            # the sandbox's own networks. libvirt does not allow the NICs to
+            # change across a restore.
+            xml = None
+        flags = (libvirt.VIR_DOMAIN_SAVE_RUNNING |
+                 libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE)
+        self.started_at = time.time()
+        try:
+            with timing.span('libvirt.restore', node=self.name):
+                conn.restoreFlags(self.save_path, xml, flags)
+        except libvirt.libvirtError as err:
+            msg = ("Failed to restore node {0} from {1}: {2}. Stop the "
+                   "sandbox to discard the saved state and cold boot the "
+                   "node instead.").format(self.name, self.save_path, err)
+            raise RuntimeError(msg)
+        finally:
+            states.invalidate(self.sandbox.libvirt_uri)
+        os.unlink(self.save_path)
 
     def stop(self):
+        """Stops the node, discarding its saved guest state if the node is
+        suspended.
+        """
         if not self.exists():
             msg = "A node with name {0} does not exist."
             msg = msg.format(self.name)
             raise RuntimeError(msg)
 
+        if self.suspended():
+            os.unlink(self.save_path)
+
         if not self.started():
             return
 
@@ -225,4 +858,6 @@ class Node(object):
             msg = "Failed to stop guest {0}"
             msg = msg.format(self.name)
             raise RuntimeError(msg)
-        dom.destroy()
+        with timing.span('libvirt.destroy', node=self.name):
+            dom.destroy()
+        states.invalidate(self.sandbox.libvirt_uri)
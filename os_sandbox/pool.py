@@ -0,0 +1,246 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import copy
+import errno
+import fcntl
+import logging
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+from os_sandbox import capacity
+from os_sandbox import catalog
+from os_sandbox import conf
+from os_sandbox import sandbox
+from os_sandbox import template
+
+LOG = logging.getLogger(__name__)
+
+POOLS_DIRNAME = 'pools'
+
+# A pooled sandbox is recorded in the `pool` setting of its config, with the
+# slug of its template and its state: filling while it is created and
+# booted, and ready once its nodes are paused. Pooled sandboxes are hidden
+# from `sandbox list` until they are checked out.
+STATE_FILLING = 'filling'
+STATE_READY = 'ready'
+
+
+def get_sizes(state_dir):
+    """Returns the target size of each warm pool, keyed by template name."""
+    sizes = conf.get_host_config(state_dir)['warm_pool']['sizes'] or {}
+    return dict((name, int(size)) for name, size in sizes.items())
+
+
+class WarmPool(object):
+    """Sandboxes of a template that are created, booted and paused ahead of
+    time, so that `sandbox checkout` can hand one out at once by renaming it
+    and unpausing its nodes.
+
+    The pool is filled up to its target size by `pool fill`, which checkout
+    starts in the background. Only one process fills a pool at a time.
+    """
+
+    def __init__(self, parsed_args, template_name):
+        """
+        :param parsed_args: Arguments returned from get_parser()
+        :param template_name: Name of the template the pool's sandboxes are
+                              created from.
+        :raises RuntimeError if the template does not exist.
+        """
+        self.parsed_args = parsed_args
+        self.state_dir = parsed_args.state_dir
+        self.template = template.Template(parsed_args, template_name)
+        if not self.template.exists():
+            msg = "No template with name {0} found.".format(template_name)
+            raise RuntimeError(msg)
+        sizes = get_sizes(self.state_dir)
+        self.size = sizes.get(template_name,
+                              sizes.get(self.template.slug, 0))
+        self.boot_seconds = conf.get_host_config(
+            self.state_dir)['warm_pool']['boot_seconds']
+        self.catalog = catalog.get_catalog(self.state_dir)
+        self.pools_dir = os.path.join(self.state_dir, POOLS_DIRNAME)
+        self.lock_path = os.path.join(self.pools_dir,
+                                      self.template.slug + '.lock')
+        self.log_path = os.path.join(self.pools_dir,
+                                     self.template.slug + '.log')
+
+    def members(self, state=None):
+        """Returns the pool's sandboxes, oldest first.
+
+        :param state: Only return the sandboxes in this state.
+        """
+        members = []
+        node_confs = self.catalog.get_nodes()
+        for slug, sb_conf in self.catalog.get_sandboxes():
+            pool = sb_conf.get('pool')
+            if not pool or pool['template'] != self.template.slug:
+                continue
+            if state is not None and pool['state'] != state:
+                continue
+            members.append(sandbox.Sandbox(
+                self.parsed_args, sb_conf['full_name'], conf=sb_conf,
+                node_confs=node_confs.get(slug, {})))
+        members.sort(key=lambda sb: sb.pool['created_at'])
+        return members
+
+    def _ensure_pools_dir(self):
+        try:
+            os.mkdir(self.pools_dir, 0755)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    @contextlib.contextmanager
+    def _fill_lock(self):
+        """Yields True if this process holds the pool's fill lock, or False
+        if another process is filling the pool.
+        """
+        self._ensure_pools_dir()
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fill(self, parallel=conf.DEFAULT_PARALLEL):
+        """Creates and boots sandboxes until the pool holds its target size
+        of them, and deletes the oldest ones if it holds more.
+
+        Sandboxes left filling by a process that died are deleted first.
+        Filling stops early if the host lacks the capacity for another
+        sandbox.
+
+        :raises RuntimeError if a sandbox fails to boot.
+        :returns False if another process is already filling the pool,
+                 True otherwise.
+        """
+        with self._fill_lock() as locked:
+            if not locked:
+                LOG.info("The warm pool of template %s is already being "
+                         "filled.", self.template.name)
+                return False
+
+            for sb in self.members(STATE_FILLING):
+                LOG.info("Deleting unfinished pooled sandbox %s.", sb.name)
+                sb.delete(parallel=parallel)
+
+            members = self.members()
+            for sb in members[:max(len(members) - self.size, 0)]:
+                LOG.info("Deleting pooled sandbox %s beyond the pool size.",
+                         sb.name)
+                sb.delete(parallel=parallel)
+
+            request = capacity.get_request(self.template.nodes)
+            for _ in range(self.size - len(members)):
+                shortfalls = capacity.Capacity(
+                    self.state_dir,
+                    self.parsed_args.libvirt_uri).shortfalls(request)
+                if shortfalls:
+                    LOG.warning("Stopped filling the warm pool of template "
+                                "%s, the host lacks the capacity for "
+                                "another sandbox: %s.", self.template.name,
+                                '; '.join(shortfalls))
+                    break
+                self._add_member(parallel)
+            return True
+
+    def _add_member(self, parallel):
+        name = 'pool-{0}-{1}'.format(self.template.slug, uuid.uuid4().hex[:8])
+        args = copy.copy(self.parsed_args)
+        args.template = self.template.name
+        sb = sandbox.Sandbox(args, name)
+        pool = {
+            'template': self.template.slug,
+            'state': STATE_FILLING,
+            'created_at': time.time(),
+        }
+        sb.create(pool=pool)
+        try:
+            LOG.info("Booting pooled sandbox %s.", name)
+            sb.start(parallel=parallel)
+            results = sb.wait_ready(timeout=self.boot_seconds)
+            for r in results:
+                LOG.info("Node %s of pooled sandbox %s was ready after "
+                         "%.1f seconds.", r.node.name, name, r.elapsed())
+            sb.pause(parallel=parallel)
+            sb.update_conf({'pool': dict(pool, state=STATE_READY)})
+        except Exception:
+            LOG.error("Failed to boot pooled sandbox %s, deleting it.", name)
+            sb.delete(parallel=parallel)
+            raise
+        LOG.info("Pooled sandbox %s is ready.", name)
+        return sb
+
+    def fill_async(self):
+        """Starts `pool fill` for the pool in a background process, unless
+        the pool is already full, and returns at once. The process's output
+        goes to the pool's log file in the pools dir.
+        """
+        if len(self.members()) >= self.size:
+            return
+        self._ensure_pools_dir()
+        args = [sys.executable, '-m', 'os_sandbox.main', 'pool', 'fill',
+                self.template.name, '--state-dir', self.state_dir]
+        if self.parsed_args.libvirt_uri:
+            args.extend(['--libvirt-uri', self.parsed_args.libvirt_uri])
+        with open(os.devnull, 'rb') as devnull:
+            with open(self.log_path, 'ab') as log_file:
+                # A new session, so the fill outlives the calling command
+                # and is not interrupted along with it.
+                subprocess.Popen(args, stdin=devnull, stdout=log_file,
+                                 stderr=subprocess.STDOUT, close_fds=True,
+                                 preexec_fn=os.setsid)
+        LOG.debug("Refilling the warm pool of template %s in the "
+                  "background. See %s.", self.template.name, self.log_path)
+
+    def checkout(self, name, parallel=conf.DEFAULT_PARALLEL):
+        """Takes the oldest ready sandbox out of the pool, renames it and
+        unpauses its nodes, then refills the pool in the background.
+
+        :param name: Name to give the sandbox.
+        :raises RuntimeError if a sandbox with the name already exists or
+                the pool has no ready sandbox.
+        :returns the checked out Sandbox.
+        """
+        # Pooled sandboxes are claimed in a catalog transaction, so
+        # concurrent checkouts never hand out the same one.
+        with self.catalog.transaction():
+            ready = self.members(STATE_READY)
+            if ready:
+                sb = ready[0].rename(name, changes={'pool': None})
+
+        if not ready:
+            if not self.size:
+                msg = ("Template {0} has no warm pool. Set its size in the "
+                       "warm_pool host config, or use `sandbox create`.")
+                raise RuntimeError(msg.format(self.template.name))
+            self.fill_async()
+            msg = ("The warm pool of template {0} has no ready sandbox yet. "
+                   "It is being refilled.").format(self.template.name)
+            raise RuntimeError(msg)
+
+        sb.start(parallel=parallel)
+        self.fill_async()
+        return sb
@@ -0,0 +1,269 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import logging
+import os
+import select
+import socket
+import subprocess
+import time
+
+from os_sandbox import connection
+from os_sandbox import events
+from os_sandbox import helpers
+
+libvirt = helpers.lazy_import('libvirt')
+
+LOG = logging.getLogger(__name__)
+
+# A node is ready once it has a DHCP lease and its SSH port is open, and,
+# when cloud-init completion is also checked for, once cloud-init finished.
+# Each check is only made once the ones before it are done.
+CHECK_LEASE = 'lease'
+CHECK_SSH = 'ssh'
+CHECK_CLOUD_INIT = 'cloud-init'
+
+SSH_PORT = 22
+
+# Seconds between checks of the nodes that are not ready yet.
+TICK_SECONDS = 1.0
+
+# Written by cloud-init when it has finished running in the guest.
+CLOUD_INIT_FINISHED_PATH = '/var/lib/cloud/instance/boot-finished'
+
+# The images are built with the local-config element, which authorizes the
+# building user's SSH keys for root.
+SSH_ARGS = ('ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=5',
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null', '-o', 'LogLevel=ERROR')
+
+
+class NodeReadiness(object):
+    """How far a node is in booting, with the times at which it got each
+    check done.
+    """
+
+    def __init__(self, node, started_at, checks):
+        self.node = node
+        self.started_at = started_at
+        self.checks = checks
+        self.address = None
+        self.done_at = {}
+        self.error = None
+        self._cloud_init_probe = None
+
+    @property
+    def ready(self):
+        return all(c in self.done_at for c in self.checks)
+
+    @property
+    def ready_at(self):
+        if not self.ready:
+            return None
+        return max(self.done_at.values())
+
+    def elapsed(self, check=None):
+        """Returns the seconds from the node's start until the supplied check
+        was done, or until the node was ready if no check is supplied, or
+        None if it has not been done yet.
+        """
+        done_at = self.ready_at if check is None else self.done_at.get(check)
+        if done_at is None:
+            return None
+        return done_at - self.started_at
+
+    def pending(self):
+        """Returns the checks that are not done yet."""
+        return [c for c in self.checks if c not in self.done_at]
+
+
+class ReadinessWaiter(object):
+    """Waits for all of a sandbox's running nodes to finish booting at once.
+
+    Each tick, DHCP leases are fetched with one call per network and matched
+    to the nodes by their MAC addresses. The SSH ports of all nodes with an
+    address are then probed with non-blocking connects that share the rest
+    of the tick. A node whose domain stops or crashes fails at once, which
+    is known from libvirt events without querying libvirtd.
+    """
+
+    def __init__(self, sandbox, cloud_init=False, tick=TICK_SECONDS):
+        """
+        :param sandbox: The Sandbox whose nodes to wait for.
+        :param cloud_init: Whether nodes are only ready once cloud-init has
+                           finished in them, which is checked over SSH.
+        :param tick: Seconds between checks.
+        """
+        self.sandbox = sandbox
+        self.checks = (CHECK_LEASE, CHECK_SSH)
+        if cloud_init:
+            self.checks += (CHECK_CLOUD_INIT,)
+        self.tick = tick
+        self.watcher = events.get_watcher(sandbox.libvirt_uri)
+
+    def _get_leases(self, network_names):
+        """Returns a dict of IPv4 addresses keyed by MAC address from the DHCP
+        leases on the named networks.
+        """
+        conn = connection.get_connection(self.sandbox.libvirt_uri)
+        addresses = {}
+        for name in network_names:
+            try:
+                leases = conn.networkLookupByName(name).DHCPLeases()
+            except libvirt.libvirtError as err:
+                LOG.debug("Failed to get DHCP leases of network %s: %s",
+                          name, err)
+                continue
+            for lease in leases:
+                if lease.get('type') == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    addresses[lease['mac'].lower()] = lease['ipaddr']
+        return addresses
+
+    def _check_leases(self, pending):
+        waiting = [r for r in pending if CHECK_LEASE not in r.done_at]
+        if not waiting:
+            return
+        network_names = set()
+        for r in waiting:
+            network_names.update(r.node.network_names)
+        addresses = self._get_leases(sorted(network_names))
+        now = time.time()
+        for r in waiting:
+            # The first of the node's NICs with a lease is the one its
+            # other checks connect to.
+            for name in r.node.network_names:
+                address = addresses.get(r.node.get_mac_address(name))
+                if address is not None:
+                    r.address = address
+                    r.done_at[CHECK_LEASE] = now
+                    break
+
+    def _check_ssh(self, pending, deadline):
+        """Probes the SSH port of every pending node with an address until
+        all answered or the deadline passed.
+        """
+        probes = {}
+        for r in pending:
+            if r.address is None or CHECK_SSH in r.done_at:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(0)
+            err = sock.connect_ex((r.address, SSH_PORT))
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                probes[sock] = r
+            else:
+                sock.close()
+        try:
+            while probes:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                _r, writable, _x = select.select([], list(probes), [],
+                                                 remaining)
+                if not writable:
+                    break
+                now = time.time()
+                for sock in writable:
+                    r = probes.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        r.done_at[CHECK_SSH] = now
+                    sock.close()
+        finally:
+            for sock in probes:
+                sock.close()
+
+    def _check_cloud_init(self, pending):
+        for r in pending:
+            if CHECK_SSH not in r.done_at or CHECK_CLOUD_INIT in r.done_at:
+                continue
+            probe = r._cloud_init_probe
+            if probe is not None:
+                if probe.poll() is None:
+                    continue
+                r._cloud_init_probe = None
+                if probe.returncode == 0:
+                    r.done_at[CHECK_CLOUD_INIT] = time.time()
+                    continue
+            with open(os.devnull, 'wb') as devnull:
+                r._cloud_init_probe = subprocess.Popen(
+                    SSH_ARGS + ('root@' + r.address, 'test', '-e',
+                                CLOUD_INIT_FINISHED_PATH),
+                    stdin=devnull, stdout=devnull, stderr=devnull)
+
+    def _check_running(self, pending):
+        for r in pending:
+            state = self.watcher.domain_state(r.node.domain_name)
+            if state not in (libvirt.VIR_DOMAIN_RUNNING,
+                             libvirt.VIR_DOMAIN_BLOCKED):
+                r.error = "Node {0} stopped while booting.".format(
+                    r.node.name)
+
+    def wait(self, timeout=None):
+        """Waits for every running node of the sandbox to be ready. Paused
+        nodes are not waited for.
+
+        :param timeout: Optional number of seconds to wait.
+        :raises RuntimeError listing every node that stopped or was not
+                ready within the timeout.
+        :returns list of NodeReadiness, one per node.
+        """
+        now = time.time()
+        deadline = None if timeout is None else now + timeout
+        results = [
+            NodeReadiness(n, n.started_at or now, self.checks)
+            for n in self.sandbox.nodes
+            if n.error is None and n.exists() and n.started() and
+            not n.paused()
+        ]
+        try:
+            while True:
+                pending = [r for r in results
+                           if not r.ready and r.error is None]
+                self._check_running(pending)
+                pending = [r for r in pending if r.error is None]
+                if not pending:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    for r in pending:
+                        r.error = ("Node {0} was not ready within {1} "
+                                   "seconds, waiting for: {2}.").format(
+                                       r.node.name, timeout,
+                                       ', '.join(r.pending()))
+                    break
+
+                tick_end = time.time() + self.tick
+                if deadline is not None:
+                    tick_end = min(tick_end, deadline)
+                self._check_leases(pending)
+                self._check_ssh(pending, tick_end)
+                if CHECK_CLOUD_INIT in self.checks:
+                    self._check_cloud_init(pending)
+                remaining = tick_end - time.time()
+                if remaining > 0:
+                    time.sleep(remaining)
+        finally:
+            for r in results:
+                if r._cloud_init_probe is not None:
+                    if r._cloud_init_probe.poll() is None:
+                        r._cloud_init_probe.kill()
+                    r._cloud_init_probe.wait()
+
+        for r in results:
+            if r.ready:
+                LOG.info("Node %s was ready after %.1f seconds.",
+                         r.node.name, r.elapsed())
+        errors = [r.error for r in results if r.error is not None]
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return results
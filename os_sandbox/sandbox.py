@@ -10,18 +10,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import functools
 import logging
 import os
 import shutil
-import yaml
 
 import slugify
-import netaddr
 
+from os_sandbox import capacity
+from os_sandbox import catalog
+from os_sandbox import conf
+from os_sandbox import cpupin
+from os_sandbox import executor
 from os_sandbox import helpers
+from os_sandbox import host
+from os_sandbox import ipam
 from os_sandbox import template
 from os_sandbox import network
 from os_sandbox import node
+from os_sandbox import readiness
+from os_sandbox import states
+from os_sandbox import timing
+
+yaml = helpers.lazy_import('yaml')
 
 
 class Sandbox(object):
@@ -32,9 +43,23 @@ class Sandbox(object):
     STATUS_ERROR = 'ERROR'
     STATUS_DOWN = 'DOWN'
     STATUS_UP = 'UP'
+    STATUS_SUSPENDED = 'SUSPENDED'
+    STATUS_PAUSED = 'PAUSED'
 
-    def __init__(self, parsed_args, name):
+    def __init__(self, parsed_args, name, conf=None, node_confs=None):
+        """
+        :param parsed_args: Arguments returned from get_parser()
+        :param name: Name of the sandbox.
+        :param conf: The sandbox's config, if already loaded from the state
+                     catalog by the caller.
+        :param node_confs: Dict of the sandbox's node configs keyed by node
+                           name, if already loaded from the state catalog.
+        """
         self.parsed_args = parsed_args
+        self.catalog = catalog.get_catalog(parsed_args.state_dir)
+        # All nodes and networks in the sandbox share the pooled libvirt
+        # connections for this URI. See os_sandbox.connection.
+        self.libvirt_uri = parsed_args.libvirt_uri
         self.name = name
         self.slug = slugify.slugify(helpers.utf8_bytes(name))
         self.sandbox_dir = os.path.join(parsed_args.state_dir,
@@ -43,32 +68,48 @@ class Sandbox(object):
         self.nodes_dir = os.path.join(self.sandbox_dir, 'nodes')
         self.conf_path = os.path.join(self.sandbox_dir, 'config.yaml')
         self.error = None
+        # Prefix of the names of the sandbox's libvirt networks. It is
+        # recorded in the config so that the networks keep their names when
+        # the sandbox is renamed.
+        self.network_prefix = self.slug
         # networks contains a list of network.Network objects that contain CIDR
         # information and are start()ed when the Sandbox is started. Networks,
         # like nodes, not persistent. They are torn down when the sandbox is
-        # torn down or when the sandbox host is restarted.
+        # stopped or when the sandbox host is restarted. Nodes have a NIC on
+        # each network, in the order of this list.
         self.networks = []
         # nodes contains a list of node.Node objects that contain configuration
         # information and are start()ed when the Sandbox is started. Nodes are
         # not persistent; their libvirt XML content is created on-demand when
         # the sandbox is started.
-        if os.path.exists(self.conf_path):
+        if conf is not None or os.path.exists(self.conf_path):
             try:
-                self._fill()
+                self._fill(conf, node_confs)
             except Exception as err:
                 self.error = err
                 raise
 
-    def _fill(self):
-        self.conf = yaml.load(open(self.conf_path, 'rb').read())
+    def _fill(self, conf=None, node_confs=None):
+        if conf is None:
+            conf = self.catalog.get_sandbox(self.slug)
+            if conf is not None:
+                node_confs = self.catalog.get_nodes(self.slug).get(self.slug)
+        if conf is None:
+            conf = yaml.load(open(self.conf_path, 'rb').read())
+        node_confs = node_confs or {}
+        self.conf = conf
         self.full_name = self.conf['full_name']
+        self.network_prefix = self.conf.get('network_prefix', self.slug)
         self.nodes = [
-            node.Node(self, node_info['name'])
+            node.Node(self, node_info['name'],
+                      conf=node_confs.get(node_info['name']))
             for node_info in self.conf['nodes']
         ]
+        network_settings = self.conf.get('network_settings', {})
         self.networks = [
-            network.Network(self, net_name, cidr)
-            for net_name, cidr in self.conf['networks'].items()
+            network.Network(self, net_name, cidr,
+                            settings=network_settings.get(net_name))
+            for net_name, cidr in sorted(self.conf['networks'].items())
         ]
         self.template = template.Template(self.parsed_args,
                                           self.conf['template'])
@@ -76,8 +117,24 @@ class Sandbox(object):
     def exists(self):
         return os.path.exists(self.sandbox_dir)
 
-    def create(self):
-        """Creates the sandbox if it doesn't exist."""
+    @property
+    def pool(self):
+        """Settings of the warm pool the sandbox belongs to, or None if it
+        is not in a pool. See os_sandbox.pool.
+        """
+        return self.conf.get('pool')
+
+    def create(self, wait_for_capacity=None, pool=None):
+        """Creates the sandbox if it doesn't exist.
+
+        :param wait_for_capacity: Optional number of seconds to wait for the
+                                  host to have the disk for the template's
+                                  nodes.
+        :param pool: Settings of the warm pool the sandbox is created for.
+        :raises RuntimeError if the template is invalid or the host lacks
+                the disk for the nodes, in which case nothing is left
+                behind.
+        """
         if self.exists():
             msg = "A sandbox with name {0} already exists.".format(self.name)
             raise RuntimeError(msg)
@@ -87,24 +144,131 @@ class Sandbox(object):
         if not tpl.exists():
             msg = "No template with name {0} found.".format(tpl_name)
             raise RuntimeError(msg)
+        network_settings = self._get_network_settings(tpl)
+        template.check_start_order(tpl_name, tpl.nodes)
+        for node_info in tpl.nodes:
+            node.Node(self, node_info['name']).check(
+                node_info, device_profile=tpl.device_profile,
+                disk_settings=tpl.disk_settings)
 
-        sandboxes = Sandboxes(self.parsed_args)
-        network_cidrs = sandboxes.get_next_available_network_cidrs()
+        with timing.span('sandbox.admit'):
+            capacity.admit(self.parsed_args.state_dir, self.libvirt_uri,
+                           capacity.get_define_request(tpl.nodes),
+                           wait=wait_for_capacity)
 
         os.mkdir(self.sandbox_dir, 0755)
-        os.mkdir(self.nodes_dir, 0755)
+        try:
+            os.mkdir(self.nodes_dir, 0755)
+
+            nodes = self._create_nodes(tpl)
+            node_confs = dict((n['name'], n) for n in nodes)
+
+            # The subnets are allocated, the config written and the sandbox
+            # recorded in one catalog transaction, so a concurrent catalog
+            # rebuild can never see the subnets as unused, and a failure
+            # rolls back the allocation.
+            with self.catalog.transaction():
+                with timing.span('sandbox.allocate_subnets'):
+                    network_cidrs = self._get_allocator().allocate()
+                config = {
+                    'full_name': self.name,
+                    'template': tpl_name,
+                    'networks': network_cidrs,
+                    'network_prefix': self.slug,
+                    'nodes': nodes,
+                }
+                if network_settings:
+                    config['network_settings'] = network_settings
+                if pool is not None:
+                    config['pool'] = pool
+                self._write_conf(config, node_confs)
+        except Exception:
+            shutil.rmtree(self.sandbox_dir, ignore_errors=True)
+            raise
+        self._fill(config, node_confs)
+
+    def _get_network_settings(self, tpl):
+        """Returns the template's settings of the sandbox's networks. They
+        are copied into the sandbox's config so that changing the template
+        does not change the networks of existing sandboxes.
+
+        :raises RuntimeError if the template has settings for a network the
+                host does not allocate, or its settings are not valid.
+        """
+        pools = conf.get_network_pools(self.parsed_args.state_dir)
+        for net_name, settings in tpl.networks.items():
+            if net_name not in pools:
+                msg = ("Template {0} has settings for network {1}, which is "
+                       "not one of the host's networks: {2}.")
+                raise RuntimeError(msg.format(tpl.name, net_name,
+                                              ', '.join(sorted(pools))))
+            network.check_settings(net_name, settings)
+        return dict((net_name, settings)
+                    for net_name, settings in tpl.networks.items()
+                    if settings)
+
+    def _write_conf(self, config, node_confs):
+        with timing.span('sandbox.write_conf'):
+            with open(self.conf_path, 'wb') as conf_file:
+                conf_file.write(yaml.safe_dump(config,
+                                               default_flow_style=False))
+            self.catalog.add_sandbox(self.slug, config, node_confs)
+
+    def _get_node_confs(self):
+        return dict((n.name, n.get_info()) for n in self.nodes
+                    if n.error is None and n.exists())
+
+    def _get_changed_conf(self, changes):
+        config = dict(self.conf)
+        for key, value in changes.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        return config
 
-        nodes = self._create_nodes(tpl)
-        config = {
-            'full_name': self.name,
-            'template': tpl_name,
-            'networks': network_cidrs,
-            'nodes': nodes,
-        }
+    def update_conf(self, changes):
+        """Changes settings in the sandbox's config.
 
-        with open(self.conf_path, 'wb') as conf_file:
-            conf_file.write(yaml.dump(config, default_flow_style=False))
-        self._fill()
+        :param changes: Dict of settings to change. Settings with a value of
+                        None are removed.
+        """
+        config = self._get_changed_conf(changes)
+        with self.catalog.transaction():
+            self._write_conf(config, self._get_node_confs())
+        self.conf = config
+
+    def rename(self, new_name, changes=None):
+        """Moves the sandbox to a new name. Its nodes keep their libvirt
+        domain names, so a running sandbox may be renamed. Running domains
+        keep the overlays they have open, which are found under the new name
+        the next time the nodes are started.
+
+        :param changes: Optional dict of settings to change in the sandbox's
+                        config along with its name. See update_conf().
+        :raises RuntimeError if a sandbox with the new name already exists.
+        :returns the renamed Sandbox.
+        """
+        renamed = Sandbox(self.parsed_args, new_name)
+        if renamed.exists():
+            msg = "A sandbox with name {0} already exists.".format(new_name)
+            raise RuntimeError(msg)
+
+        changes = dict(changes or {}, full_name=new_name)
+        changes.setdefault('network_prefix', self.network_prefix)
+        config = self._get_changed_conf(changes)
+        node_confs = self._get_node_confs()
+        with self.catalog.transaction():
+            os.rename(self.sandbox_dir, renamed.sandbox_dir)
+            self.catalog.delete_sandbox(self.slug)
+            renamed._write_conf(config, node_confs)
+            cpupin.rename_sandbox(self.catalog, self.slug, renamed.slug)
+        renamed._fill(config, node_confs)
+        return renamed
+
+    def _get_allocator(self):
+        pools = conf.get_network_pools(self.parsed_args.state_dir)
+        return ipam.SubnetAllocator(self.catalog, pools)
 
     def _create_nodes(self, tpl):
         """Given a template instance, create the libvirt XML file definition of
@@ -114,7 +278,9 @@ class Sandbox(object):
         for node_info in tpl.nodes:
             node_name = node_info['name']
             n = node.Node(self, node_name)
-            n.create(node_info)
+            with timing.span('node.create', node=node_name):
+                n.create(node_info, device_profile=tpl.device_profile,
+                         disk_settings=tpl.disk_settings)
             nodes.append(n.get_info())
         return nodes
 
@@ -127,63 +293,278 @@ class Sandbox(object):
             return Sandbox.STATUS_NO_NODES
         else:
             status = Sandbox.STATUS_DOWN
-            
-            guest_states = [n.status for n in self.nodes]
-            if all(node.Node.STATUS_UP == s for s in guest_states):
+
+            # Node.status reads from the bulk host state snapshot, so this
+            # costs no libvirt calls beyond the first node's.
+            guest_states = [(n, n.status) for n in self.nodes]
+            if all(node.Node.STATUS_UP == s for n, s in guest_states):
                 status = Sandbox.STATUS_UP
-            elif node.Node.STATUS_ERROR in guest_states:
-                node_errors = [n.error for n in self.nodes
-                               if n.status == node.Node.STATUS_ERROR]
+            elif all(node.Node.STATUS_SUSPENDED == s
+                     for n, s in guest_states):
+                status = Sandbox.STATUS_SUSPENDED
+            elif all(node.Node.STATUS_PAUSED == s for n, s in guest_states):
+                status = Sandbox.STATUS_PAUSED
+            elif any(node.Node.STATUS_ERROR == s for n, s in guest_states):
+                node_errors = [
+                    str(n.error) if n.error is not None
+                    else "Node {0} is in error state.".format(n.name)
+                    for n, s in guest_states if s == node.Node.STATUS_ERROR
+                ]
                 self.error = "\n".join(node_errors)
                 status = Sandbox.STATUS_ERROR
         return status
 
-    def start(self):
+    def _node_tasks(self, action):
+        return [
+            (n.name, getattr(n, action), n.start_after)
+            for n in self.nodes
+        ]
+
+    def _teardown_tasks(self, action):
+        """Returns the node tasks for an action that takes nodes down. If
+        the nodes' start_after settings are invalid, e.g. in a sandbox
+        created before they were checked, the tasks are returned unordered
+        so that the sandbox can still be stopped and deleted.
+        """
+        tasks = self._node_tasks(action)
+        try:
+            executor.get_waves(tasks)
+        except (RuntimeError, TypeError) as err:
+            self.LOG.warning("Ignoring the node order of sandbox %s: %s",
+                             self.name, err)
+            tasks = [(name, func, None) for name, func, after in tasks]
+        return tasks
+
+    def start(self, parallel=conf.DEFAULT_PARALLEL, wait_for_capacity=None):
+        """Starts the sandbox's networks that are down, then up to `parallel`
+        nodes at a time. Nodes are started after the nodes listed in their
+        start_after template setting.
+
+        :param wait_for_capacity: Optional number of seconds to wait for the
+                                  host to have the capacity for the nodes.
+        :raises RuntimeError if the host lacks the capacity for the nodes, or
+                listing every network or node that failed to start.
+        """
         if self.error is not None:
             msg = ("Cannot start sandbox {0}. Sandbox is in error state.\n"
                    "Current error: {1}").format(self.name, self.error)
             self.LOG.warning(msg)
             return
 
-        #for net in self.networks:
-        #    net.start()
-        for n in self.nodes:
-            n.start()
+        nested = [n for n in self.nodes
+                  if n.error is None and n.exists() and n.nested_virt]
+        if nested:
+            self._check_nested_virt(nested)
+
+        stopped = [n.get_info() for n in self.nodes
+                   if n.error is None and n.exists() and not n.started()]
+        if stopped:
+            with timing.span('sandbox.admit'):
+                capacity.admit(self.parsed_args.state_dir, self.libvirt_uri,
+                               capacity.get_request(stopped, running=True),
+                               wait=wait_for_capacity)
+
+        with timing.span('sandbox.allocate_cpus'):
+            self._allocate_cpus()
+        try:
+            self._start_networks()
+            executor.run(self._node_tasks('start'), parallel=parallel,
+                         action='start')
+        finally:
+            with timing.span('sandbox.release_cpus'):
+                self._release_cpus()
+
+    def _check_nested_virt(self, nodes):
+        """Checks that the host can give the supplied nodes nested
+        virtualization. Nodes that only default to it are started without
+        it on a host that cannot, with a warning.
+
+        :raises RuntimeError if the host lacks nested virtualization and a
+                node's resources ask for it.
+        """
+        try:
+            host.check_nested_virt(self.libvirt_uri)
+        except RuntimeError as err:
+            required = [n for n in nodes if n.nested_virt_required]
+            conf_paths = ", ".join(
+                n.conf_path for n in (required or nodes))
+            if required:
+                msg = "{0} Or set nested_virt: false in the resources in {1}."
+                raise RuntimeError(msg.format(err, conf_paths))
+            self.LOG.warning("%s Starting the nodes without it. Set "
+                             "nested_virt: false in the resources in %s to "
+                             "silence this warning.", err, conf_paths)
+
+    def _network_tasks(self, action, status):
+        """Returns tasks that run the action on every network with the
+        supplied status. The statuses of all networks are read from one host
+        state snapshot, so the tasks skip that check.
+        """
+        return [
+            (net.name, functools.partial(getattr(net, action), check=False),
+             None)
+            for net in self.networks if net.status == status
+        ]
+
+    def _start_networks(self):
+        """Starts all of the sandbox's networks that are down at once."""
+        tasks = self._network_tasks('start', network.Network.STATUS_DOWN)
+        if tasks:
+            executor.run(tasks, parallel=len(tasks), action='start network')
+
+    def _stop_networks(self):
+        """Stops all of the sandbox's networks that are up at once."""
+        tasks = self._network_tasks('stop', network.Network.STATUS_UP)
+        if tasks:
+            executor.run(tasks, parallel=len(tasks), action='stop network')
+
+    def wait_ready(self, timeout=None, cloud_init=False):
+        """Waits for the sandbox's running nodes to boot, that is, to get a
+        DHCP lease and open their SSH port. See os_sandbox.readiness.
+
+        :param timeout: Optional number of seconds to wait.
+        :param cloud_init: Also wait for cloud-init to finish in the nodes.
+        :raises RuntimeError listing every node that stopped or was not
+                ready within the timeout.
+        :returns list of readiness.NodeReadiness, one per node.
+        """
+        waiter = readiness.ReadinessWaiter(self, cloud_init=cloud_init)
+        return waiter.wait(timeout=timeout)
+
+    def _allocate_cpus(self):
+        """Assigns host CPUs to every node of the sandbox before any of
+        them is started.
+
+        :raises RuntimeError if the host's CPU pools cannot fit the nodes.
+        """
+        nodes = [n for n in self.nodes if n.error is None and n.exists()]
+        if not nodes:
+            return
+        caps = host.get_capabilities(self.libvirt_uri)
+        cells = dict((cell_id, cell['cpus'])
+                     for cell_id, cell in caps.numa_cells.items())
+        host_cpus = [cpu for cpus in cells.values() for cpu in cpus]
+        cpu_conf = conf.get_host_config(self.parsed_args.state_dir)['cpus']
+        allocator = cpupin.CpuAllocator(self.catalog, host_cpus, cpu_conf,
+                                        numa_cells=cells)
+        host_states = states.get_states(self.libvirt_uri)
+        pins = allocator.allocate(
+            self.slug,
+            [(n.domain_name, n.cpu_policy, n.resources['vcpu'],
+              n.resources.get('numa_node')) for n in nodes],
+            host_states.domain_active)
+        for n in nodes:
+            n.cpu_pins = pins[n.domain_name]
+
+    def _release_cpus(self):
+        """Returns the host CPUs of the sandbox's nodes that are not running
+        to the pools.
+        """
+        stopped = [n.domain_name for n in self.nodes
+                   if n.error is None and not n.started()]
+        if stopped:
+            cpupin.release(self.catalog, stopped)
+
+    def stop(self, parallel=conf.DEFAULT_PARALLEL):
+        """Stops up to `parallel` nodes at a time, in the reverse of the
+        order they are started in, then the sandbox's networks. Every node
+        is stopped even if others failed to, but networks are left up if any
+        node failed to stop.
 
-    def stop(self):
-        #for net in self.networks:
-        #    net.stop()
-        for n in self.nodes:
-            n.stop()
+        :raises RuntimeError listing every node or network that failed to
+                stop.
+        """
+        try:
+            executor.run(self._teardown_tasks('stop'), parallel=parallel,
+                         reverse=True, action='stop',
+                         skip_after_failure=False)
+        finally:
+            self._release_cpus()
+        self._stop_networks()
+
+    def pause(self, parallel=conf.DEFAULT_PARALLEL):
+        """Pauses up to `parallel` running nodes at a time, in the reverse
+        of the order they are started in. Paused nodes keep their memory and
+        host CPUs, and continue at once when the sandbox is started.
 
-    def delete(self):
-        self.stop()
-        shutil.rmtree(self.sandbox_dir)
+        :raises RuntimeError listing every node that failed to pause.
+        """
+        executor.run(self._node_tasks('pause'), parallel=parallel,
+                     reverse=True, action='pause', skip_after_failure=False)
+
+    def suspend(self, parallel=conf.DEFAULT_PARALLEL):
+        """Saves the state of up to `parallel` running nodes at a time to
+        their node dirs, in the reverse of the order they are started in.
+        The sandbox's networks are left up, so the nodes' addresses and
+        leases are unchanged when they are resumed.
+
+        :raises RuntimeError listing every node that failed to suspend.
+        """
+        try:
+            executor.run(self._node_tasks('suspend'), parallel=parallel,
+                         reverse=True, action='suspend',
+                         skip_after_failure=False)
+        finally:
+            self._release_cpus()
+
+    def resume(self, parallel=conf.DEFAULT_PARALLEL, wait_for_capacity=None):
+        """Restores the saved state of suspended nodes, bringing up any of
+        the sandbox's networks that are down first, for instance after the
+        sandbox host rebooted. Nodes that were not suspended are started.
+
+        :raises RuntimeError if the host lacks the capacity for the nodes, or
+                listing every network or node that failed to resume.
+        """
+        self.start(parallel=parallel, wait_for_capacity=wait_for_capacity)
+
+    def delete(self, parallel=conf.DEFAULT_PARALLEL):
+        self.stop(parallel=parallel)
+        with timing.span('sandbox.remove'):
+            # The sandbox is forgotten and its subnets released before its
+            # files are removed, so a failure to update the catalog never
+            # leaves it describing a sandbox whose files are gone.
+            with self.catalog.transaction():
+                self.catalog.delete_sandbox(self.slug)
+                self._get_allocator().release(self.conf['networks'])
+            try:
+                shutil.rmtree(self.sandbox_dir)
+            except Exception:
+                # Indexes whatever is left of the sandbox's files again.
+                self.catalog.rebuild()
+                raise
+            # Records the sandboxes dir's new mtime, so that the removal is
+            # not mistaken for a change made behind the catalog's back.
+            with self.catalog.transaction():
+                pass
 
 
 class Sandboxes(object):
-    """Operations on all sandboxes on the sandbox host."""
-
-    MGMT_SUBNETS = [
-        n for n in netaddr.IPNetwork('10.10.0.0/16').subnet(28)
-    ]
-    PRIVATE_SUBNETS = [
-        n for n in netaddr.IPNetwork('10.20.0.0/16').subnet(28)
-    ]
-    PUBLIC_SUBNETS = [
-        n for n in netaddr.IPNetwork('10.30.0.0/16').subnet(28)
-    ]
-
-    def __init__(self, parsed_args):
+    """Operations on all sandboxes on the sandbox host.
+
+    The status of every sandbox, node and network is read from a single
+    bulk snapshot of host state (see os_sandbox.states), so iterating over
+    all sandboxes costs a constant number of libvirt calls.
+    """
+
+    def __init__(self, parsed_args, include_pool=False):
+        """
+        :param include_pool: Include the sandboxes held in warm pools, which
+                             are otherwise hidden until checked out.
+        """
         self.sandboxes_dir = os.path.join(parsed_args.state_dir,
                                           'sandboxes')
-        sandboxes = []
-        for entry in os.listdir(self.sandboxes_dir):
-            sb_entry = os.path.join(self.sandboxes_dir, entry)
-            if os.path.isdir(sb_entry):
-                sandboxes.append(Sandbox(parsed_args, entry))
-        
-        self.sandboxes = sandboxes
+        # All sandbox and node configs are read from the state catalog with
+        # two queries, rather than by parsing every YAML file in the
+        # sandboxes dir.
+        cat = catalog.get_catalog(parsed_args.state_dir)
+        with timing.span('sandboxes.load'):
+            node_confs = cat.get_nodes()
+            self.sandboxes = [
+                Sandbox(parsed_args, slug, conf=sb_conf,
+                        node_confs=node_confs.get(slug, {}))
+                for slug, sb_conf in cat.get_sandboxes()
+                if include_pool or 'pool' not in sb_conf
+            ]
 
     def __iter__(self):
         for sb in self.sandboxes:
@@ -191,37 +572,3 @@ class Sandboxes(object):
 
     def __len__(self):
         return len(self.sandboxes)
-
-    def get_next_available_network_cidrs(self):
-        """Returns a dict of CIDR network addresses for various networks, keyed
-        by the name of the network. At present, we return a management, private
-        and public network.
-        """
-        # The management network CIDRs are /28 subnets in a 10.10.0.0/16
-        # The private network CIDRs are /28 subnets in a 10.20.0.0/16
-        # The public network CIDRs are /28 subnets in a 10.30.0.0/16
-        if len(self.sandboxes) == 0:
-            return {
-                'mgmt': '10.10.0.0/28',
-                'private': '10.20.0.0/28',
-                'public': '10.30.0.0/28',
-            }
-
-        # We determine next available CIDR addresses by simply iterating the
-        # existing sandboxes, and removing the sandbox's mgmt CIDR from the set
-        # of /28 subnets in the mgmt /8 supernet CIDR and the first element in
-        # the remaining set of /28 subnets is used.
-        sb_cidrs = netaddr.IPSet([sb.networks['mgmt'].ip_net
-                                  for sb in self.sandboxes])
-        for cidr_idx, subnet in enumerate(Sandboxes.MGMT_SUBNETS):
-            if subnet not in sb_cidrs:
-                break
-
-        next_mgmt = str(Sandboxes.MGMT_SUBNETS[cidr_idx].cidr)
-        next_private = str(Sandboxes.PRIVATE_SUBNETS[cidr_idx].cidr)
-        next_public = str(Sandboxes.PUBLIC_SUBNETS[cidr_idx].cidr)
-        return {
-            'mgmt': next_mgmt,
-            'private': next_private,
-            'public': next_public,
-        }
@@ -0,0 +1,110 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+
+from os_sandbox import connection
+from os_sandbox import helpers
+from os_sandbox import timing
+
+libvirt = helpers.lazy_import('libvirt')
+
+LOG = logging.getLogger(__name__)
+
+
+class HostStates(object):
+    """A snapshot of the state of every domain and network on a libvirt host.
+
+    The snapshot is fetched lazily with a single bulk call for domains and a
+    single bulk call for networks, no matter how many sandboxes, nodes or
+    networks are subsequently looked up in it.
+    """
+
+    def __init__(self, uri=None):
+        self.uri = uri
+        self._lock = threading.Lock()
+        self._domains = None
+        self._networks = None
+
+    def _load_domains(self):
+        conn = connection.get_connection(self.uri)
+        # getAllDomainStats() returns the state of every domain in one RPC,
+        # whereas listAllDomains() requires a further dom.info() per domain.
+        with timing.span('libvirt.getAllDomainStats'):
+            records = conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        return dict(
+            (dom.name(), stats['state.state']) for dom, stats in records
+        )
+
+    def _load_networks(self):
+        conn = connection.get_connection(self.uri)
+        flags = libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE
+        with timing.span('libvirt.listAllNetworks'):
+            nets = conn.listAllNetworks(flags)
+        return set(net.name() for net in nets)
+
+    def domain_state(self, name):
+        """Returns the libvirt state code of the named domain or None if no
+        domain with that name exists.
+
+        :raises libvirt.libvirtError if the host could not be queried.
+        """
+        with self._lock:
+            if self._domains is None:
+                self._domains = self._load_domains()
+            return self._domains.get(name)
+
+    def domain_active(self, name):
+        """Returns True if the named domain exists and is not shut off, in
+        which case it holds host memory and CPUs, whether its guest is
+        running, paused or shutting down.
+
+        :raises libvirt.libvirtError if the host could not be queried.
+        """
+        state = self.domain_state(name)
+        return state is not None and state != libvirt.VIR_DOMAIN_SHUTOFF
+
+    def network_active(self, name):
+        """Returns True if the named network exists and is active.
+
+        :raises libvirt.libvirtError if the host could not be queried.
+        """
+        with self._lock:
+            if self._networks is None:
+                self._networks = self._load_networks()
+            return name in self._networks
+
+    def invalidate(self):
+        """Discards the snapshot so the next lookup re-queries the host."""
+        with self._lock:
+            self._domains = None
+            self._networks = None
+
+
+_STATES = {}
+_STATES_LOCK = threading.Lock()
+
+
+def get_states(uri=None):
+    """Returns the shared HostStates snapshot for the supplied URI."""
+    with _STATES_LOCK:
+        if uri not in _STATES:
+            _STATES[uri] = HostStates(uri)
+        return _STATES[uri]
+
+
+def invalidate(uri=None):
+    """Invalidates the snapshot for the supplied URI after the caller has
+    changed the state of a domain or network on it.
+    """
+    get_states(uri).invalidate()
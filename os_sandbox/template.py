@@ -11,11 +11,41 @@
 # under the License.
 
 import os
-import yaml
 
 import slugify
 
+from os_sandbox import catalog
+from os_sandbox import devices
+from os_sandbox import executor
 from os_sandbox import helpers
+from os_sandbox import network
+from os_sandbox import timing
+
+yaml = helpers.lazy_import('yaml')
+
+
+def check_start_order(tpl_name, nodes):
+    """Checks the start_after settings of a template's nodes.
+
+    :param tpl_name: Name of the template, used in error messages.
+    :param nodes: List of node configuration blocks of the template.
+    :raises RuntimeError if a node's start_after is not a list, names a node
+            that is not in the template, or the ordering contains a cycle.
+    """
+    tasks = []
+    for node_conf in nodes:
+        after = node_conf.get('start_after') or []
+        if not isinstance(after, list):
+            msg = ("Invalid start_after for node {0} in template {1}. It "
+                   "must be a list of node names.")
+            msg = msg.format(node_conf['name'], tpl_name)
+            raise RuntimeError(msg)
+        tasks.append((node_conf['name'], None, after))
+    try:
+        executor.get_waves(tasks)
+    except RuntimeError as err:
+        msg = "Invalid start_after in template {0}: {1}".format(tpl_name, err)
+        raise RuntimeError(msg)
 
 
 class Template(object):
@@ -23,6 +53,7 @@ class Template(object):
     def __init__(self, parsed_args, name):
         self.name = name
         self.slug = slugify.slugify(helpers.utf8_bytes(name))
+        self.catalog = catalog.get_catalog(parsed_args.state_dir)
         self.template_dir = os.path.join(parsed_args.state_dir,
                                          'templates',
                                          self.slug)
@@ -32,21 +63,59 @@ class Template(object):
             self._fill()
 
     def _fill(self):
-        self.conf = yaml.load(open(self.conf_path, 'rb').read())
+        with timing.span('template.load', template=self.name):
+            self.conf = self.catalog.get_template(self.slug)
+            if self.conf is None:
+                self.conf = yaml.load(open(self.conf_path, 'rb').read())
         self.full_name = self.conf['full_name']
         self.description = self.conf['description']
         self.nodes = self.conf['nodes']
+        # Nodes may override the template's device profile with their own
+        # device_profile setting.
+        self.device_profile = self.conf.get('device_profile',
+                                            devices.DEFAULT_PROFILE)
+        # Settings of the sandboxes' networks, keyed by network name. See
+        # network.NETWORK_SETTINGS.
+        self.networks = self.conf.get('networks') or {}
+        # Settings of the nodes' disks, which nodes may override with their
+        # own disk settings. See devices.DISK_SETTINGS.
+        self.disk_settings = self.conf.get('disk') or {}
 
     def exists(self):
         """Returns True if the named template exists, False otherwise."""
         return os.path.exists(self.conf_path)
 
-    def create(self, full_name=None, description=None, nodes=None):
-        """Creates a new template."""
+    def create(self, full_name=None, description=None, nodes=None,
+               device_profile=devices.DEFAULT_PROFILE, networks=None,
+               disk=None):
+        """Creates a new template.
+
+        :param networks: Optional dict of settings of the sandboxes'
+                         networks, keyed by network name. See
+                         network.NETWORK_SETTINGS.
+        :param disk: Optional dict of settings of the nodes' disks. See
+                     devices.DISK_SETTINGS.
+        :raises RuntimeError if a template with the name exists or the
+                settings are not valid.
+        """
         if self.exists():
             msg = "A template with name {0} already exists.".format(self.name)
             raise RuntimeError(msg)
 
+        devices.check_profile(device_profile)
+        check_start_order(self.name, nodes or [])
+        for node_conf in nodes or []:
+            if 'device_profile' in node_conf:
+                devices.check_profile(node_conf['device_profile'])
+            node_disk = dict(disk or {})
+            node_disk.update(node_conf.get('disk') or {})
+            devices.check_disk_settings('node {0}'.format(node_conf['name']),
+                                        node_disk)
+        devices.check_disk_settings('template {0}'.format(self.name),
+                                    disk or {})
+        for net_name, settings in (networks or {}).items():
+            network.check_settings(net_name, settings)
+
         full_name = full_name or self.name
         nodes = nodes or []
         description = description or self.name
@@ -54,8 +123,15 @@ class Template(object):
             'full_name': full_name,
             'description': description,
             'nodes': nodes,
+            'device_profile': device_profile,
         }
+        if networks:
+            conf['networks'] = networks
+        if disk:
+            conf['disk'] = disk
         os.mkdir(self.template_dir, 0755)
         with open(self.conf_path, 'wb') as conf_file:
-            conf_file.write(yaml.dump(conf, default_flow_style=False))
+            conf_file.write(yaml.safe_dump(conf,
+                                           default_flow_style=False))
+        self.catalog.add_template(self.slug, conf)
         self._fill()
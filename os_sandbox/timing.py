@@ -0,0 +1,218 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import threading
+import time
+
+# Commands record how long their phases take as a tree of named spans, e.g.
+#
+#     with timing.span('node.get_xml', node=self.name):
+#         xml = self._get_xml()
+#
+# Recording is off unless enable() was called, for the --timings and
+# --timings-file options. Until then span() returns a shared object that
+# does nothing, so instrumented code costs one function call per span.
+
+# Span names are nested under their parents' names by this much in the
+# report.
+INDENT = '  '
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+_enabled = False
+_spans = []
+_spans_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Span(object):
+    """A timed phase of a command. Spans entered while another span is open
+    in the same thread are its children.
+    """
+
+    def __init__(self, name, parent=None, attrs=None):
+        """
+        :param name: Name of the phase. Spans with the same name under the
+                     same parents are summed up in the report.
+        :param parent: Optional Span to nest the span under, for spans
+                       opened in another thread than their parent.
+        :param attrs: Optional dict of details, written to the trace file.
+        """
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs or {}
+        self.start = None
+        self.end = None
+        self.thread = threading.current_thread()
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def path(self):
+        """Tuple of the names of the span's ancestors and the span."""
+        names = []
+        span = self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return tuple(reversed(names))
+
+    def __enter__(self):
+        stack = _get_stack()
+        if self.parent is None and stack:
+            self.parent = stack[-1]
+        stack.append(self)
+        self.thread = threading.current_thread()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.time()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _get_stack().pop()
+        with _spans_lock:
+            _spans.append(self)
+        return False
+
+
+def enable():
+    """Starts recording spans."""
+    global _enabled
+    _enabled = True
+
+
+def enabled():
+    """Returns True if spans are being recorded."""
+    return _enabled
+
+
+def span(name, parent=None, **attrs):
+    """Returns a context manager that records the time spent in its block as
+    a span with the supplied name and details, if recording is enabled.
+
+    :param parent: Optional Span to nest the span under. Defaults to the
+                   innermost span open in the current thread.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, parent=parent, attrs=attrs)
+
+
+def current():
+    """Returns the innermost span open in the current thread, or None."""
+    if not _enabled:
+        return None
+    stack = _get_stack()
+    return stack[-1] if stack else None
+
+
+def get_spans():
+    """Returns the finished spans in the order they started."""
+    with _spans_lock:
+        return sorted(_spans, key=lambda s: s.start)
+
+
+def get_summary():
+    """Sums up the finished spans by their path from the root span.
+
+    :returns list of (depth, name, count, total_seconds, max_seconds)
+             tuples, with every path following its parent and siblings in
+             the order they first started.
+    """
+    rows = {}
+    first_start = {}
+    for s in get_spans():
+        path = s.path
+        row = rows.setdefault(path, [0, 0.0, 0.0])
+        row[0] += 1
+        row[1] += s.duration
+        row[2] = max(row[2], s.duration)
+        for i in range(1, len(path) + 1):
+            first_start.setdefault(path[:i], s.start)
+
+    def sort_key(path):
+        return tuple(first_start[path[:i]] for i in range(1, len(path) + 1))
+
+    return [
+        (len(path) - 1, path[-1], rows[path][0], rows[path][1],
+         rows[path][2])
+        for path in sorted(rows, key=sort_key)
+    ]
+
+
+def format_summary():
+    """Returns the summary of the finished spans as a table."""
+    summary = get_summary()
+    width = max([len(INDENT * d + name) for d, name, _c, _t, _m in summary] +
+                [len('Span')])
+    line = "{0:<%d}  {1:>5}  {2:>10}  {3:>10}" % width
+    lines = [line.format('Span', 'Count', 'Total (s)', 'Max (s)')]
+    for depth, name, count, total, max_seconds in summary:
+        lines.append(line.format(INDENT * depth + name, count,
+                                 "%.4f" % total, "%.4f" % max_seconds))
+    return "\n".join(lines)
+
+
+def write_trace(path):
+    """Writes the finished spans to the supplied path in the Trace Event
+    JSON format, which chrome://tracing and Perfetto display as a timeline
+    with a track per thread.
+    """
+    pid = os.getpid()
+    events = []
+    threads = {}
+    for s in get_spans():
+        threads[s.thread.ident] = s.thread.name
+        events.append({
+            'name': s.name,
+            'ph': 'X',
+            'ts': int(s.start * 1000000),
+            'dur': int(s.duration * 1000000),
+            'pid': pid,
+            'tid': s.thread.ident,
+            'args': s.attrs,
+        })
+    for ident, name in threads.items():
+        events.append({
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': ident,
+            'args': {'name': name},
+        })
+    with open(path, 'wb') as trace_file:
+        trace_file.write(json.dumps({
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+        }, default=str).encode('utf-8'))
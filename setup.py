@@ -51,14 +51,22 @@ setup(
         ],
         'os_sandbox': [
             'setup = os_sandbox.cmd.setup:Setup',
+            'host capacity = os_sandbox.cmd.host:HostCapacity',
+            'host watch = os_sandbox.cmd.host:HostWatch',
             'image list = os_sandbox.cmd.image:ImageList',
+            'metrics = os_sandbox.cmd.metrics:Metrics',
+            'pool list = os_sandbox.cmd.pool:PoolList',
+            'pool fill = os_sandbox.cmd.pool:PoolFill',
             'template list = os_sandbox.cmd.template:TemplateList',
             'template show = os_sandbox.cmd.template:TemplateShow',
             'sandbox list = os_sandbox.cmd.sandbox:SandboxList',
             'sandbox show = os_sandbox.cmd.sandbox:SandboxShow',
             'sandbox start = os_sandbox.cmd.sandbox:SandboxStart',
             'sandbox stop = os_sandbox.cmd.sandbox:SandboxStop',
+            'sandbox suspend = os_sandbox.cmd.sandbox:SandboxSuspend',
+            'sandbox resume = os_sandbox.cmd.sandbox:SandboxResume',
             'sandbox create = os_sandbox.cmd.sandbox:SandboxCreate',
+            'sandbox checkout = os_sandbox.cmd.sandbox:SandboxCheckout',
             'sandbox delete = os_sandbox.cmd.sandbox:SandboxDelete',
         ],
     },